@@ -1,9 +1,96 @@
-from flask import Flask
-import threading
+from flask import Flask, Response, request
+import fcntl
+import logging
+import os
 import main  # Import the bot module
+import metrics
+from Utils import constants as keys
+
+logger = logging.getLogger(__name__)
+
+# Only one process may run the bot, the first one to take this lock
+BOT_LOCK_FILE = getattr(keys, 'BOT_LOCK_FILE', '/tmp/telebot.lock')
 
 app = Flask(__name__)
 
+_bot = None  # main.WebhookBot once this process owns the bot in webhook mode
+_poller = None  # main.PollingBot once this process owns the bot in polling mode
+_lock_file = None
+
+
+def acquire_bot_lock(path=None):
+    """Take the bot ownership lock without waiting; returns True if this process owns it."""
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    lock_file = open(path or BOT_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    _lock_file = lock_file
+    return True
+
+
+def release_bot_lock():
+    """Let another process take over the bot."""
+    global _lock_file
+    if _lock_file is not None:
+        fcntl.flock(_lock_file, fcntl.LOCK_UN)
+        _lock_file.close()
+        _lock_file = None
+
+
+def start_bot():
+    """Start the bot in this process unless another process already runs it.
+
+    Uses webhook mode when WEBHOOK_URL is configured, polling otherwise.
+    """
+    global _bot, _poller
+    if not acquire_bot_lock():
+        logger.info(f"Bot is owned by another process, pid {os.getpid()} only serves HTTP")
+        return False
+    mode = 'webhook' if main.WEBHOOK_URL else 'polling'
+    bot = None
+    try:
+        if main.WEBHOOK_URL:
+            bot = main.WebhookBot(main.build_application(webhook=True))
+            bot.start()
+            _bot = bot
+        else:
+            bot = main.PollingBot(main.build_application())
+            bot.start()
+            _poller = bot
+    except Exception as e:
+        logger.critical(f"Bot failed to start in {mode} mode: {e}", exc_info=True)
+        # Do not leave a half-started loop thread behind or keep other processes from taking over
+        if bot is not None:
+            try:
+                bot.stop()
+            except Exception as stop_error:
+                logger.warning(f"Stopping the half-started bot failed: {stop_error}")
+        release_bot_lock()
+        return False
+    return True
+
+
+def stop_bot():
+    """Stop the bot in either mode, running its shutdown hook, then release the ownership lock."""
+    global _bot, _poller
+    try:
+        if _bot is not None:
+            _bot.stop()
+            _bot = None
+        if _poller is not None:
+            _poller.stop()
+            _poller = None
+    finally:
+        release_bot_lock()
+
+
 @app.route('/')
 def home():
     return 'Telegram Bot is running!'
@@ -12,11 +99,26 @@ def home():
 def health():
     return {'status': 'healthy'}
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route(main.WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    bot = _bot
+    if bot is None:
+        # Telegram retries failed deliveries, so the update is not lost
+        return {'status': 'bot not running in this process'}, 503
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != bot.secret:
+        return {'status': 'forbidden'}, 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {'status': 'invalid update'}, 400
+    bot.submit(data)
+    return {'status': 'ok'}
+
 if __name__ == '__main__':
-    # Start the bot in a separate thread
-    bot_thread = threading.Thread(target=main.run_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
-    
+    start_bot()
+
     # Run the Flask app
-    app.run(host='0.0.0.0', port=10000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=10000)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Telegram Finance Bot.
+
+Runs message handling, every report type and multi-line saves against the
+in-process Google Sheets stand-in (tests/fake_sheets.py) at several sheet
+sizes, and stores the timings as JSON so runs can be compared for regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+project_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_dir)
+sys.path.insert(0, os.path.join(project_dir, 'tests'))
+
+from fake_sheets import FakeSheets, generate_spendings  # noqa: E402
+import responses  # noqa: E402
+import spendings  # noqa: E402
+from scheduler import SheetsScheduler  # noqa: E402
+
+REPORTS = {'day': '📊 День', 'week': '📊 Неделя', 'month': '📊 Месяц', 'year': '📊 Год'}
+BALANCE_MESSAGE = '💰💰💰  Сколько у нас всего денег 💰💰💰'
+MULTI_LINE_EXPENSES = '\n'.join(f'{amount} item {amount}' for amount in range(11, 21))
+
+
+def cold():
+    """Forget everything derived from the sheet, like a freshly started bot."""
+    spendings.reset_caches()
+    responses.chat_states.clear()
+
+
+def warm():
+    """Keep the replica but drop cached report texts, like right after a write."""
+    spendings._report_cache.clear()
+
+
+def build_cases():
+    """(name, setup, action) for every timed scenario."""
+    cases = []
+    for name, message in REPORTS.items():
+        cases.append((f'report_{name}_cold', cold, lambda m=message: spendings.get_report(m)))
+        cases.append((f'report_{name}_warm', warm, lambda m=message: spendings.get_report(m)))
+        cases.append((f'report_{name}_cached', None, lambda m=message: spendings.get_report(m)))
+    cases.append(('balance_cold', cold, lambda: responses.sample_responses(BALANCE_MESSAGE)))
+    cases.append(('balance_warm', None, lambda: responses.sample_responses(BALANCE_MESSAGE)))
+    cases.append(('message_save', None, lambda: responses.sample_responses('12.50 coffee')))
+    cases.append(('message_category', None, lambda: responses.sample_responses(responses.categories[0])))
+    cases.append(('message_cancel', None, lambda: responses.sample_responses('❌ Отмена')))
+    cases.append(('multi_save', None, lambda: responses.sample_responses(MULTI_LINE_EXPENSES)))
+    cases.append(('multi_save_categorized', None, save_and_categorize))
+    cases.append(('message_report_day', warm, lambda: responses.sample_responses(REPORTS['day'])))
+    return cases
+
+
+def save_and_categorize():
+    """A multi-line save followed by a category press for every expense."""
+    responses.sample_responses(MULTI_LINE_EXPENSES)
+    for _ in MULTI_LINE_EXPENSES.split('\n'):
+        responses.sample_responses(responses.categories[1])
+
+
+def run_case(fake, setup, action, repeat):
+    timings = []
+    calls = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        before = len(fake.calls)
+        started = time.perf_counter()
+        action()
+        timings.append((time.perf_counter() - started) * 1000)
+        calls += len(fake.calls) - before
+    return {
+        'runs': repeat,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'api_calls': calls / repeat,
+    }
+
+
+def run_size(rows, args):
+    fake = FakeSheets(latency=args.latency, row_latency=args.row_latency)
+    fake.set_values(spendings.SHEET_NAME, generate_spendings(rows))
+    fake.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '1234.56']])
+    spendings.get_sheet_service = lambda: fake
+    cold()
+    if args.storage != 'sheets':
+        spendings.stop_journal()
+        spendings.close_store()
+        directory = tempfile.mkdtemp(prefix='telebot-benchmark-')
+        spendings.STORAGE_BACKEND = args.storage
+        spendings.LEDGER_FILE = os.path.join(directory, 'spendings.ledger')
+        spendings.SQLITE_FILE = os.path.join(directory, 'spendings.db')
+        spendings.JOURNAL_FILE = os.path.join(directory, 'journal.db')
+        spendings.get_store()
+
+    results = {}
+    for name, setup, action in build_cases():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        results[name] = run_case(fake, setup, action, args.repeat)
+        print(f"{rows:>8} rows  {name:<28} median {results[name]['median_ms']:>10.2f} ms"
+              f"  ({results[name]['api_calls']:.1f} API calls)")
+    responses.flush_pending_categories()
+    if args.storage != 'sheets':
+        spendings.stop_journal()
+        spendings.close_store()
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """Print median changes against a previous run; returns the regressions."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for size, cases in results.items():
+        for name, stats in cases.items():
+            before = baseline.get(size, {}).get(name)
+            if not before or not before['median_ms']:
+                continue
+            ratio = stats['median_ms'] / before['median_ms']
+            marker = '  REGRESSION' if ratio > threshold else ''
+            print(f"{size:>8} rows  {name:<28} {before['median_ms']:>10.2f} -> {stats['median_ms']:>10.2f} ms"
+                  f"  x{ratio:.2f}{marker}")
+            if marker:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='sheet sizes in rows (default: 1000 10000 100000)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per scenario (default: 5)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated seconds per API request (default: 0.05)')
+    parser.add_argument('--row-latency', type=float, default=0.00001,
+                        help='simulated seconds per row read or written (default: 0.00001)')
+    parser.add_argument('--quotas', action='store_true',
+                        help='throttle to the configured Sheets quotas (by default requests are not throttled)')
+    parser.add_argument('--storage', choices=spendings.STORAGE_BACKENDS, default='sheets',
+                        help='primary store of spendings; Google Sheets only mirrors a local one (default: sheets)')
+    parser.add_argument('--only', nargs='+', help='run only scenarios whose name contains one of these')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to store the JSON results')
+    parser.add_argument('--compare', help='previous results file to compare medians with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='median ratio reported as a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Every save must reach the fake sheet to be measured
+    spendings.WRITE_BEHIND = False
+    if not args.quotas:
+        spendings._scheduler = SheetsScheduler(None, None)
+
+    results = {str(rows): run_size(rows, args) for rows in args.sizes}
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'repeat': args.repeat, 'latency': args.latency, 'row_latency': args.row_latency,
+                     'quotas': args.quotas, 'storage': args.storage},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        print(f"\nCompared with {args.compare}:")
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} scenarios regressed by more than x{args.threshold}")
+            sys.exit(1)
+        print("\n✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# Gunicorn settings for app:app
+# One worker: the bot runs inside the worker and only one process may own it
+workers = 1
+threads = 4
+
+
+def post_worker_init(worker):
+    import app
+    app.start_bot()
+
+
+def worker_exit(server, worker):
+    # Webhook or polling: the shutdown hook flushes pending writes before the bot lock is released
+    import app
+    app.stop_bot()
@@ -0,0 +1,394 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Flusher settings
+FLUSH_INTERVAL = 2  # seconds between flush attempts while entries are pending
+FLUSH_BATCH_SIZE = 100  # rows sent per append request
+MAX_BACKOFF = 300  # seconds, upper bound for the retry delay after failures
+
+# Flushed entries are only needed for undo and for refs still held by chats
+KEEP_FLUSHED = 20  # newest flushed entries that are always kept
+KEEP_FLUSHED_SECONDS = 24 * 3600  # older flushed entries are kept for this long
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_FLUSHED = 'flushed'
+
+# Entries undone while in flight: their sheet row is cleared once it is known
+DELETE_REQUESTED = 1
+DELETE_DONE = 2
+
+
+class JournalRef(namedtuple('JournalRef', ['entry_id'])):
+    """Reference to a journaled spending whose sheet row may not be known yet."""
+
+    __slots__ = ()
+
+
+class SpendingJournal:
+    """Durable local journal for write-behind spending saves.
+
+    Rows are committed to SQLite before the user is acknowledged and a
+    background thread sends them to Google Sheets in batches. ``flush_rows``
+    receives a list of sheet rows, appends them in one request and returns the
+    sheet row number of the first one. ``update_categories`` receives
+    (row_number, category) pairs chosen while their row was in flight.
+    ``find_rows`` is used after a crash to look up rows that may have been
+    sent without being marked as flushed; it gets a list of sheet rows and
+    returns the row number for each (or None). ``clear_rows`` receives the
+    sheet row numbers of rows undone while they were being sent.
+    ``on_flushed`` receives the first row number and the rows of a batch once
+    it is marked flushed, under the journal lock: inside holding_flushes()
+    a row is either in unflushed_rows() or has been passed to it. Flushed
+    entries beyond the newest ``keep`` are deleted after ``keep_seconds``.
+    """
+
+    def __init__(self, path, flush_rows, update_categories=None, find_rows=None, clear_rows=None,
+                 on_flushed=None, interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH_SIZE,
+                 keep=KEEP_FLUSHED, keep_seconds=KEEP_FLUSHED_SECONDS):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.update_categories = update_categories
+        self.find_rows = find_rows
+        self.clear_rows = clear_rows
+        self.on_flushed = on_flushed
+        self.interval = interval
+        self.batch_size = batch_size
+        self.keep = keep
+        self.keep_seconds = keep_seconds
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._failures = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' created_at REAL NOT NULL,'
+            ' row TEXT NOT NULL,'
+            ' category TEXT,'
+            ' status TEXT NOT NULL,'
+            ' row_number INTEGER,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' last_error TEXT)'
+        )
+        columns = [column[1] for column in self._conn.execute('PRAGMA table_info(entries)')]
+        if 'deleted' not in columns:
+            self._conn.execute('ALTER TABLE entries ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_status ON entries (status, id)')
+
+    # Writes coming from the bot
+
+    def append(self, row):
+        """Journal one sheet row and return its JournalRef."""
+        return self.append_many([row])[0]
+
+    def append_many(self, rows):
+        """Journal several sheet rows in one transaction."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                refs = []
+                for row in rows:
+                    cursor = self._conn.execute(
+                        'INSERT INTO entries (created_at, row, status) VALUES (?, ?, ?)',
+                        (now, json.dumps(row, ensure_ascii=False), STATUS_PENDING)
+                    )
+                    refs.append(JournalRef(cursor.lastrowid))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._wakeup.set()
+        return refs
+
+    def set_category(self, ref, category):
+        """Attach ``category`` to a journaled row.
+
+        Returns None when the row is still waiting in the journal (it will be
+        sent with the category) or was undone, otherwise the sheet row number
+        the caller has to update.
+        """
+        with self._lock:
+            entry = self._conn.execute(
+                'SELECT status, row_number, deleted FROM entries WHERE id = ?', (ref.entry_id,)
+            ).fetchone()
+            if entry is None:
+                raise KeyError(f"Unknown journal entry {ref.entry_id}")
+            status, row_number, deleted = entry
+            if deleted:
+                return None
+            if status == STATUS_FLUSHED:
+                return row_number
+            # A row already in flight gets its category written by the flusher afterwards
+            self._conn.execute('UPDATE entries SET category = ? WHERE id = ?', (category, ref.entry_id))
+            return None
+
+    def last_unsent(self):
+        """JournalRef of the newest entry not flushed yet (waiting or being sent), or None."""
+        with self._lock:
+            entry = self._conn.execute(
+                'SELECT id FROM entries WHERE status != ? AND deleted = 0 ORDER BY id DESC LIMIT 1',
+                (STATUS_FLUSHED,)
+            ).fetchone()
+        return JournalRef(entry[0]) if entry else None
+
+    def discard(self, ref):
+        """Undo an entry that is not flushed yet; returns False if it is too late.
+
+        A waiting entry is dropped. One being sent is marked, and its row is
+        cleared through ``clear_rows`` once its row number is known.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM entries WHERE id = ? AND status = ?', (ref.entry_id, STATUS_PENDING)
+            )
+            if cursor.rowcount == 1:
+                return True
+            if self.clear_rows is None:
+                return False
+            cursor = self._conn.execute(
+                'UPDATE entries SET deleted = ? WHERE id = ? AND status = ? AND deleted = 0',
+                (DELETE_REQUESTED, ref.entry_id, STATUS_SENDING)
+            )
+        return cursor.rowcount == 1
+
+    def resolve(self, ref):
+        """Sheet row number of a journaled entry, or None if not flushed yet."""
+        with self._lock:
+            entry = self._conn.execute(
+                'SELECT row_number FROM entries WHERE id = ? AND status = ?', (ref.entry_id, STATUS_FLUSHED)
+            ).fetchone()
+        return entry[0] if entry else None
+
+    def unflushed_rows(self):
+        """Sheet rows (with their category) of the entries not flushed yet, undone ones aside, oldest first."""
+        with self._lock:
+            entries = self._conn.execute(
+                'SELECT row, category FROM entries WHERE status != ? AND deleted = 0 ORDER BY id',
+                (STATUS_FLUSHED,)
+            ).fetchall()
+        return [self._row_with_category(row, category) for row, category in entries]
+
+    @contextmanager
+    def holding_flushes(self):
+        """Keep entries from being marked flushed meanwhile (sending goes on)."""
+        with self._lock:
+            yield
+
+    def row(self, ref):
+        """Sheet row (with its category) of a journaled entry, or None if it is gone."""
+        with self._lock:
+            entry = self._conn.execute('SELECT row, category FROM entries WHERE id = ?', (ref.entry_id,)).fetchone()
+        return self._row_with_category(*entry) if entry else None
+
+    def ref_of_row(self, row_number):
+        """JournalRef of the flushed entry sent to sheet row ``row_number``, or None."""
+        with self._lock:
+            entry = self._conn.execute(
+                'SELECT id FROM entries WHERE status = ? AND row_number = ? ORDER BY id DESC LIMIT 1',
+                (STATUS_FLUSHED, row_number)
+            ).fetchone()
+        return JournalRef(entry[0]) if entry else None
+
+    def rows_deleted(self, first_row, count):
+        """Sheet rows ``first_row``.. were deleted: forget entries sent there and renumber later ones."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM entries WHERE status = ? AND row_number >= ? AND row_number < ?',
+                                   (STATUS_FLUSHED, first_row, first_row + count))
+                self._conn.execute('UPDATE entries SET row_number = row_number - ?'
+                                   ' WHERE status = ? AND row_number >= ?',
+                                   (count, STATUS_FLUSHED, first_row + count))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM entries WHERE status != ?', (STATUS_FLUSHED,)
+            ).fetchone()[0]
+
+    # Sending to Google Sheets
+
+    def flush(self):
+        """Send pending entries to Google Sheets; returns the number of rows flushed."""
+        self.reconcile()
+        flushed = 0
+        while True:
+            with self._lock:
+                batch = self._conn.execute(
+                    'SELECT id, row, category FROM entries WHERE status = ? ORDER BY id LIMIT ?',
+                    (STATUS_PENDING, self.batch_size)
+                ).fetchall()
+                if not batch:
+                    self._prune()
+                    return flushed
+                ids = [entry_id for entry_id, _, _ in batch]
+                self._mark(ids, STATUS_SENDING)
+
+            values = [self._row_with_category(row, category) for _, row, category in batch]
+            try:
+                first_row = self.flush_rows(values)
+            except Exception as e:
+                # The request may still have reached the sheet, leave the rows in flight
+                # so reconcile() checks for them before anything is resent
+                with self._lock:
+                    self._conn.executemany(
+                        'UPDATE entries SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                        [(str(e), entry_id) for entry_id in ids]
+                    )
+                raise
+
+            late = self._mark_flushed(ids, first_row, values)
+            flushed += len(ids)
+            logger.info(f"Flushed {len(ids)} journaled spendings (rows {first_row}-{first_row + len(ids) - 1})")
+            if late and self.update_categories is not None:
+                self.update_categories(late)
+            self._clear_deleted()
+
+    def reconcile(self):
+        """Resolve entries left in flight by a crash before they are resent."""
+        with self._lock:
+            stuck = self._conn.execute(
+                'SELECT id, row, category, deleted FROM entries WHERE status = ? ORDER BY id', (STATUS_SENDING,)
+            ).fetchall()
+        if not stuck:
+            self._clear_deleted()
+            return
+        if self.find_rows is None:
+            # Without a way to check the sheet, resending is the only option that loses nothing
+            with self._lock:
+                self._mark([entry_id for entry_id, _, _, _ in stuck], STATUS_PENDING)
+                # Undone rows that never reached the sheet need no resend
+                self._conn.execute('DELETE FROM entries WHERE status = ? AND deleted != 0', (STATUS_PENDING,))
+            return
+
+        row_numbers = self.find_rows([json.loads(row) for _, row, _, _ in stuck])
+        categories = []
+        with self._lock:
+            for (entry_id, _, category, deleted), row_number in zip(stuck, row_numbers):
+                if row_number is None:
+                    if deleted:
+                        self._conn.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+                    else:
+                        self._mark([entry_id], STATUS_PENDING)
+                    continue
+                self._conn.execute(
+                    'UPDATE entries SET status = ?, row_number = ? WHERE id = ?',
+                    (STATUS_FLUSHED, row_number, entry_id)
+                )
+                if category and not deleted:
+                    categories.append((row_number, category))
+        logger.info(f"Reconciled {len(stuck)} journaled spendings left in flight")
+        if categories and self.update_categories is not None:
+            self.update_categories(categories)
+        self._clear_deleted()
+
+    def _clear_deleted(self):
+        """Clear the sheet rows of flushed entries that were undone while in flight."""
+        with self._lock:
+            undone = self._conn.execute(
+                'SELECT id, row_number FROM entries WHERE status = ? AND deleted = ? ORDER BY id',
+                (STATUS_FLUSHED, DELETE_REQUESTED)
+            ).fetchall()
+        if not undone or self.clear_rows is None:
+            return
+        self.clear_rows([row_number for _, row_number in undone])
+        with self._lock:
+            self._conn.executemany('UPDATE entries SET deleted = ? WHERE id = ?',
+                                   [(DELETE_DONE, entry_id) for entry_id, _ in undone])
+        logger.info(f"Cleared {len(undone)} spendings undone while they were being sent")
+
+    def start(self):
+        """Start the background flusher (idempotent)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='journal-flusher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Stop the flusher after a last flush attempt."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._conn.close()
+
+    def _run(self):
+        while True:
+            delay = self.interval
+            try:
+                self.flush()
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                delay = min(MAX_BACKOFF, self.interval * 2 ** self._failures) * random.uniform(0.5, 1.0)
+                logger.warning(f"Journal flush failed ({self._failures} in a row), retrying in {delay:.0f}s: {e}")
+            if self._stopping.is_set():
+                return
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def _mark(self, ids, status):
+        self._conn.executemany('UPDATE entries SET status = ? WHERE id = ?', [(status, entry_id) for entry_id in ids])
+
+    def _mark_flushed(self, ids, first_row, rows):
+        """Record row numbers of the sent ``rows``; returns categories that changed while in flight."""
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE entries SET status = ?, row_number = ?, last_error = NULL WHERE id = ?',
+                [(STATUS_FLUSHED, first_row + offset, entry_id) for offset, entry_id in enumerate(ids)]
+            )
+            late = []
+            for offset, (entry_id, row) in enumerate(zip(ids, rows)):
+                sent = row[5] if len(row) > 5 else None
+                current, deleted = self._conn.execute(
+                    'SELECT category, deleted FROM entries WHERE id = ?', (entry_id,)
+                ).fetchone()
+                if current and current != sent and not deleted:
+                    late.append((first_row + offset, current))
+            if self.on_flushed is not None:
+                self.on_flushed(first_row, rows)
+            return late
+
+    def _prune(self):
+        """Delete flushed entries beyond the newest ``keep`` once they are ``keep_seconds`` old."""
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM entries WHERE status = ? AND deleted != ? AND created_at < ?'
+                ' AND id <= (SELECT MAX(id) FROM entries) - ?',
+                (STATUS_FLUSHED, DELETE_REQUESTED, time.time() - self.keep_seconds, self.keep)
+            )
+        if cursor.rowcount:
+            logger.info(f"Pruned {cursor.rowcount} flushed journal entries")
+
+    @staticmethod
+    def _row_with_category(row, category):
+        row = json.loads(row)
+        if category:
+            row = row[:5] + [category]
+        return row
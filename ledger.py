@@ -0,0 +1,301 @@
+import logging
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from storage import SpendingStore, parse_row, sheet_row, spending_frame
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TBLEDGR1'
+HEADER = np.dtype([('magic', 'S8'), ('record_size', '<u4'), ('reserved', '<u4')])
+
+# One spending. ``entry`` links the record to its copy in Google Sheets: the
+# write-behind journal entry id when positive, minus the sheet row number for
+# rows imported from the sheet, 0 when unknown.
+RECORD = np.dtype([
+    ('timestamp', '<i8'),  # seconds since 1970-01-01 in local wall-clock time
+    ('cents', '<i8'),
+    ('entry', '<i8'),
+    ('comment_offset', '<i8'),  # into the comment heap
+    ('comment_length', '<i4'),
+    ('category', '<i2'),  # 0 is no category, otherwise line number in the categories file
+    ('flags', 'u1'),
+    ('reserved', 'u1'),
+])
+
+DELETED = 1
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(moment):
+    return int((moment - EPOCH).total_seconds())
+
+
+def from_timestamps(timestamps):
+    """Timestamps as a datetime64[s] array (no copy)."""
+    return np.asarray(timestamps).view('datetime64[s]')
+
+
+class SpendingLedger:
+    """Append-only file of fixed-width spending records, read through mmap.
+
+    ``path`` holds a header and RECORD-sized records, ``path + '.heap'`` the
+    comments as UTF-8 and ``path + '.categories'`` the category names, one per
+    line. Records never move: deleting sets a flag and a category change
+    rewrites the record's category id in place, so aggregates are NumPy scans
+    over the mapped file without parsing or copying rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        if not os.path.exists(path):
+            header = np.array([(MAGIC, RECORD.itemsize, 0)], dtype=HEADER)
+            with open(path, 'wb') as f:
+                f.write(header.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self._file = open(path, 'r+b')
+        header = np.frombuffer(self._file.read(HEADER.itemsize), dtype=HEADER)
+        if len(header) != 1 or header['magic'][0] != MAGIC or header['record_size'][0] != RECORD.itemsize:
+            self._file.close()
+            raise ValueError(f"{path} is not a spendings ledger of this version")
+        self._heap = open(path + '.heap', 'a+b')
+        self._categories_file = open(path + '.categories', 'a+', encoding='utf-8')
+        self._categories_file.seek(0)
+        self._categories = [''] + self._categories_file.read().splitlines()
+        self._category_ids = {name: index for index, name in enumerate(self._categories)}
+        self._records = None
+
+    def close(self):
+        with self._lock:
+            self._records = None
+            self._file.close()
+            self._heap.close()
+            self._categories_file.close()
+
+    @property
+    def count(self):
+        """Number of records, deleted ones included."""
+        return (os.fstat(self._file.fileno()).st_size - HEADER.itemsize) // RECORD.itemsize
+
+    def records(self):
+        """All records as a memory-mapped structured array (writes go to the file)."""
+        with self._lock:
+            count = self.count
+            if self._records is None or len(self._records) != count:
+                if count == 0:
+                    self._records = np.zeros(0, dtype=RECORD)
+                else:
+                    self._records = np.memmap(self._file, dtype=RECORD, mode='r+',
+                                              offset=HEADER.itemsize, shape=(count,))
+            return self._records
+
+    def live(self):
+        """Records that are not deleted (a copy)."""
+        records = self.records()
+        return records[records['flags'] & DELETED == 0]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.records()['flags'] & DELETED == 0))
+
+    # Writing
+
+    def append(self, spendings):
+        """Append (moment, cents, comment, category, entry) tuples; returns the first new index."""
+        with self._lock:
+            records = np.zeros(len(spendings), dtype=RECORD)
+            self._heap.seek(0, os.SEEK_END)
+            offset = self._heap.tell()
+            comments = []
+            for index, (moment, cents, comment, category, entry) in enumerate(spendings):
+                data = (comment or '').encode('utf-8')
+                records[index] = (to_timestamp(moment), cents, entry, offset, len(data),
+                                  self._category_id(category), 0, 0)
+                comments.append(data)
+                offset += len(data)
+            self._heap.write(b''.join(comments))
+            self._heap.flush()
+            os.fsync(self._heap.fileno())
+
+            first = self.count
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(records.tobytes())
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return first
+
+    def set_category(self, index, category):
+        with self._lock:
+            records = self.records()
+            records['category'][index] = self._category_id(category)
+            records.flush()
+
+    def delete(self, index):
+        with self._lock:
+            records = self.records()
+            records['flags'][index] |= DELETED
+            records.flush()
+
+    def rows_deleted(self, first_row, count):
+        """Keep the sheet row links right after sheet rows ``first_row``.. were deleted."""
+        with self._lock:
+            records = self.records()
+            rows = -records['entry']
+            records['entry'][(rows >= first_row) & (rows < first_row + count)] = 0
+            records['entry'][rows >= first_row + count] += count
+            records.flush()
+
+    def _category_id(self, name):
+        name = name or ''
+        category_id = self._category_ids.get(name)
+        if category_id is None:
+            if '\n' in name:
+                raise ValueError(f"Category names cannot span lines: {name!r}")
+            self._categories_file.write(name + '\n')
+            self._categories_file.flush()
+            os.fsync(self._categories_file.fileno())
+            category_id = self._category_ids[name] = len(self._categories)
+            self._categories.append(name)
+        return category_id
+
+    # Lookups
+
+    def find(self, entry=None):
+        """Index of the live record with ``entry``, or of the newest live record; None if absent."""
+        records = self.records()
+        matches = records['flags'] & DELETED == 0
+        if entry is not None:
+            matches &= records['entry'] == entry
+        indexes = np.flatnonzero(matches)
+        return int(indexes[-1]) if len(indexes) else None
+
+    def category_names(self, ids):
+        return np.array(self._categories, dtype=object)[ids]
+
+    def comments(self, records):
+        """Comments of ``records`` in order, read from the heap."""
+        with self._lock:
+            heap = self._heap.fileno()
+            return [os.pread(heap, int(length), int(offset)).decode('utf-8')
+                    for offset, length in zip(records['comment_offset'], records['comment_length'])]
+
+    # Aggregates, same results as SpendingRollup
+
+    def total_cents(self):
+        records = self.records()
+        return int(records['cents'][records['flags'] & DELETED == 0].sum())
+
+    def categories_for(self, year, month=None):
+        """Totals per category as [(category, amount)] sorted by category."""
+        if month is None:
+            start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+        else:
+            start = datetime(year, month, 1)
+            end = datetime(year + (month == 12), month % 12 + 1, 1)
+        records = self.records()
+        timestamps = records['timestamp']
+        selected = ((timestamps >= to_timestamp(start)) & (timestamps < to_timestamp(end)) &
+                    (records['flags'] & DELETED == 0))
+        totals = np.bincount(records['category'][selected], weights=records['cents'][selected],
+                             minlength=len(self._categories))
+        # Category 0 is uncategorized, left out like in SpendingRollup
+        named = [(self._categories[category_id], int(round(cents)))
+                 for category_id, cents in enumerate(totals) if category_id and round(cents)]
+        return [(name, cents / 100) for name, cents in sorted(named)]
+
+    def year_totals(self):
+        """Totals per year of categorized spendings as [(year, amount)] sorted by year."""
+        records = self.live()
+        records = records[records['category'] != 0]
+        if not len(records):
+            return []
+        years = from_timestamps(records['timestamp']).astype('datetime64[Y]').astype(int) + 1970
+        found, positions = np.unique(years, return_inverse=True)
+        totals = np.bincount(positions, weights=records['cents'])
+        return [(int(year), int(round(cents)) / 100) for year, cents in zip(found, totals) if round(cents)]
+
+    def since(self, moment):
+        """Live records dated ``moment`` or later (a copy)."""
+        records = self.live()
+        return records[records['timestamp'] >= to_timestamp(moment)]
+
+
+class LedgerStore(SpendingStore):
+    """SpendingStore interface over a SpendingLedger, refs being record ``entry`` values."""
+
+    def __init__(self, path):
+        self.ledger = SpendingLedger(path)
+
+    def close(self):
+        self.ledger.close()
+
+    def append(self, rows, refs=None):
+        refs = list(refs) if refs is not None else [0] * len(rows)
+        spendings = []
+        for row, entry in zip(rows, refs):
+            parsed = parse_row(row)
+            if parsed is None:
+                raise ValueError(f"Not a spending row: {row!r}")
+            spendings.append(parsed + (entry,))
+        if spendings:
+            self.ledger.append(spendings)
+        return refs
+
+    def set_category(self, category, ref=None):
+        index = self.ledger.find(ref)
+        if index is None:
+            return False
+        self.ledger.set_category(index, category)
+        return True
+
+    def set_categories(self, assignments):
+        for ref, category in assignments:
+            if ref is not None:
+                self.set_category(category, ref)
+
+    def delete_last(self):
+        index = self.ledger.find()
+        if index is None:
+            return None
+        entry = int(self.ledger.records()['entry'][index])
+        self.ledger.delete(index)
+        return entry
+
+    def last_ref(self):
+        index = self.ledger.find()
+        return int(self.ledger.records()['entry'][index]) if index is not None else None
+
+    def sheet_rows_deleted(self, first_row, count):
+        self.ledger.rows_deleted(first_row, count)
+
+    def query(self, start, end=None):
+        records = self.ledger.since(datetime.combine(start, datetime.min.time()))
+        if end is not None:
+            records = records[records['timestamp'] < to_timestamp(datetime.combine(end, datetime.min.time()))]
+        return spending_frame(from_timestamps(records['timestamp']), records['cents'],
+                              self.ledger.comments(records), self.ledger.category_names(records['category']))
+
+    def categories_for(self, year, month=None):
+        return self.ledger.categories_for(year, month)
+
+    def year_totals(self):
+        return self.ledger.year_totals()
+
+    def total_cents(self):
+        return self.ledger.total_cents()
+
+    def __len__(self):
+        return len(self.ledger)
+
+    def rows(self):
+        records = self.ledger.live()
+        moments = from_timestamps(records['timestamp']).astype(datetime)
+        categories = self.ledger.category_names(records['category'])
+        return [(sheet_row(moment, int(cents), comment, category), int(entry))
+                for moment, cents, comment, category, entry
+                in zip(moments, records['cents'], self.ledger.comments(records), categories, records['entry'])]
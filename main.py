@@ -1,15 +1,24 @@
+import time
+_process_started = time.perf_counter()  # for the startup time breakdown
+
 import logging
 import asyncio
-import time
+import functools
+import secrets
+import threading
 import signal
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import pytz
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 
+import metrics
 import responses as responses
+import spendings
 from Utils import constants as keys
 
+_imports_done = time.perf_counter()
+
 # Set socket timeout globally to prevent hanging on API calls
 socket.setdefaulttimeout(30)
 
@@ -19,6 +28,7 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+metrics.install_error_counter()
 
 # Allowed chat IDs - bot will respond in these chats only
 ALLOWED_CHAT_IDS = [
@@ -26,6 +36,21 @@ ALLOWED_CHAT_IDS = [
     -4148217207     # Group chat with your wife
 ]
 
+# Blocking Google Sheets work runs in this pool so the event loop keeps polling
+SHEETS_WORKERS = getattr(keys, 'SHEETS_WORKERS', 4)
+HANDLER_TIMEOUT = getattr(keys, 'HANDLER_TIMEOUT', 45)  # seconds
+_executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix='sheets')
+responses.chat_states.executor = _executor  # idle category flushes too
+
+# Updates of different chats are handled concurrently, each chat's in order
+UPDATE_CONCURRENCY = getattr(keys, 'UPDATE_CONCURRENCY', 4)
+MAX_WAITING_UPDATES = 256  # updates queued behind busy chats or the concurrency limit
+
+# Webhook mode: Telegram POSTs updates to the Flask app instead of being polled
+WEBHOOK_URL = getattr(keys, 'WEBHOOK_URL', None)  # public base URL of the web service, enables webhook mode
+WEBHOOK_PATH = getattr(keys, 'WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = getattr(keys, 'WEBHOOK_SECRET', None)  # random per start if not set
+
 # Define the keyboard layout
 keyboard = [['💰💰💰  Сколько у нас всего денег 💰💰💰'],
             ['📊 День', '📊 Неделя', '📊 Месяц', '📊 Год'],
@@ -35,6 +60,81 @@ keyboard = [['💰💰💰  Сколько у нас всего денег 💰
             ['🌐 Сервисы', '📚 Образование', '✈️ Путешествия', '🌎 Прочее']]
 
 
+async def run_blocking(func, *args, timeout=None):
+    """Run a blocking call in the Sheets thread pool and await its result.
+
+    Raises asyncio.TimeoutError if the call does not finish within ``timeout``
+    seconds (HANDLER_TIMEOUT by default); the worker thread is left to finish
+    on its own.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor, functools.partial(func, *args))
+    return await asyncio.wait_for(future, timeout or HANDLER_TIMEOUT)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each chat's updates in order.
+
+    At most ``handler_limit`` handlers run at once. Updates waiting behind an
+    earlier update of their own chat do not take one of those slots, so a chat
+    with a slow report cannot hold up the others. ``max_concurrent_updates``
+    of the base class bounds the updates in progress or waiting.
+    """
+
+    def __init__(self, handler_limit, max_waiting_updates=MAX_WAITING_UPDATES):
+        if handler_limit < 1:
+            raise ValueError("`handler_limit` must be a positive integer!")
+        super().__init__(max(handler_limit, max_waiting_updates))
+        self.handler_limit = handler_limit
+        self._running = asyncio.Semaphore(handler_limit)
+        self._chats = {}  # chat id -> [lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await self._run(coroutine)
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def _run(self, coroutine):
+        async with self._running:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def instrumented(handler):
+    """Count and time a Telegram handler for /metrics."""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        metrics.UPDATES.inc(handler=handler.__name__)
+        with metrics.HANDLER_SECONDS.time(handler=handler.__name__):
+            return await handler(update, context)
+    return wrapper
+
+
+async def get_response(text, chat_id):
+    """Build the reply for ``text`` in ``chat_id`` without blocking the event loop."""
+    try:
+        return await run_blocking(responses.sample_responses, text, chat_id)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out after {HANDLER_TIMEOUT}s processing: {text[:50]}")
+        return "Google Sheets is taking too long to respond. Please try again later."
+
+
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Check if message is from allowed chat
@@ -54,6 +154,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in start command: {e}", exc_info=True)
 
 
+@instrumented
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Check if message is from allowed chat
@@ -77,7 +178,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        response = responses.sample_responses(text)
+        response = await get_response(text, update.effective_chat.id)
         
         await update.message.reply_text(response, reply_markup=reply_markup)
         logger.info(f"Message processed successfully in chat {update.effective_chat.id}")
@@ -99,6 +200,7 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Error sending error message: {send_error}")
 
 
+@instrumented
 async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /add command for adding expenses"""
     try:
@@ -110,7 +212,7 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         text = ' '.join(context.args)
-        response = responses.sample_responses(text)
+        response = await get_response(text, update.effective_chat.id)
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         await update.message.reply_text(response, reply_markup=reply_markup)
         logger.info(f"Expense added via command in chat {update.effective_chat.id}")
@@ -122,6 +224,7 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+@instrumented
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /report command for getting reports"""
     try:
@@ -129,17 +232,24 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         if not context.args:
-            await update.message.reply_text("Usage: /report <type>\nTypes: day, week, month, year")
+            await update.message.reply_text("Usage: /report <type>\nTypes: day, week, month, year [YYYY], years")
             return
         
         report_type = context.args[0].lower()
-        report_map = {'day': '📊 День', 'week': '📊 Неделя', 'month': '📊 Месяц', 'year': '📊 Год'}
+        report_map = {'day': '📊 День', 'week': '📊 Неделя', 'month': '📊 Месяц', 'year': '📊 Год',
+                      'years': spendings.YEARS_REPORT}
         
         if report_type not in report_map:
-            await update.message.reply_text("Invalid report type. Use: day, week, month, or year")
+            await update.message.reply_text("Invalid report type. Use: day, week, month, year [YYYY], or years")
             return
         
-        response = responses.sample_responses(report_map[report_type])
+        message = report_map[report_type]
+        if report_type == 'year' and len(context.args) > 1:
+            if not context.args[1].isdigit() or len(context.args[1]) != 4:
+                await update.message.reply_text("Invalid year. Example: /report year 2024")
+                return
+            message = f"{message} {context.args[1]}"
+        response = await get_response(message, update.effective_chat.id)
         await update.message.reply_text(response)
         logger.info(f"Report generated in chat {update.effective_chat.id}: {report_type}")
     except Exception as e:
@@ -150,13 +260,35 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+@instrumented
+async def archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /archive command: move closed years out of the Spendings sheet"""
+    try:
+        if update.effective_chat.id not in ALLOWED_CHAT_IDS:
+            return
+
+        # Archiving renumbers rows: chats are dropped first, which writes their
+        # buffered categories and stops them waiting for categories of earlier saves
+        await run_blocking(responses.chat_states.clear)
+        response = await run_blocking(spendings.archive_closed_years)
+        await update.message.reply_text(response)
+        logger.info(f"Archive run from chat {update.effective_chat.id}: {response}")
+    except Exception as e:
+        logger.error(f"Error in archive: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("Error archiving spendings. Please try again.")
+        except:
+            pass
+
+
+@instrumented
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /balance command for checking total balance"""
     try:
         if update.effective_chat.id not in ALLOWED_CHAT_IDS:
             return
         
-        response = responses.sample_responses('💰💰💰  Сколько у нас всего денег 💰💰💰')
+        response = await get_response('💰💰💰  Сколько у нас всего денег 💰💰💰', update.effective_chat.id)
         await update.message.reply_text(response)
         logger.info(f"Balance checked in chat {update.effective_chat.id}")
     except Exception as e:
@@ -167,7 +299,145 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
-def run_bot():
+def prewarm():
+    """Warm up Sheets access so the first message after a cold start is fast."""
+    try:
+        timings = spendings.prewarm()
+    except Exception as e:
+        logger.warning(f"Pre-warming Google Sheets access failed: {e}")
+        return
+    steps = ', '.join(f"{step} {seconds:.2f}s" for step, seconds in timings.items())
+    logger.info(f"Pre-warm done in {sum(timings.values()):.2f}s ({steps})")
+
+
+async def on_startup(application):
+    """Resume sending journaled spendings left over from the previous run.
+
+    Also starts pre-warming Sheets access and the balance refresh in the
+    background and logs how long the start took.
+    """
+    await run_blocking(spendings.get_journal)
+    logger.info(f"Startup: imports {_imports_done - _process_started:.2f}s, "
+                f"connected to Telegram after {time.perf_counter() - _process_started:.2f}s")
+    asyncio.get_running_loop().run_in_executor(_executor, prewarm)
+    spendings.start_balance_refresh()
+
+
+async def on_shutdown(application):
+    """Write buffered categories and journaled spendings, then stop accepting Sheets work."""
+    await run_blocking(responses.flush_pending_categories)
+    await run_blocking(spendings.stop_journal)
+    await run_blocking(spendings.stop_balance_refresh)
+    await run_blocking(spendings.close_store)
+    _executor.shutdown(wait=False)
+
+
+def build_application(webhook=False):
+    """Create the bot application with all handlers registered.
+
+    With ``webhook`` there is no updater; updates are put on
+    ``application.update_queue`` by whoever receives them.
+    """
+    builder = (Application.builder().token(keys.API_KEY)
+               .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if webhook:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("add", add_expense))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("balance", balance))
+    application.add_handler(CommandHandler("archive", archive))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(error)
+    return application
+
+
+class WebhookBot:
+    """Runs the application on its own event loop thread and feeds it webhook updates."""
+
+    def __init__(self, application, url=None, secret=None):
+        self.application = application
+        self.url = url or f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}"
+        self.secret = secret or WEBHOOK_SECRET or secrets.token_hex(32)
+        self.loop = None
+        self._thread = None
+
+    def start(self, timeout=60):
+        """Start the event loop thread, the application and register the webhook."""
+        self._start_loop()
+        asyncio.run_coroutine_threadsafe(self._startup(), self.loop).result(timeout)
+        logger.info(f"Webhook set to {self.url}")
+
+    def submit(self, data, timeout=5):
+        """Queue one update received as Telegram JSON."""
+        update = Update.de_json(data, self.application.bot)
+        asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop).result(timeout)
+
+    def stop(self, timeout=60):
+        """Stop processing updates, run the shutdown hook and end the loop thread."""
+        if self.loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+            self.loop = None
+
+    def _start_loop(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='telegram-webhook', daemon=True)
+        self._thread.start()
+
+    async def _startup(self):
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+        await self.application.bot.set_webhook(url=self.url, secret_token=self.secret,
+                                               allowed_updates=Update.ALL_TYPES)
+
+    async def _shutdown(self):
+        if self.application.running:
+            await self.application.stop()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+        await self.application.shutdown()
+
+
+class PollingBot:
+    """Runs run_polling() on its own thread so that another thread can stop it."""
+
+    def __init__(self, application):
+        self.application = application
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='telegram-polling', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=60):
+        """Stop polling; run_polling() runs the shutdown hook before it returns."""
+        if self._thread is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.application.stop_running)
+        except RuntimeError:
+            pass  # run_polling() already returned and closed the loop
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        run_bot(self.application)
+
+
+def run_bot(application=None):
     """Main function to run the bot"""
     
     if not hasattr(keys, 'API_KEY') or not keys.API_KEY:
@@ -176,22 +446,23 @@ def run_bot():
     
     try:
         logger.info("Starting bot...")
-        application = Application.builder().token(keys.API_KEY).build()
+        application = application or build_application()
         logger.info('Bot application built successfully')
 
-        # Add handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("add", add_expense))
-        application.add_handler(CommandHandler("report", report))
-        application.add_handler(CommandHandler("balance", balance))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_error_handler(error)
-
         logger.info(f'Bot ready for chats: {ALLOWED_CHAT_IDS}')
         logger.info('Starting polling...')
         
         # Run polling - this is blocking and manages its own event loop
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        options = {}
+        if threading.current_thread() is not threading.main_thread():
+            # Signal handlers can only be installed from the main thread
+            try:
+                asyncio.get_event_loop_policy().get_event_loop()
+            except RuntimeError:
+                # PollingBot sets up the thread's loop, other callers get a new one
+                asyncio.set_event_loop(asyncio.new_event_loop())
+            options['stop_signals'] = None
+        application.run_polling(allowed_updates=Update.ALL_TYPES, **options)
         
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
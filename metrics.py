@@ -0,0 +1,192 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket bounds, in seconds for latencies and in rows for row counts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, one series per label combination."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self, items):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Ordered collection of metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+SHEETS_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'telebot_sheets_request_seconds', 'Duration of Google Sheets API requests.', ['function']))
+SHEETS_ERRORS = REGISTRY.register(Counter(
+    'telebot_sheets_errors_total', 'Google Sheets API requests that failed.', ['function', 'status']))
+SHEETS_ROWS_READ = REGISTRY.register(Counter(
+    'telebot_sheets_rows_read_total', 'Rows returned by Google Sheets reads.', ['function']))
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'telebot_handler_seconds', 'Duration of Telegram update handlers.', ['handler']))
+UPDATES = REGISTRY.register(Counter(
+    'telebot_updates_total', 'Telegram updates received, by handler.', ['handler']))
+ERRORS = REGISTRY.register(Counter(
+    'telebot_errors_total', 'Errors logged, by logger.', ['logger']))
+REPORT_ROWS_LOADED = REGISTRY.register(Histogram(
+    'telebot_report_rows_loaded', 'Rows read from Google Sheets to build a report.', ['report'],
+    buckets=ROW_BUCKETS))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    'telebot_cache_requests_total', 'Report and balance cache lookups, by result.', ['report', 'result']))
+COALESCED_CALLS = REGISTRY.register(Counter(
+    'telebot_coalesced_calls_total', 'Calls that waited for an identical in-flight load instead of making their own.',
+    ['call']))
+
+# Rows read by Sheets requests made in the current thread, see rows_read()
+_local = threading.local()
+
+
+def count_rows_read(rows):
+    _local.rows = getattr(_local, 'rows', 0) + rows
+
+
+def rows_read():
+    """Rows read from Google Sheets so far by the calling thread."""
+    return getattr(_local, 'rows', 0)
+
+
+def render():
+    return REGISTRY.render()
+
+
+class ErrorCounter(logging.Handler):
+    """Logging handler counting ERROR and CRITICAL records per logger."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        ERRORS.inc(logger=record.name)
+
+
+def install_error_counter(logger=None):
+    """Count errors logged through ``logger`` (the root logger by default), once."""
+    logger = logger or logging.getLogger()
+    if not any(isinstance(handler, ErrorCounter) for handler in logger.handlers):
+        logger.addHandler(ErrorCounter())
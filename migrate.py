@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Copy the spendings of the configured storage backend into another one.
+
+Reads every spending from the current STORAGE_BACKEND (Google Sheets by
+default) and writes it to a new local 'ledger' or 'sqlite' store. Set
+STORAGE_BACKEND in Utils/constants.py to the new backend afterwards; Google
+Sheets then becomes its mirror.
+"""
+
+import argparse
+import logging
+import sys
+
+import spendings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('target', choices=spendings.STORAGE_BACKENDS[1:], help='backend to copy the spendings to')
+    parser.add_argument('--file', help='file of the new store (default: LEDGER_FILE or SQLITE_FILE)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        count = spendings.migrate(args.target, args.file)
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        sys.exit(1)
+    finally:
+        spendings.stop_journal()
+        spendings.close_store()
+    print(f"✅ Copied {count} spendings from {spendings.STORAGE_BACKEND} to {args.target}. "
+          f"Set STORAGE_BACKEND = '{args.target}' in Utils/constants.py to use it.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
+import atexit
 import logging
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
 import spendings
 
 logger = logging.getLogger(__name__)
@@ -8,51 +12,229 @@ categories = ['🛒 Продукты', '👶 Дети', '🚇 Транспорт
               '🎁 Подарки', '👕 Шоппинг', '🐈‍⬛ Котики', '🏡 Ремонт',
               '🌐 Сервисы', '📚 Образование', '✈️ Путешествия', '🌎 Прочее']
 
-pending_expenses = []  # List of tuples: (expense_text, row_number)
+# Per-chat conversation state (pending expenses and buffered categories)
+CATEGORY_FLUSH_DELAY = 60  # seconds of inactivity before buffered categories are written
+CHAT_STATE_TTL = 3600  # seconds of inactivity before a chat's state is dropped
+MAX_CHAT_STATES = 1000  # least recently used chats are evicted beyond this
+DEFAULT_CHAT_ID = 0  # used when the caller does not know the chat
 
+PendingExpense = namedtuple('PendingExpense', ['text', 'row_number'])
+CategoryAssignment = namedtuple('CategoryAssignment', ['row_number', 'category'])
 
-def process_multiple_expenses(expense_lines):
+
+class ChatState:
+    """Expenses waiting for a category and category choices not yet written."""
+
+    __slots__ = ('pending', 'assigned', 'flush_timer', 'touched_at')
+
+    def __init__(self):
+        self.pending = deque()  # PendingExpense records, oldest first
+        self.assigned = []  # CategoryAssignment records
+        self.flush_timer = None
+        self.touched_at = time.monotonic()
+
+
+class ChatStateStore:
+    """Chat states keyed by chat_id with TTL expiry and an LRU size bound.
+
+    Evicted chats get their buffered categories written first, so nothing the
+    user already chose is lost; choices of a live chat that fail to write are
+    put back and retried when the chat is idle again. Idle flushes run on
+    ``executor`` when set, so they reuse its threads' Sheets clients.
+    """
+
+    def __init__(self, ttl=CHAT_STATE_TTL, max_chats=MAX_CHAT_STATES, executor=None):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.executor = executor
+        self._states = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, chat_id):
+        """Return the state for ``chat_id``, creating it if needed."""
+        evicted = []
+        with self._lock:
+            deadline = time.monotonic() - self.ttl
+            while self._states:
+                oldest_id, oldest = next(iter(self._states.items()))
+                if oldest.touched_at > deadline or oldest_id == chat_id:
+                    break
+                evicted.extend(self._drop(oldest_id))
+
+            state = self._states.get(chat_id)
+            if state is None:
+                state = self._states[chat_id] = ChatState()
+            self._states.move_to_end(chat_id)
+            state.touched_at = time.monotonic()
+
+            while len(self._states) > self.max_chats:
+                evicted.extend(self._drop(next(iter(self._states))))
+
+        _write_dropped(evicted)
+        return state
+
+    def chat_ids(self):
+        with self._lock:
+            return list(self._states)
+
+    def buffer_category(self, chat_id, assignment, on_idle):
+        """Queue ``assignment`` and (re)start the chat's idle timer running ``on_idle``."""
+        state = self.get(chat_id)
+        with self._lock:
+            state.assigned.append(assignment)
+            self._restart_timer(state, chat_id, on_idle)
+
+    def restore_assigned(self, chat_id, assignments, on_idle):
+        """Put back category choices that failed to write, ahead of newer ones, and retry when idle.
+
+        Returns False when the chat was dropped meanwhile and they are lost.
+        """
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is None:
+                return False
+            state.assigned[:0] = assignments
+            self._restart_timer(state, chat_id, on_idle)
+            return True
+
+    def pop_assigned(self, chat_id):
+        """Take the buffered category choices of ``chat_id`` and stop its timer."""
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is None:
+                return []
+            if state.flush_timer is not None:
+                state.flush_timer.cancel()
+                state.flush_timer = None
+            assigned, state.assigned = state.assigned, []
+            return assigned
+
+    def _restart_timer(self, state, chat_id, on_idle):
+        if state.flush_timer is not None:
+            state.flush_timer.cancel()
+        state.flush_timer = threading.Timer(CATEGORY_FLUSH_DELAY, self._run_idle, args=(on_idle, chat_id))
+        state.flush_timer.daemon = True
+        state.flush_timer.start()
+
+    def _run_idle(self, on_idle, chat_id):
+        if self.executor is not None:
+            try:
+                self.executor.submit(on_idle, chat_id)
+                return
+            except RuntimeError:
+                pass  # the executor is shut down, flush from the timer thread
+        on_idle(chat_id)
+
+    def forget(self, row_number):
+        """Drop the pending expense and buffered category of a deleted spending, in every chat."""
+        with self._lock:
+            for state in self._states.values():
+                pending = [expense for expense in state.pending if expense.row_number != row_number]
+                if len(pending) != len(state.pending):
+                    state.pending.clear()
+                    state.pending.extend(pending)
+                state.assigned = [assignment for assignment in state.assigned
+                                  if assignment.row_number != row_number]
+
+    def clear(self):
+        """Drop every chat, writing their buffered categories."""
+        evicted = []
+        with self._lock:
+            for chat_id in list(self._states):
+                evicted.extend(self._drop(chat_id))
+        _write_dropped(evicted)
+
+    def _drop(self, chat_id):
+        assigned = self.pop_assigned(chat_id)
+        del self._states[chat_id]
+        logger.debug(f"Dropped conversation state for chat {chat_id}")
+        return assigned
+
+
+chat_states = ChatStateStore()
+
+
+def _write_categories(assignments):
+    if not assignments:
+        return None
+    try:
+        return spendings.update_spending_categories(assignments)
+    except Exception as e:
+        logger.error(f"Error flushing buffered categories: {e}", exc_info=True)
+        return f"Error updating categories: {e}"
+
+
+def _categories_written(result):
+    return result is None or result.startswith("Categories updated")
+
+
+def _log_uncategorized(assignments, result):
+    rows = ', '.join(str(assignment.row_number) for assignment in assignments)
+    logger.error(f"Spendings in rows {rows} were left uncategorized: {result}")
+
+
+def _write_dropped(assignments):
+    """Write the categories of dropped chats, which have no state left to retry from."""
+    result = _write_categories(assignments)
+    if not _categories_written(result):
+        _log_uncategorized(assignments, result)
+
+
+def flush_pending_categories(chat_id=None):
+    """Write buffered category choices to Google Sheets in one batch.
+
+    Flushes a single chat when ``chat_id`` is given, otherwise every chat.
+    When the write fails the choices go back to their chats for a retry.
+    """
+    chat_ids = [chat_id] if chat_id is not None else chat_states.chat_ids()
+    taken = [(current_id, chat_states.pop_assigned(current_id)) for current_id in chat_ids]
+    result = _write_categories([assignment for _, assigned in taken for assignment in assigned])
+    if not _categories_written(result):
+        for current_id, assigned in taken:
+            if assigned and not chat_states.restore_assigned(current_id, assigned, flush_pending_categories):
+                _log_uncategorized(assigned, result)
+    return result
+
+
+atexit.register(flush_pending_categories)
+
+
+def process_multiple_expenses(expense_lines, chat_id=DEFAULT_CHAT_ID):
     """Process multiple expense lines, save them, and queue for category assignment."""
-    global pending_expenses
     results = []
     total_amount = 0.0
     successful_count = 0
     
-    # Clear any previous pending expenses
+    # Clear any previous pending expenses, keeping categories already chosen for them
+    pending_expenses = chat_states.get(chat_id).pending
     pending_expenses.clear()
+    flush_pending_categories(chat_id)
     
-    for line in expense_lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        try:
-            result = spendings.save_spending(line)
-            # Handle both tuple and string returns for backward compatibility
-            if isinstance(result, tuple):
-                msg, row_number = result
-            else:
-                msg = result
-                row_number = None
-            
-            if "saved" in msg.lower() and row_number is not None:
-                successful_count += 1
-                # Extract amount from the line for total calculation
-                parts = line.split()
-                if parts:
-                    try:
-                        amount = float(parts[0])
-                        total_amount += amount
-                        # Add to pending expenses for category assignment with row number
-                        pending_expenses.append((line, row_number))
-                    except ValueError:
-                        pass
-                results.append(f"✅ {line}: {msg}")
-            else:
-                results.append(f"❌ {line}: {msg}")
-        except Exception as e:
-            logger.error(f"Error processing line in process_multiple_expenses: {line} - {e}", exc_info=True)
-            results.append(f"❌ {line}: Error - {str(e)}")
+    lines = [line.strip() for line in expense_lines if line.strip()]
+    
+    try:
+        # All valid lines go to Google Sheets in a single append
+        saved = spendings.save_spendings(lines)
+    except Exception as e:
+        logger.error(f"Error saving lines in process_multiple_expenses: {e}", exc_info=True)
+        saved = [(line, f"Error - {str(e)}", None) for line in lines]
+    
+    for line, msg, row_number in saved:
+        if "saved" in msg.lower() and row_number is not None:
+            successful_count += 1
+            # Extract amount from the line for total calculation
+            parts = line.split()
+            if parts:
+                try:
+                    amount = float(parts[0])
+                    total_amount += amount
+                    # Add to pending expenses for category assignment with row number
+                    pending_expenses.append(PendingExpense(line, row_number))
+                except ValueError:
+                    pass
+            results.append(f"✅ {line}: {msg}")
+        else:
+            results.append(f"❌ {line}: {msg}")
     
     summary = f"📊 Processed {successful_count}/{len([l for l in expense_lines if l.strip()])} expenses"
     if total_amount > 0:
@@ -60,18 +242,17 @@ def process_multiple_expenses(expense_lines):
     
     # If we have pending expenses, start category assignment
     if pending_expenses:
-        summary += f"\n\n🎯 Now let's assign categories. First expense: '{pending_expenses[0][0]}'\nPlease select a category:"
+        summary += f"\n\n🎯 Now let's assign categories. First expense: '{pending_expenses[0].text}'\nPlease select a category:"
     
     return summary + "\n\n" + "\n".join(results)
 
 
-def sample_responses(user_message):
+def sample_responses(user_message, chat_id=DEFAULT_CHAT_ID):
     """
     Process user message and return appropriate response.
     Handles spending tracking, reports, and AI queries.
+    Conversation state (pending expenses) is kept per ``chat_id``.
     """
-    global pending_expenses
-    
     try:
         if not user_message or not isinstance(user_message, str):
             logger.warning("Invalid user message received")
@@ -84,23 +265,26 @@ def sample_responses(user_message):
         # Check for multi-row expenses (multiple lines, each starting with digit)
         lines = [line.strip() for line in user_message.split('\n') if line.strip()]
         if len(lines) > 1 and all(line[0].isdigit() for line in lines):
-            return process_multiple_expenses(lines)
+            return process_multiple_expenses(lines, chat_id)
 
         # Handle category selection for pending expenses
+        pending_expenses = chat_states.get(chat_id).pending
         if pending_expenses and user_message in categories:
-            # Get the first pending expense (expense_text, row_number)
-            expense_text, row_number = pending_expenses[0]
-            # Assign category to the specific row
-            result = spendings.update_spending_category(user_message, row_number)
-            # Remove the processed expense from pending list
-            pending_expenses.pop(0)
+            # Get the first pending expense
+            expense_text, row_number = pending_expenses.popleft()
+            # Buffer the category for the specific row, written with the rest of the batch
+            chat_states.buffer_category(chat_id, CategoryAssignment(row_number, user_message), flush_pending_categories)
             
             if pending_expenses:
                 # More expenses to categorize
-                next_expense_text, _ = pending_expenses[0]
+                next_expense_text = pending_expenses[0].text
                 return f"✅ Category '{user_message}' assigned to '{expense_text}'\n\n🎯 Next expense: '{next_expense_text}'\nPlease select a category:"
             else:
-                # All expenses categorized
+                # All expenses categorized, write the whole batch now
+                result = flush_pending_categories(chat_id)
+                if not _categories_written(result):
+                    return (f"❌ {result}\n\n⏳ The chosen categories are kept and will be written again "
+                            f"in {CATEGORY_FLUSH_DELAY} seconds.")
                 return f"✅ Category '{user_message}' assigned to '{expense_text}'\n\n🎉 All expenses have been categorized!"
 
         # Check for spending input (starts with digit)
@@ -118,7 +302,8 @@ def sample_responses(user_message):
         # Check for cancel command
         if user_message == "❌ Отмена":
             try:
-                return spendings.delete_last_spending()
+                # The deleted expense must not be categorized afterwards
+                return spendings.delete_last_spending(on_deleted=chat_states.forget)
             except Exception as e:
                 logger.error(f"Error deleting spending: {e}")
                 return "Error canceling last spending."
@@ -126,6 +311,8 @@ def sample_responses(user_message):
         # Check for category selection
         if user_message in categories:
             try:
+                # Choices buffered earlier may be for the same row, write them first so this one wins
+                flush_pending_categories(chat_id)
                 return spendings.update_last_spending_category(user_message)
             except Exception as e:
                 logger.error(f"Error updating category: {e}")
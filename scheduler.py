@@ -0,0 +1,137 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger(__name__)
+
+# Google Sheets API quotas per user (the service account), requests per minute
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+BURST = 10  # requests that may go out back to back before the steady rate applies
+
+# Retries of rate-limited and failed requests
+MAX_RETRIES = 5
+BACKOFF_BASE = 1  # seconds before the first retry, doubled for every further one
+MAX_BACKOFF = 32  # seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Request priorities, lower goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """Token bucket handing out tokens to interactive callers before background ones.
+
+    Holds up to ``capacity`` tokens and gains ``rate`` tokens per second.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._waiting = [0, 0]  # callers waiting per priority
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=INTERACTIVE):
+        """Take one token, waiting as long as needed; returns the seconds waited."""
+        started = self.clock()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    ahead = any(self._waiting[:priority])
+                    if self._tokens >= 1 and not ahead:
+                        self._tokens -= 1
+                        return self.clock() - started
+                    # Sleep until the next token, or until a caller ahead has taken it
+                    self._condition.wait(None if self._tokens >= 1 else (1 - self._tokens) / self.rate)
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class SheetsScheduler:
+    """Single gate for Google Sheets requests.
+
+    Reads and writes draw from separate token buckets sized to the per-minute
+    quotas (None disables a bucket); rate limited and server errors are retried
+    with exponential backoff and jitter. Requests made inside ``background()``
+    yield to interactive ones while tokens are short.
+    """
+
+    def __init__(self, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE,
+                 burst=BURST, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 max_backoff=MAX_BACKOFF, clock=time.monotonic, sleep=time.sleep):
+        self.reads = self._bucket(reads_per_minute, burst, clock)
+        self.writes = self._bucket(writes_per_minute, burst, clock)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self._local = threading.local()
+
+    @staticmethod
+    def _bucket(per_minute, burst, clock):
+        if per_minute is None:
+            return None
+        # Burst plus a minute of refills stays within the quota
+        burst = min(burst, per_minute)
+        return TokenBucket(max(per_minute - burst, 1) / 60, burst, clock)
+
+    @property
+    def priority(self):
+        return getattr(self._local, 'priority', INTERACTIVE)
+
+    @contextmanager
+    def background(self):
+        """Run the requests of the ``with`` block at background priority."""
+        previous = self.priority
+        self._local.priority = BACKGROUND
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def run(self, call, write=False, idempotent=True, label=''):
+        """Run ``call`` (one Sheets request) within quota, retrying when worthwhile.
+
+        Requests that are not ``idempotent`` (appends) are only retried on 429,
+        where the API guarantees nothing was written.
+        """
+        bucket = self.writes if write else self.reads
+        attempt = 0
+        while True:
+            if bucket is not None:
+                waited = bucket.acquire(self.priority)
+                if waited > 0.1:
+                    logger.info(f"Waited {waited:.1f}s for Sheets quota ({label})")
+            try:
+                return call()
+            except HttpError as e:
+                status = e.resp.status
+                retryable = status == 429 or (idempotent and status in RETRY_STATUSES)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._delay(attempt, e)
+            attempt += 1
+            logger.warning(f"Sheets request {label} failed with {status}, retry {attempt} in {delay:.1f}s")
+            self.sleep(delay)
+
+    def _delay(self, attempt, error):
+        retry_after = error.resp.get('retry-after') if hasattr(error.resp, 'get') else None
+        if retry_after and str(retry_after).isdigit():
+            return min(self.max_backoff, int(retry_after))
+        return min(self.max_backoff, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
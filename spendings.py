@@ -1,15 +1,23 @@
+import functools
+import json
 import logging
 from datetime import datetime, timedelta
 import os
+import re
 import socket
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager, nullcontext
 from urllib3.util.timeout import Timeout
 
-import pandas as pd
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 from Utils import constants
+import metrics
+from journal import JournalRef, SpendingJournal
+from scheduler import SheetsScheduler
+from storage import SpendingStore, sheet_row
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +37,70 @@ CURRENCY = '€'
 # API timeout settings
 API_TIMEOUT = 20  # seconds
 
+# Discovery document used to build Sheets clients when googleapiclient has no bundled copy
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE_FILE = getattr(constants, 'DISCOVERY_CACHE_FILE', 'sheets_v4_discovery.json')
+
+# Full reload interval for the in-memory replica, catches manual edits in old rows
+REPLICA_FULL_REFRESH_SECONDS = getattr(constants, 'REPLICA_FULL_REFRESH_SECONDS', 3600)
+
+SPENDING_COLUMNS = ['year', 'month', 'date', 'sum', 'comment', 'category']
+
+# Read unformatted cell values (numbers, serial-number dates) instead of display strings
+RAW_VALUE_READS = getattr(constants, 'RAW_VALUE_READS', True)
+SHEETS_EPOCH = datetime(1899, 12, 30)  # day 0 of Sheets serial-number dates
+
+# Short-window reports on a cold replica read only the tail of the sheet, widening as needed
+TAIL_READ_ROWS = getattr(constants, 'TAIL_READ_ROWS', 100)
+
+# Report cache: finished report texts are reused until a write touches their period
+REPORT_CACHE_TTL = getattr(constants, 'REPORT_CACHE_TTL', 300)  # seconds
+REPORT_CACHE_SIZE = getattr(constants, 'REPORT_CACHE_SIZE', 64)
+BALANCE_REPORT = 'balance'
+YEARS_REPORT = '📊 Годы'
+YEAR_REPORT_PATTERN = re.compile(r'^📊 Год (\d{4})$')  # a given year, e.g. "📊 Год 2024"
+REPORT_LABELS = {'📊 День': 'day', '📊 Неделя': 'week', '📊 Месяц': 'month', '📊 Год': 'year',
+                 YEARS_REPORT: 'years'}  # for /metrics
+
+# Closed years are moved out of the Spendings sheet into '<SHEET_NAME> <year>' sheets; their
+# totals per (year, month, category) are kept in ARCHIVE_SHEET so reports need not read them
+ARCHIVE_SHEET = getattr(constants, 'ARCHIVE_SHEET', 'Archive')
+ARCHIVE_COLUMNS = ['year', 'month', 'category', 'sum']
+
+# Balance: the Pivot cell is only re-read every BALANCE_REFRESH_SECONDS, spendings since then are
+# applied locally. With OPENING_BALANCE (cash before the first spending) Pivot is never read.
+BALANCE_RANGE = 'Pivot!D2:D2'
+BALANCE_REFRESH_SECONDS = getattr(constants, 'BALANCE_REFRESH_SECONDS', 3600)
+OPENING_BALANCE = getattr(constants, 'OPENING_BALANCE', None)
+INVEST_BALANCE = getattr(constants, 'INVEST_BALANCE', None)
+
+# Parts of a combined "cash: €1 234,56 invest: €500" balance cell
+CASH_PATTERN = re.compile(r"cash\s*:\s*(€)?\s*([\d\s.,]+)", re.IGNORECASE)
+INVEST_PATTERN = re.compile(r"invest\s*:\s*(€)?\s*([\d\s.,]+)", re.IGNORECASE)
+INVEST_LABEL = re.compile(r"invest\s*:\s*", re.IGNORECASE)
+CASH_LABEL = re.compile(r"\bcash\s*:\s*", re.IGNORECASE)
+DECIMAL_COMMA = re.compile(r",\d{1,2}$")
+WHITESPACE = re.compile(r"\s")
+
+# Number of saved rows "❌ Отмена" can step back through
+UNDO_DEPTH = getattr(constants, 'UNDO_DEPTH', 20)
+
+# Sheets API quotas per minute for the service account (None disables throttling)
+SHEETS_READS_PER_MINUTE = getattr(constants, 'SHEETS_READS_PER_MINUTE', 60)
+SHEETS_WRITES_PER_MINUTE = getattr(constants, 'SHEETS_WRITES_PER_MINUTE', 60)
+
+# Write-behind mode: saves are acknowledged once journaled locally and sent in the background
+WRITE_BEHIND = getattr(constants, 'WRITE_BEHIND', False)
+JOURNAL_FILE = getattr(constants, 'JOURNAL_FILE', 'spendings_journal.db')
+
+# Primary store of spendings: 'sheets', or a local 'ledger' or 'sqlite' store. Reports are
+# computed from a local store and Google Sheets is kept as a mirror through the write-behind
+# journal. Setting LEDGER_FILE alone still selects the ledger.
+LEDGER_FILE = getattr(constants, 'LEDGER_FILE', None) or 'spendings.ledger'
+SQLITE_FILE = getattr(constants, 'SQLITE_FILE', 'spendings.db')
+STORAGE_BACKEND = getattr(constants, 'STORAGE_BACKEND', 'ledger' if getattr(constants, 'LEDGER_FILE', None) else 'sheets')
+STORAGE_BACKENDS = ('sheets', 'ledger', 'sqlite')
+
 day_abbreviations = {
     'Monday': 'пн',
     'Tuesday': 'вт',
@@ -39,30 +111,85 @@ day_abbreviations = {
     'Sunday': 'вс'
 }
 
-# Global service object (lazy initialization)
-_service = None
+# Abbreviations by weekday number (Monday is 0), as in Series.dt.dayofweek
+weekday_abbreviations = dict(enumerate(
+    day_abbreviations[day] for day in
+    ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+))
+
+# Sheets clients: one per thread (httplib2 connections are not thread-safe), sharing one credential
+_credentials = None
+_credentials_lock = threading.Lock()
+_clients = threading.local()
+_discovery = None
+_discovery_lock = threading.Lock()
+
+
+def _get_credentials():
+    """Load the service account credentials once for all threads."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            from google.oauth2.service_account import Credentials
+            if not os.path.exists(CREDENTIALS_FILE):
+                raise FileNotFoundError(f"Credentials file not found: {CREDENTIALS_FILE}")
+            _credentials = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+        return _credentials
+
+
+def _discovery_document():
+    """Sheets v4 discovery document, without a network round trip when possible.
+
+    Uses the copy bundled with googleapiclient, then the one cached in
+    DISCOVERY_CACHE_FILE, and only fetches it (and caches it) as a last resort.
+    """
+    global _discovery
+    with _discovery_lock:
+        if _discovery is not None:
+            return _discovery
+        from googleapiclient import discovery_cache
+        get_static_doc = getattr(discovery_cache, 'get_static_doc', None)  # googleapiclient 2.x
+        document = get_static_doc('sheets', 'v4') if get_static_doc else None
+        if document is None and os.path.exists(DISCOVERY_CACHE_FILE):
+            with open(DISCOVERY_CACHE_FILE, encoding='utf-8') as f:
+                document = f.read()
+        if document is None:
+            import httplib2
+            logger.info("Fetching the Google Sheets discovery document...")
+            response, document = httplib2.Http(timeout=API_TIMEOUT).request(DISCOVERY_URL)
+            if response.status != 200:
+                raise Exception(f"Failed to fetch the Google Sheets discovery document: HTTP {response.status}")
+            document = document.decode('utf-8')
+            with open(DISCOVERY_CACHE_FILE, 'w', encoding='utf-8') as f:
+                f.write(document)
+        _discovery = json.loads(document)
+        return _discovery
 
 
 def get_sheet_service():
-    """Get or create Google Sheets service with error handling."""
-    global _service
-    if _service is not None:
-        return _service
+    """Get or create the calling thread's Google Sheets service with error handling.
+
+    Each thread keeps its own authorized client, so its HTTP connections stay
+    open between requests and are never shared with another thread.
+    """
+    service = getattr(_clients, 'service', None)
+    if service is not None:
+        return service
     
     try:
         if not SPREADSHEET_ID:
             raise ValueError("SPREADSHEET_ID not found in constants")
         
-        if not os.path.exists(CREDENTIALS_FILE):
-            raise FileNotFoundError(f"Credentials file not found: {CREDENTIALS_FILE}")
-        
-        logger.info("Initializing Google Sheets service...")
-        credentials = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        # Create service with timeout
-        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
-        _service = service.spreadsheets()
+        logger.info(f"Initializing Google Sheets service for thread {threading.current_thread().name}...")
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build_from_document
+        # Keep-alive connections with a timeout, authorized with the shared credential
+        http = AuthorizedHttp(_get_credentials(), http=httplib2.Http(timeout=API_TIMEOUT))
+        service = build_from_document(_discovery_document(), http=http)
+        _clients.service = service.spreadsheets()
         logger.info("Google Sheets service initialized successfully")
-        return _service
+        return _clients.service
         
     except Exception as e:
         logger.error(f"Failed to initialize Google Sheets service: {e}")
@@ -92,95 +219,1349 @@ def get_current_date():
         }
 
 
-def load_data_from_google_sheets():
-    """Load data from Google Sheets and return as DataFrame with error handling and timeout."""
+class ReportCache:
+    """LRU cache of report texts keyed by (report, date bucket), with a TTL.
+
+    Buckets are the day for 📊 День, the last day of the window for 📊 Неделя,
+    (year, month) for 📊 Месяц and the year for 📊 Год. A change to a row dated
+    ``day`` drops only the entries whose period contains that day.
+
+    Every write bumps ``generation`` through record_write(); a report built
+    while it changed may miss that write and is not stored.
+    """
+
+    def __init__(self, max_entries=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()  # (report, bucket) -> (stored_at, text)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(report, day):
+        if report == '📊 Месяц':
+            return day.year, day.month
+        if report == '📊 Год':
+            return day.year
+        return day
+
+    def get(self, report, day):
+        key = (report, self.bucket(report, day))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, text = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def put(self, report, day, text, generation=None):
+        """Store ``text``, unless something was invalidated since ``generation`` was read."""
+        key = (report, self.bucket(report, day))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._entries[key] = (time.monotonic(), text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, day=None):
+        """Drop entries covering ``day`` (a date), or everything when it is None."""
+        with self._lock:
+            if day is None:
+                self._entries.clear()
+                return
+            stale = [key for key in self._entries if self._covers(key, day)]
+            for key in stale:
+                del self._entries[key]
+
+    def record_write(self, day=None):
+        """A spending dated ``day`` (None: unknown) was written; reports built meanwhile are not stored."""
+        with self._lock:
+            self.generation += 1
+        self.invalidate(day)
+
+    def clear(self):
+        self.invalidate()
+
+    @staticmethod
+    def _covers(key, day):
+        report, bucket = key
+        if report == '📊 День':
+            return bucket == day
+        if report == '📊 Неделя':
+            return day <= bucket <= day + timedelta(days=6)
+        if report == '📊 Месяц':
+            return bucket == (day.year, day.month)
+        if report == '📊 Год':
+            return bucket == day.year
+        # The balance depends on every row
+        return True
+
+
+_report_cache = ReportCache()
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one in-flight call."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func, *args, label=None):
+        """Return ``func(*args)``, or the result of the identical call already running.
+
+        ``label`` names the call in metrics instead of ``key``.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            metrics.COALESCED_CALLS.inc(call=label or key)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+_inflight = SingleFlight()
+
+
+def _execute(request, function, write=False, idempotent=True):
+    """Execute a Sheets API request through the scheduler.
+
+    Every attempt is recorded for /metrics under ``function``. Writes draw
+    from the write quota; appends are not ``idempotent``.
+    """
+    def attempt():
+        try:
+            with metrics.SHEETS_REQUEST_SECONDS.time(function=function):
+                return request.execute()
+        except HttpError as e:
+            metrics.SHEETS_ERRORS.inc(function=function, status=e.resp.status)
+            raise
+        except socket.timeout:
+            metrics.SHEETS_ERRORS.inc(function=function, status='timeout')
+            raise
+        except Exception:
+            metrics.SHEETS_ERRORS.inc(function=function, status='error')
+            raise
+
+    result = _scheduler.run(attempt, write=write, idempotent=idempotent, label=function)
+    rows = len(result.get('values', [])) if isinstance(result, dict) else 0
+    if rows:
+        metrics.SHEETS_ROWS_READ.inc(rows, function=function)
+        metrics.count_rows_read(rows)
+    return result
+
+
+_scheduler = SheetsScheduler(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE)
+
+
+def _in_background(func):
+    """Wrap ``func`` so its Sheets requests yield to interactive ones."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _scheduler.background():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _read_values(service, range_name, function):
+    """values().get for ``range_name`` in the configured render mode."""
+    options = {}
+    if RAW_VALUE_READS:
+        options = {'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'}
+    return _execute(service.values().get(spreadsheetId=SPREADSHEET_ID, range=range_name, **options), function)
+
+
+def _cell_datetime(value):
+    """Datetime of a date cell, either a serial number or a '%Y-%m-%d %H:%M:%S' string."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return SHEETS_EPOCH + timedelta(seconds=round(value * 86400))
     try:
-        logger.debug("Starting load_data_from_google_sheets")
-        service = get_sheet_service()
-        logger.debug("Got sheet service, executing query...")
-        
-        # Execute with timeout handling
-        result = service.values().get(
-            spreadsheetId=SPREADSHEET_ID, 
-            range=RANGE_NAME
-        ).execute()
-        
+        return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _cell_cents(value):
+    """Amount of a sum cell in integer cents, or None."""
+    try:
+        return round(float(value) * 100)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row_day(row):
+    """Date of a sheet row, or None when it cannot be read."""
+    moment = _cell_datetime(row[2]) if len(row) > 2 else None
+    return moment.date() if moment else None
+
+
+def _row_year(row):
+    """Year of a sheet row from its date or year cell, or None."""
+    day = _row_day(row)
+    if day is not None:
+        return day.year
+    try:
+        return int(row[0])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _row_key(row):
+    """Identity of a sheet row for matching: timestamp, amount and comment."""
+    moment = _cell_datetime(row[2]) if len(row) > 2 else None
+    cents = _cell_cents(row[3]) if len(row) > 3 else None
+    comment = str(row[4]) if len(row) > 4 else ''
+    return moment, cents, comment
+
+
+class SpendingRollup:
+    """Running totals per (year, month, category) and per day.
+
+    Amounts are kept in integer cents so adding and removing rows never
+    accumulates float error. Rows are in sheet column order (year, month,
+    date, sum, comment, category); rows that do not parse are ignored.
+    Uncategorized rows (empty or missing category cell) are kept under the
+    category None and left out of the category and year totals.
+    """
+
+    def __init__(self):
+        self.month_totals = defaultdict(int)  # (year, month, category or None) -> cents
+        self.day_totals = defaultdict(int)  # date -> cents
+        self.total_cents = 0  # every row with an amount, dated or not
+
+    def clear(self):
+        self.month_totals.clear()
+        self.day_totals.clear()
+        self.total_cents = 0
+
+    def add(self, row, sign=1):
+        key = self._parse(row)
+        if key is None:
+            return
+        year, month, day, category, cents = key
+        self.total_cents += sign * cents
+        self._bump(self.month_totals, (year, month, category), sign * cents)
+        if day is not None:
+            self._bump(self.day_totals, day, sign * cents)
+
+    def remove(self, row):
+        self.add(row, sign=-1)
+
+    def categories_for(self, year, month=None):
+        """Totals per category as [(category, amount)] sorted by category."""
+        totals = defaultdict(int)
+        for (row_year, row_month, category), cents in self.month_totals.items():
+            if row_year == year and (month is None or row_month == month) and category is not None:
+                totals[category] += cents
+        return [(category, totals[category] / 100) for category in sorted(totals)]
+
+    def year_totals(self):
+        """Totals per year as [(year, amount)] sorted by year."""
+        totals = defaultdict(int)
+        for (year, _, category), cents in self.month_totals.items():
+            if category is not None:
+                totals[year] += cents
+        return [(year, totals[year] / 100) for year in sorted(totals)]
+
+    def total_for_days(self, start, end):
+        """Total amount spent between ``start`` and ``end`` (dates, inclusive)."""
+        return sum(cents for day, cents in self.day_totals.items() if start <= day <= end) / 100
+
+    @staticmethod
+    def _bump(totals, key, cents):
+        totals[key] += cents
+        if totals[key] == 0:
+            del totals[key]
+
+    @staticmethod
+    def _parse(row):
+        cents = _cell_cents(row[3]) if len(row) > 3 else None
+        if cents is None:
+            return None
+        day = _row_day(row)
+        if day is not None:
+            year, month = day.year, day.month
+        else:
+            try:
+                year = int(row[0])
+                month = int(str(row[1]).split()[0])
+            except (TypeError, ValueError, IndexError):
+                return None
+        # Uncategorized rows are left out of category totals, like groupby('category') does;
+        # a saved row's '' and the missing cell of a reloaded one are the same thing
+        category = row[5] if len(row) > 5 and row[5] not in ('', None) else None
+        return year, month, day, category, cents
+
+
+def _parse_dates(column):
+    """Parse serial-number dates (raw reads) and '%Y-%m-%d %H:%M:%S' strings."""
+    import pandas as pd
+    serials = pd.to_numeric(column, errors='coerce')
+    dates = pd.to_datetime(serials, unit='D', origin=pd.Timestamp(SHEETS_EPOCH)).dt.round('s')
+    if serials.isna().any():
+        texts = column[serials.isna()]
+        dates[serials.isna()] = pd.to_datetime(texts, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    return dates
+
+
+def normalize_spendings(df):
+    """Parse sheet columns once into compact dtypes.
+
+    ``date`` becomes datetime64, ``year`` and ``month`` small integers taken
+    from the date (falling back to the year/month cells), ``sum`` float64 and
+    ``category`` categorical. Frames that are already typed are returned as is.
+    """
+    import pandas as pd
+    if (pd.api.types.is_datetime64_any_dtype(df['date']) and
+            pd.api.types.is_float_dtype(df['sum']) and
+            isinstance(df['category'].dtype, pd.CategoricalDtype) and
+            pd.api.types.is_integer_dtype(df.get('month'))):
+        return df
+
+    df = df.copy()
+    if not pd.api.types.is_datetime64_any_dtype(df['date']):
+        df['date'] = _parse_dates(df['date'])
+    df['sum'] = pd.to_numeric(df['sum'], errors='coerce').astype('float64')
+    df['category'] = df['category'].astype('category')
+
+    dated = df['date'].notna()
+    year = df['date'].dt.year.astype('Int16')
+    month = df['date'].dt.month.astype('Int16')
+    if not dated.all():
+        undated = ~dated
+        if 'year' in df.columns:
+            year[undated] = pd.to_numeric(df.loc[undated, 'year'], errors='coerce').astype('Int16')
+        if 'month' in df.columns:
+            month_cells = df.loc[undated, 'month'].astype(str).str.extract(r'^\s*(\d+)', expand=False)
+            month[undated] = pd.to_numeric(month_cells, errors='coerce').astype('Int16')
+    df['year'] = year
+    df['month'] = month
+    return df
+
+
+class SheetReplica:
+    """Process-wide in-memory copy of the Spendings sheet.
+
+    The whole sheet is downloaded once; afterwards only rows appended after the
+    last known row count are fetched. Writes made through this module are
+    applied locally so reports work on a warm copy, and the rollup totals are
+    updated with every row change.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.header = None
+        self.rows = []  # rows[0] is sheet row 2
+        self.rollup = SpendingRollup()
+        self._loaded_at = None
+        self._frame = None
+
+    @property
+    def loaded(self):
+        return self.header is not None
+
+    @property
+    def row_count(self):
+        """Number of sheet rows covered by the replica, header included."""
+        if not self.loaded:
+            return 0
+        return len(self.rows) + 1
+
+    def reset(self):
+        with self._lock:
+            self.header = None
+            self.rows = []
+            self.rollup.clear()
+            self._loaded_at = None
+            self._frame = None
+
+    def sync(self):
+        """Bring the replica up to date with the sheet."""
+        with self._lock:
+            expired = (self._loaded_at is not None and
+                       time.monotonic() - self._loaded_at > REPLICA_FULL_REFRESH_SECONDS)
+            if not self.loaded or expired:
+                self._full_load()
+            else:
+                self._fetch_delta()
+
+    def _full_load(self):
+        result = _read_values(get_sheet_service(), RANGE_NAME, 'load_data')
         values = result.get('values', [])
         logger.info(f"Loaded {len(values)} rows from Google Sheets")
-        
-        if not values:
-            logger.warning("No data found in Google Sheets")
-            return pd.DataFrame(columns=['year', 'month', 'date', 'sum', 'comment', 'category'])
-        
-        logger.debug(f"Creating DataFrame from {len(values)} rows")
-        df = pd.DataFrame(values[1:], columns=values[0])
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
-        logger.info(f"Converted to DataFrame with {len(df)} rows")
+
+        self.header = list(values[0]) if values else []
+        self.rows = []
+        self.rollup.clear()
+        _report_cache.clear()
+        self._extend(values[1:])
+        self._loaded_at = time.monotonic()
+
+    def _fetch_delta(self):
+        start_row = self.row_count + 1
+        result = _read_values(get_sheet_service(), f'{SHEET_NAME}!A{start_row}:Z', 'load_data')
+        new_rows = result.get('values', [])
+        if new_rows:
+            logger.info(f"Fetched {len(new_rows)} new rows from Google Sheets (from row {start_row})")
+            if not self.header:
+                # Sheet was empty on the last load, the first fetched row is the header
+                self.header = list(new_rows[0])
+                new_rows = new_rows[1:]
+            self._extend(new_rows)
+
+    def _extend(self, rows):
+        for row in rows:
+            row = list(row)
+            self.rows.append(row)
+            self.rollup.add(row)
+            self._changed(row)
+        self._trim_trailing_empty_rows()
+        self._frame = None
+
+    def _replace(self, row_number, row):
+        index = row_number - 2
+        self.rollup.remove(self.rows[index])
+        self._changed(self.rows[index])
+        self.rows[index] = row
+        self.rollup.add(row)
+        self._changed(row)
+        self._trim_trailing_empty_rows()
+        self._frame = None
+
+    @staticmethod
+    def _changed(row):
+        if any(row):
+            _report_cache.invalidate(_row_day(row))
+
+    def _trim_trailing_empty_rows(self):
+        # The values API omits trailing empty rows, mirror that so row_count matches the sheet
+        while self.rows and not any(self.rows[-1]):
+            self.rows.pop()
+
+    def frame(self):
+        """Return the replica as a DataFrame (a copy, callers may mutate it)."""
+        import pandas as pd
+        with self._lock:
+            if self._frame is None:
+                if not self.header:
+                    self._frame = pd.DataFrame(columns=SPENDING_COLUMNS)
+                else:
+                    width = len(self.header)
+                    df = pd.DataFrame([row[:width] for row in self.rows], columns=self.header)
+                    if set(SPENDING_COLUMNS) <= set(df.columns):
+                        # Drop cleared rows and parse everything once into typed columns
+                        df = normalize_spendings(df[df[SPENDING_COLUMNS[:4]].notna().any(axis=1)])
+                    self._frame = df
+            return self._frame.copy()
+
+    def row(self, row_number):
+        """The row at sheet row ``row_number``, or None when the replica does not know it."""
+        with self._lock:
+            if not self.loaded or not 1 < row_number <= self.row_count:
+                return None
+            return list(self.rows[row_number - 2])
+
+    def find_rows(self, values):
+        """Row numbers of rows matching ``values`` on all but the category column (None if absent).
+
+        Identical rows are matched by occurrence: the first of two equal
+        ``values`` gets the first matching sheet row, the second the next one.
+        """
+        positions = defaultdict(deque)
+        with self._lock:
+            for index, row in enumerate(self.rows):
+                positions[_row_key(row)].append(index + 2)
+        found = []
+        for row in values:
+            rows = positions.get(_row_key(row))
+            found.append(rows.popleft() if rows else None)
+        return found
+
+    def apply_append(self, row_number, row):
+        """Record a row appended by this process at ``row_number``."""
+        with self._lock:
+            if not self.loaded:
+                _report_cache.invalidate(_row_day(row))
+                return
+            if row_number == self.row_count + 1:
+                self._extend([row])
+            elif 1 < row_number <= self.row_count:
+                self._replace(row_number, list(row))
+            # Otherwise someone else appended in between, the next delta fetch picks both rows up
+
+    def apply_category(self, row_number, category):
+        with self._lock:
+            if not self.loaded or not 1 < row_number <= self.row_count:
+                # The row's date is unknown, so any cached report may be affected
+                _report_cache.invalidate()
+                return
+            row = list(self.rows[row_number - 2])
+            row.extend([''] * (len(SPENDING_COLUMNS) - len(row)))
+            row[SPENDING_COLUMNS.index('category')] = category
+            self._replace(row_number, row)
+
+    def apply_clear(self, row_number):
+        with self._lock:
+            if not self.loaded or not 1 < row_number <= self.row_count:
+                _report_cache.invalidate()
+                return
+            self._replace(row_number, [])
+
+
+_replica = SheetReplica()
+
+
+class RowTracker:
+    """Undo stack of sheet rows written by this process, newest last.
+
+    Seeded from the updatedRange of each append so undo and "last category"
+    know their row without reading the sheet. Also remembers the last row
+    known to hold data, where a tail read of the sheet starts, and the rows
+    undone since, which late category writes must not fill in again.
+    """
+
+    def __init__(self, depth=UNDO_DEPTH):
+        self._rows = deque(maxlen=depth)
+        self._last_row = None
+        self._cleared = set()
+        self._lock = threading.Lock()
+
+    def push(self, row_number):
+        with self._lock:
+            if row_number in self._rows:
+                self._rows.remove(row_number)
+            self._rows.append(row_number)
+            self._last_row = max(self._last_row or 0, row_number)
+            # The next append after an undo reuses the blank row
+            self._cleared.discard(row_number)
+
+    def cleared(self, row_number):
+        """Row ``row_number`` was blanked by an undo."""
+        with self._lock:
+            self._cleared.add(row_number)
+
+    def was_cleared(self, row_number):
+        with self._lock:
+            return row_number in self._cleared
+
+    def saw_row(self, row_number):
+        """Row ``row_number`` was read and holds data."""
+        with self._lock:
+            self._last_row = max(self._last_row or 0, row_number)
+
+    def last_row(self):
+        with self._lock:
+            return self._last_row
+
+    def peek(self):
+        with self._lock:
+            return self._rows[-1] if self._rows else None
+
+    def pop(self):
+        with self._lock:
+            return self._rows.pop() if self._rows else None
+
+    def discard(self, row_number):
+        with self._lock:
+            if row_number in self._rows:
+                self._rows.remove(row_number)
+
+    def reset(self):
+        with self._lock:
+            self._rows.clear()
+            self._last_row = None
+            self._cleared.clear()
+
+
+_row_tracker = RowTracker()
+
+
+class SpendingArchive:
+    """Totals of the closed years moved out of the Spendings sheet.
+
+    Read once per process from the ARCHIVE_SHEET manifest, one row per
+    (year, month, category). Uncategorized spendings have an empty category
+    cell; they count towards the balance but not the category totals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rollup = None
+
+    def reset(self):
+        with self._lock:
+            self._rollup = None
+
+    def load(self):
+        """The archived totals as a SpendingRollup (without day totals)."""
+        with self._lock:
+            if self._rollup is None:
+                try:
+                    result = _read_values(get_sheet_service(), f"'{ARCHIVE_SHEET}'!A2:D", 'archive')
+                except HttpError as e:
+                    # The range of a missing sheet cannot be parsed: nothing archived yet
+                    if e.resp.status != 400:
+                        raise
+                    result = {}
+                self._rollup = self.parse(result.get('values', []))
+            return self._rollup
+
+    def replace(self, rollup):
+        with self._lock:
+            self._rollup = rollup
+
+    @staticmethod
+    def parse(rows):
+        rollup = SpendingRollup()
+        for row in rows:
+            cents = _cell_cents(row[3]) if len(row) > 3 else None
+            try:
+                key = (int(row[0]), int(row[1]), str(row[2]) or None)
+            except (TypeError, ValueError, IndexError):
+                continue
+            if cents:
+                rollup._bump(rollup.month_totals, key, cents)
+                rollup.total_cents += cents
+        return rollup
+
+    @staticmethod
+    def rows(rollup):
+        return [[year, month, category or '', cents / 100]
+                for (year, month, category), cents in sorted(rollup.month_totals.items(),
+                                                             key=lambda item: (item[0][:2], item[0][2] or ''))]
+
+
+_archive = SpendingArchive()
+
+
+def reset_caches():
+    """Drop in-process state derived from the sheet so the next read starts cold."""
+    _replica.reset()
+    _row_tracker.reset()
+    _report_cache.clear()
+    _balance.reset()
+    _archive.reset()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Return the write-behind journal, starting its flusher on first use.
+
+    Returns None when WRITE_BEHIND is off and Google Sheets is the primary store.
+    """
+    global _journal
+    if not WRITE_BEHIND and STORAGE_BACKEND == 'sheets':
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = SpendingJournal(
+                JOURNAL_FILE,
+                flush_rows=_in_background(_send_rows),
+                update_categories=_in_background(_batch_update_categories),
+                find_rows=_in_background(_find_rows),
+                clear_rows=_in_background(_clear_rows),
+                on_flushed=_apply_appended,
+                keep=UNDO_DEPTH
+            )
+            _journal.start()
+            logger.info(f"Write-behind journal started ({_journal.pending_count()} entries waiting)")
+        return _journal
+
+
+def stop_journal():
+    """Flush what is left in the journal and stop its background thread."""
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            _journal.close()
+            _journal = None
+
+
+class SheetsStore(SpendingStore):
+    """The Spendings sheet as the store, read through the replica.
+
+    With the write-behind journal appends are journaled and their refs are
+    JournalRefs, otherwise they are sheet row numbers. Aggregates come from
+    the replica's rollup, loaded once, plus the journaled rows not flushed
+    yet; call sync() to pick up sheet edits.
+    """
+
+    def append(self, rows, refs=None):
+        journal = get_journal()
+        if journal is not None:
+            refs = journal.append_many(rows)
+            logger.info(f"Journaled {len(rows)} spendings (entries {refs[0].entry_id}-{refs[-1].entry_id})")
+            return refs
+        first_row = _append_rows(rows)
+        logger.info(f"Appended {len(rows)} rows to {SHEET_NAME} (rows {first_row}-{first_row + len(rows) - 1})")
+        return list(range(first_row, first_row + len(rows)))
+
+    def set_category(self, category, ref=None):
+        journal = get_journal()
+        if ref is None and journal is not None:
+            ref = journal.last_unsent()
+            if ref is None:
+                _check_nothing_in_flight(journal)
+        if isinstance(ref, JournalRef):
+            ref = journal.set_category(ref, category)
+            if ref is None:
+                # Still in the journal, the category is sent together with the row
+                return True
+
+        sheet = get_sheet_service()
+
+        if ref is None:
+            ref = _row_tracker.peek()
+        if ref is None:
+            # Nothing saved by this process yet, the last row of the (synced) replica it is
+            _replica.sync()
+            if _replica.row_count <= 1:
+                return False
+            ref = _replica.row_count
+
+        # Assuming category is in the 6th column ('F')
+        _execute(sheet.values().update(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f'{SHEET_NAME}!F{ref}',
+            valueInputOption='USER_ENTERED',
+            body={'values': [[category]]}
+        ), 'update_spending_category', write=True)
+        _replica.apply_category(ref, category)
+        return True
+
+    def set_categories(self, assignments):
+        # Rows still in the write-behind journal take their category from there
+        rows = []
+        for ref, category in assignments:
+            if isinstance(ref, JournalRef):
+                try:
+                    ref = get_journal().set_category(ref, category)
+                except KeyError:
+                    ref = None  # undone before it was sent
+            # A row undone since would be left holding nothing but the category
+            if ref is not None and not _row_tracker.was_cleared(ref):
+                rows.append((ref, category))
+        if rows:
+            _batch_update_categories(rows)
+
+    def delete_last(self):
+        # A spending still waiting in the journal is simply dropped
+        journal = get_journal()
+        if journal is not None:
+            ref = journal.last_unsent()
+            if ref is not None and journal.discard(ref):
+                logger.info(f"Deleted journaled spending entry {ref.entry_id}")
+                return ref
+            if ref is None:
+                _check_nothing_in_flight(journal)
+
+        sheet = get_sheet_service()
+
+        # Rows saved by this process are undone newest first without reading the sheet;
+        # once those run out, fall back to the last row of the (synced) replica
+        last_row_index = _row_tracker.pop()
+        if last_row_index is None:
+            _replica.sync()
+            if _replica.row_count <= 1:  # Only header or empty
+                return None
+            last_row_index = _replica.row_count
+
+        # Clear the last row
+        _execute(sheet.values().update(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f'{SHEET_NAME}!A{last_row_index}:F{last_row_index}',
+            valueInputOption='USER_ENTERED',
+            body={'values': [['', '', '', '', '', '']]}  # Clear all columns
+        ), 'delete_last_spending', write=True)
+        _replica.apply_clear(last_row_index)
+        _row_tracker.cleared(last_row_index)
+        logger.info(f"Deleted last spending entry (row {last_row_index})")
+        # Chats hold the refs append() returned: a JournalRef when the row went through the journal
+        return (journal.ref_of_row(last_row_index) if journal is not None else None) or last_row_index
+
+    def query(self, start, end=None):
+        """Without ``end`` the frame may also hold older rows, reports filter by date themselves."""
+        import pandas as pd
+        df = load_data_from_google_sheets(since=start)
+        journal = get_journal()
+        unsent = journal.unflushed_rows() if journal is not None else []
+        if unsent:
+            df = pd.concat([normalize_spendings(df),
+                            normalize_spendings(pd.DataFrame(unsent, columns=SPENDING_COLUMNS))],
+                           ignore_index=True)
+        if end is not None:
+            df = normalize_spendings(df)
+            df = df[df['date'] < pd.Timestamp(end)]
         return df
-        
+
+    def _rollup(self):
+        if not _replica.loaded:
+            _sync_replica()
+        return _replica.rollup
+
+    def _aggregate(self, aggregate):
+        """``aggregate`` of the replica's rollup and of the journaled rows not in it yet."""
+        rollup = self._rollup()
+        journal = get_journal()
+        if journal is None:
+            return [aggregate(rollup)]
+        unsent = SpendingRollup()
+        with journal.holding_flushes():
+            for row in journal.unflushed_rows():
+                unsent.add(row)
+            return [aggregate(rollup), aggregate(unsent)]
+
+    def categories_for(self, year, month=None):
+        return _merge_totals(*self._aggregate(lambda rollup: rollup.categories_for(year, month)))
+
+    def year_totals(self):
+        return _merge_totals(*self._aggregate(lambda rollup: rollup.year_totals()))
+
+    def total_cents(self):
+        return sum(self._aggregate(lambda rollup: rollup.total_cents))
+
+    def sheet_cents(self):
+        """Total of the rows in the sheet itself, journaled ones aside, in cents."""
+        return self._rollup().total_cents
+
+    def __len__(self):
+        self._rollup()
+        journal = get_journal()
+        unsent = len(journal.unflushed_rows()) if journal is not None else 0
+        return max(_replica.row_count - 1, 0) + unsent
+
+    def rows(self):
+        _sync_replica()
+        rows = []
+        skipped = 0
+        for row_number, row in enumerate(_replica.rows, start=2):
+            moment = _cell_datetime(row[2]) if len(row) > 2 else None
+            cents = _cell_cents(row[3]) if len(row) > 3 else None
+            if moment is None or cents is None:
+                skipped += any(row)
+                continue
+            comment = str(row[4]) if len(row) > 4 else ''
+            category = str(row[5]) if len(row) > 5 else ''
+            rows.append((sheet_row(moment, cents, comment, category), row_number))
+        if skipped:
+            logger.warning(f"{skipped} rows of {SHEET_NAME} without a date or amount are not copied")
+        return rows
+
+    def sync(self):
+        _sync_replica()
+
+
+class MirroredStore(SpendingStore):
+    """A local store as the primary copy, with every write mirrored to Google Sheets.
+
+    Writes go to ``sheets`` (journaled, so they cost no request in the
+    foreground) and then to ``local``, which answers every read. Refs are
+    those of ``sheets``; ``local`` keeps them as its integer entries.
+    """
+
+    def __init__(self, local, sheets):
+        self.local = local
+        self.sheets = sheets
+
+    @staticmethod
+    def _entry(ref):
+        """Local entry of a Sheets ref: a JournalRef, a sheet row number or None (the newest)."""
+        if isinstance(ref, JournalRef):
+            return ref.entry_id
+        if ref is not None:
+            return -ref
+        return None
+
+    def append(self, rows, refs=None):
+        refs = self.sheets.append(rows)
+        self.local.append(rows, [self._entry(ref) for ref in refs])
+        return refs
+
+    def set_category(self, category, ref=None):
+        updated = self.sheets.set_category(category, ref)
+        return self.local.set_category(category, self._entry(ref)) or updated
+
+    def set_categories(self, assignments):
+        self.sheets.set_categories(assignments)
+        self.local.set_categories([(self._entry(ref), category) for ref, category in assignments])
+
+    def delete_last(self):
+        newest = self.local.last_ref()
+        if newest is None:
+            return None
+        ref = self.sheets.delete_last()
+        if ref is None:
+            logger.warning(f"Nothing to delete in Google Sheets, kept local spending {newest}")
+            return None
+        if self._entry(ref) != newest:
+            logger.error(f"Google Sheets deleted spending {self._entry(ref)} but the newest local one is {newest}, "
+                         f"the stores differ")
+            return None
+        self.local.delete_last()
+        return ref
+
+    def sheet_rows_deleted(self, first_row, count):
+        self.local.sheet_rows_deleted(first_row, count)
+
+    def query(self, start, end=None):
+        return self.local.query(start, end)
+
+    def categories_for(self, year, month=None):
+        return self.local.categories_for(year, month)
+
+    def year_totals(self):
+        return self.local.year_totals()
+
+    def total_cents(self):
+        return self.local.total_cents()
+
+    def __len__(self):
+        return len(self.local)
+
+    def rows(self):
+        return self.local.rows()
+
+    def close(self):
+        self.local.close()
+
+
+_sheets_store = SheetsStore()
+_store = None
+_store_lock = threading.Lock()
+
+
+def _store_path(backend):
+    return LEDGER_FILE if backend == 'ledger' else SQLITE_FILE
+
+
+def _open_local_store(backend, path):
+    if backend == 'ledger':
+        from ledger import LedgerStore
+        return LedgerStore(path)
+    if backend == 'sqlite':
+        from storage import SQLiteStore
+        return SQLiteStore(path)
+    raise ValueError(f"Unknown local storage backend {backend!r}, expected 'ledger' or 'sqlite'")
+
+
+def _remove_store_files(path):
+    for suffix in ('', '.heap', '.categories', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _copy_spendings(source, target):
+    """Copy every spending of ``source`` into ``target``; returns how many."""
+    rows = source.rows()
+    refs = [ref for _, ref in rows]
+    if isinstance(source, SheetsStore):
+        # Local stores link sheet rows by their negated row number
+        refs = [MirroredStore._entry(ref) for ref in refs]
+    if rows:
+        target.append([row for row, _ in rows], refs)
+    return len(rows)
+
+
+def get_store():
+    """Return the configured store, importing the sheet into a local store when it is created."""
+    global _store
+    if STORAGE_BACKEND == 'sheets':
+        return _sheets_store
+    with _store_lock:
+        if _store is None:
+            path = _store_path(STORAGE_BACKEND)
+            created = not os.path.exists(path)
+            local = _open_local_store(STORAGE_BACKEND, path)
+            if created:
+                try:
+                    count = _copy_spendings(_sheets_store, local)
+                except Exception:
+                    # Start over on the next use rather than keep a partial copy
+                    local.close()
+                    _remove_store_files(path)
+                    raise
+                logger.info(f"Imported {count} spendings from Google Sheets into {path}")
+            _store = MirroredStore(local, _sheets_store)
+            logger.info(f"Storage {STORAGE_BACKEND} ({path}) opened with {len(_store)} spendings")
+        return _store
+
+
+def close_store():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+
+def migrate(target, path=None):
+    """Copy every spending of the configured store into a new ``target`` ('ledger' or 'sqlite') store.
+
+    Returns the number of spendings copied. The new store is written to
+    ``path`` (default: LEDGER_FILE or SQLITE_FILE) and must not exist yet;
+    set STORAGE_BACKEND to ``target`` afterwards to use it.
+    """
+    if target == STORAGE_BACKEND:
+        raise ValueError(f"Spendings are already kept in {target}")
+    if target not in STORAGE_BACKENDS[1:]:
+        raise ValueError(f"Cannot migrate to {target!r}, Google Sheets stays the mirror of 'ledger' and 'sqlite'")
+    path = path or _store_path(target)
+    if os.path.exists(path):
+        raise ValueError(f"{path} already exists, remove it first to migrate again")
+    source = get_store()
+    journal = get_journal()
+    if journal is not None:
+        # Rows still in the journal would be copied without their sheet row numbers
+        journal.flush()
+    store = _open_local_store(target, path)
+    try:
+        count = _copy_spendings(source, store)
+    except Exception:
+        store.close()
+        _remove_store_files(path)
+        raise
+    store.close()
+    logger.info(f"Migrated {count} spendings from {STORAGE_BACKEND} to {target} ({path})")
+    return count
+
+
+def _check_nothing_in_flight(journal):
+    """Refuse to fall back to older rows while undone rows are still being sent."""
+    if journal.pending_count():
+        raise RuntimeError("The previous change is still being sent to Google Sheets, try again in a moment")
+
+
+def _clear_rows(row_numbers):
+    """Blank whole sheet rows (spendings undone while they were being sent)."""
+    _execute(get_sheet_service().values().batchUpdate(
+        spreadsheetId=SPREADSHEET_ID,
+        body={'valueInputOption': 'USER_ENTERED',
+              'data': [{'range': f'{SHEET_NAME}!A{row_number}:F{row_number}', 'values': [[''] * 6]}
+                       for row_number in row_numbers]}
+    ), 'delete_last_spending', write=True)
+    for row_number in row_numbers:
+        _replica.apply_clear(row_number)
+        _row_tracker.discard(row_number)
+        _row_tracker.cleared(row_number)
+    _report_cache.record_write()
+
+
+def _find_rows(values):
+    """Sheet row numbers of ``values`` as currently found in the sheet."""
+    _replica.sync()
+    return _replica.find_rows(values)
+
+
+@contextmanager
+def _readable_api_errors():
+    """Turn timeouts and API failures of a read into readable errors."""
+    try:
+        yield
     except socket.timeout:
         logger.error("Timeout connecting to Google Sheets API")
         raise Exception("Google Sheets API timeout - unable to load data")
     except HttpError as e:
         logger.error(f"Google Sheets API error: {e}")
         raise Exception("Failed to access Google Sheets. Check permissions and spreadsheet ID.")
+
+
+def _sync_replica():
+    """Bring the replica up to date, turning API failures into readable errors."""
+    with _readable_api_errors():
+        # Callers arriving while a sync is running wait for it instead of fetching again
+        _inflight.do('sync_replica', _replica.sync)
+
+
+def _sheet_row_count():
+    """Number of grid rows of the Spendings sheet (an upper bound for the data rows)."""
+    metadata = _execute(get_sheet_service().get(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=[SHEET_NAME],
+        fields='sheets(properties(gridProperties(rowCount)))'
+    ), 'load_data')
+    return metadata['sheets'][0]['properties']['gridProperties']['rowCount']
+
+
+def _sheet_ids(service):
+    """Sheet ids of the spreadsheet by sheet title."""
+    metadata = _execute(service.get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields='sheets(properties(sheetId,title))'
+    ), 'archive')
+    return {sheet['properties']['title']: sheet['properties']['sheetId'] for sheet in metadata.get('sheets', [])}
+
+
+def _add_sheet(service, title, header):
+    _execute(service.batchUpdate(
+        spreadsheetId=SPREADSHEET_ID,
+        body={'requests': [{'addSheet': {'properties': {'title': title}}}]}
+    ), 'archive', write=True)
+    _execute(service.values().update(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"'{title}'!A1",
+        valueInputOption='USER_ENTERED',
+        body={'values': [header]}
+    ), 'archive', write=True)
+
+
+def _load_recent_rows(since):
+    """Read rows from the end of the sheet back to the first one dated before ``since``.
+
+    Rows are chronological, so the read window is doubled until its oldest dated
+    row falls before ``since`` or the header is reached. The first window ends
+    at the last row known to hold data (from an append or an earlier tail read)
+    and is open-ended, so rows added since are read too; the grid size is only
+    asked for when no such row is known.
+    """
+    import pandas as pd
+    service = get_sheet_service()
+    end_row = _row_tracker.last_row() or _sheet_row_count()
+    window = TAIL_READ_ROWS
+    range_end = 'Z'
+    rows = []
+    while True:
+        start_row = max(2, end_row - window + 1)
+        result = _read_values(service, f'{SHEET_NAME}!A{start_row}:{range_end}', 'load_data')
+        values = [list(row) for row in result.get('values', [])]
+        if values and not rows:
+            # The newest window with data: the values API omits trailing empty rows,
+            # so the last one returned is the last row holding data
+            _row_tracker.saw_row(start_row + len(values) - 1)
+        rows = values + rows
+        dated = [_row_day(row) for row in rows if any(row)]
+        dated = [day for day in dated if day is not None]
+        if start_row == 2 or (dated and dated[0] < since):
+            break
+        end_row = start_row - 1
+        range_end = f'Z{end_row}'
+        window *= 2
+    logger.info(f"Loaded {len(rows)} recent rows from Google Sheets (from row {start_row})")
+    return pd.DataFrame([row[:len(SPENDING_COLUMNS)] for row in rows if any(row)], columns=SPENDING_COLUMNS)
+
+
+def load_data_from_google_sheets(since=None):
+    """Load data from Google Sheets and return as DataFrame with error handling and timeout.
+
+    With ``since`` (a date) and no warm replica only the tail of the sheet is
+    read; the frame then holds at least the rows dated ``since`` or later.
+    """
+    try:
+        logger.debug("Starting load_data_from_google_sheets")
+        if since is not None and not _replica.loaded:
+            with _readable_api_errors():
+                return normalize_spendings(_load_recent_rows(since))
+
+        _sync_replica()
+        df = _replica.frame()
+
+        if df.empty:
+            logger.warning("No data found in Google Sheets")
+            return df
+
+        logger.info(f"Converted to DataFrame with {len(df)} rows")
+        return df
+        
     except Exception as e:
         logger.error(f"Error loading data from Google Sheets: {e}", exc_info=True)
         raise
 
 
+def load_rollup():
+    """Sync the replica and return its per-category and per-day totals."""
+    _sync_replica()
+    return _replica.rollup
+
+
+def _spent_cents():
+    """Total of all spendings (archived ones aside) in cents."""
+    return get_store().total_cents()
+
+
+def _sheet_spent_cents():
+    """Total of the spendings in the Spendings sheet itself (what Pivot sums) in cents."""
+    store = get_store()
+    if isinstance(store, SheetsStore):
+        return store.sheet_cents()
+    journal = get_journal()
+    unsent = SpendingRollup()
+    for row in (journal.unflushed_rows() if journal is not None else []):
+        unsent.add(row)
+    return store.total_cents() - unsent.total_cents
+
+
+def prewarm():
+    """Do the slow first-use work before the first message needs it.
+
+    Returns the seconds spent per step, for the startup log.
+    """
+    def import_pandas():
+        import pandas  # noqa: F401
+
+    # With a local store, reports need that store (created from the sheet once) instead of the replica
+    if STORAGE_BACKEND == 'sheets':
+        data = ('replica', _in_background(_sync_replica))
+    else:
+        data = ('store', _in_background(get_store))
+    timings = {}
+    for step, action in (('pandas', import_pandas), ('discovery', _discovery_document),
+                         ('credentials', _get_credentials), ('client', get_sheet_service), data):
+        started = time.perf_counter()
+        action()
+        timings[step] = time.perf_counter() - started
+    return timings
+
+
+def _parse_spending(text):
+    """Split an expense line into (amount, description, error).
+
+    ``error`` is a user-facing message when the line is not a valid expense,
+    otherwise None.
+    """
+    if not text or not text.strip():
+        return None, None, "Please provide amount and description (e.g., '10.50 coffee')"
+
+    parts = text.split(maxsplit=1)
+    if len(parts) != 2:
+        return None, None, "Please provide both amount and description separated by space"
+
+    amount, description = parts
+    amount = amount.strip()
+    description = description.strip()
+
+    # Validate amount
+    try:
+        float(amount)
+    except ValueError:
+        return None, None, f"Invalid amount: {amount}. Please enter a valid number."
+
+    return amount, description, None
+
+
+def _first_row_of_range(updated_range):
+    """Parse a range like 'Spendings!A5:F7' and return its first row (5)."""
+    cell = updated_range.split('!')[1].split(':')[0]
+    return int(cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+
+def _append_rows(values):
+    """Append ``values`` in one request and return the sheet row of the first one."""
+    first_row = _send_rows(values)
+    _apply_appended(first_row, values)
+    return first_row
+
+
+def _send_rows(values):
+    """Append ``values`` to the sheet without recording them in the replica."""
+    sheet = get_sheet_service()
+    logger.debug("Got sheet service, executing append...")
+
+    result = _execute(sheet.values().append(
+        spreadsheetId=SPREADSHEET_ID,
+        range=RANGE_NAME,
+        valueInputOption='USER_ENTERED',
+        body={'values': values}
+    ), 'save_spending', write=True, idempotent=False)
+
+    logger.debug("Append completed, extracting row number...")
+
+    # Extract the row number from the updated range
+    updated_range = result.get('updates', {}).get('updatedRange', '')
+    if updated_range:
+        first_row = _first_row_of_range(updated_range)
+    else:
+        # Fallback: the appended rows are the last ones in the sheet
+        sheet_data = _execute(sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=SHEET_NAME), 'save_spending')
+        first_row = len(sheet_data.get('values', [])) - len(values) + 1
+    return first_row
+
+
+def _apply_appended(first_row, values):
+    """Record rows appended from ``first_row`` in the replica and the undo stack."""
+    for offset, row in enumerate(values):
+        _replica.apply_append(first_row + offset, row)
+        _row_tracker.push(first_row + offset)
+
+
+@contextmanager
+def _writing(*days):
+    """Record a write of spendings dated ``days`` once it is done, also when it fails half-way.
+
+    Without days, or with a None among them, every cached report is dropped.
+    """
+    try:
+        yield
+    finally:
+        for day in set(days) or [None]:
+            _report_cache.record_write(day)
+
+
+def _spending_day(ref=None):
+    """Date of the spending ``ref`` (None: the newest) if known without a request, otherwise None."""
+    journal = get_journal()
+    if ref is None and journal is not None:
+        ref = journal.last_unsent()
+    if isinstance(ref, JournalRef):
+        row = journal.row(ref)
+    else:
+        if ref is None:
+            ref = _row_tracker.peek() or _replica.row_count
+        row = _replica.row(ref)
+    return _row_day(row) if row else None
+
+
 def save_spending(text):
     """Save a spending entry to Google Sheets with error handling."""
     try:
         logger.debug(f"save_spending called with: {text[:50]}")
         
-        # Input validation
-        if not text or not text.strip():
-            return "Please provide amount and description (e.g., '10.50 coffee')"
-        
-        parts = text.split(maxsplit=1)
-        if len(parts) != 2:
-            return "Please provide both amount and description separated by space"
-        
-        amount, description = parts
-        amount = amount.strip()
-        description = description.strip()
-        
-        # Validate amount
-        try:
-            float(amount)
-        except ValueError:
-            return f"Invalid amount: {amount}. Please enter a valid number."
+        amount, description, error = _parse_spending(text)
+        if error:
+            return error
         
-        logger.debug(f"Calling Google Sheets API to save: {amount} {description}")
         current_date = get_current_date()
         values = [[current_date['year'], current_date['month'], current_date['day'], amount, description, '']]
-        body = {'values': values}
-        
-        sheet = get_sheet_service()
-        logger.debug("Got sheet service, executing append...")
-        
-        result = sheet.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=RANGE_NAME,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        
-        logger.debug("Append completed, extracting row number...")
 
-        # Extract the row number from the updated range
-        updated_range = result.get('updates', {}).get('updatedRange', '')
-        if updated_range:
-            # Parse the range like 'Spendings!A5:F5' to get row 5
-            row_number = int(updated_range.split('!')[1].split(':')[0][1:])  # Extract number from A5
-        else:
-            # Fallback: get the last row
-            sheet_data = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=SHEET_NAME).execute()
-            row_number = len(sheet_data.get('values', []))
+        logger.debug(f"Saving to {STORAGE_BACKEND}: {amount} {description}")
+        with _writing(datetime.now().date()):
+            ref = get_store().append(values)[0]
         
-        logger.info(f"Spending saved: {amount} {description} (row {row_number})")
-        return "Spending saved. Don't forget to choose Category", row_number
+        logger.info(f"Spending saved: {amount} {description}")
+        return "Spending saved. Don't forget to choose Category", ref
         
     except HttpError as e:
         logger.error(f"Google Sheets API error in save_spending: {e}")
@@ -190,33 +1571,59 @@ def save_spending(text):
         return f"Unexpected error saving spending: {e}", None
 
 
-def delete_last_spending():
-    """Delete the last spending entry from Google Sheets with error handling."""
+def save_spendings(lines):
+    """Save several spending entries with a single append request.
+
+    Returns a list of (line, message, row_number) in input order. Lines that
+    fail validation are not sent and get their validation message with a
+    row_number of None.
+    """
+    results = [None] * len(lines)
+    values = []
+    valid_indexes = []
+    current_date = get_current_date()
+
+    for index, line in enumerate(lines):
+        amount, description, error = _parse_spending(line)
+        if error:
+            results[index] = (line, error, None)
+            continue
+        values.append([current_date['year'], current_date['month'], current_date['day'], amount, description, ''])
+        valid_indexes.append(index)
+
+    if not values:
+        return results
+
     try:
-        sheet = get_sheet_service()
-        
-        # First, get all values to find the last row
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=SHEET_NAME).execute()
-        values = result.get('values', [])
-        
-        if not values or len(values) <= 1:  # Only header or empty
+        with _writing(datetime.now().date()):
+            refs = get_store().append(values)
+        for index, ref in zip(valid_indexes, refs):
+            results[index] = (lines[index], "Spending saved. Don't forget to choose Category", ref)
+        logger.info(f"Saved {len(values)} spendings in one request")
+    except HttpError as e:
+        logger.error(f"Google Sheets API error in save_spendings: {e}")
+        for index in valid_indexes:
+            results[index] = (lines[index], f"Error saving spending: {e}", None)
+    except Exception as e:
+        logger.error(f"Unexpected error in save_spendings: {e}", exc_info=True)
+        for index in valid_indexes:
+            results[index] = (lines[index], f"Unexpected error saving spending: {e}", None)
+
+    return results
+
+
+def delete_last_spending(on_deleted=None):
+    """Delete the last spending entry from Google Sheets with error handling.
+
+    ``on_deleted`` is called with the ref of the deleted spending.
+    """
+    try:
+        with _writing(_spending_day()):
+            ref = get_store().delete_last()
+        if ref is None:
             return "No spending entries to delete"
-        
-        # Find the last non-empty row (excluding header)
-        last_row_index = len(values)
-        
-        # Clear the last row
-        range_to_clear = f'{SHEET_NAME}!A{last_row_index}:F{last_row_index}'
-        body = {'values': [['', '', '', '', '', '']]}  # Clear all columns
-        
-        result = sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_to_clear,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        
-        logger.info(f"Deleted last spending entry (row {last_row_index})")
+        if on_deleted is not None:
+            on_deleted(ref)
         return "Last spending entry deleted successfully"
         
     except HttpError as e:
@@ -229,27 +1636,10 @@ def delete_last_spending():
 
 def update_spending_category(text, row_number=None):
     try:
-        sheet = get_sheet_service()
-        
-        if row_number is None:
-            # Fetch the last row number with data to find where to update the category
-            result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=SHEET_NAME).execute()
-            values = result.get('values', [])
-            if values:
-                row_number = len(values)  # This gives us the row index in 1-based indexing
-            else:
-                return "No spending to update"
-
-        # Assuming category is in the 6th column ('F')
-        range_to_update = f'{SHEET_NAME}!F{row_number}'
-        values = [[text]]  # The new category text
-        body = {'values': values}
-        result = sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_to_update,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
+        with _writing(_spending_day(row_number)):
+            updated = get_store().set_category(text, row_number)
+        if not updated:
+            return "No spending to update"
         return "Category updated for the spending"
     except HttpError as e:
         logger.error(f"Google Sheets API error in update_spending_category: {e}")
@@ -259,6 +1649,40 @@ def update_spending_category(text, row_number=None):
         return f"Unexpected error updating category: {e}"
 
 
+def _batch_update_categories(assignments):
+    """Write (row_number, category) pairs to column F with one batchUpdate request."""
+    sheet = get_sheet_service()
+    data = [
+        {'range': f'{SHEET_NAME}!F{row_number}', 'values': [[category]]}
+        for row_number, category in assignments
+    ]
+    _execute(sheet.values().batchUpdate(
+        spreadsheetId=SPREADSHEET_ID,
+        body={'valueInputOption': 'USER_ENTERED', 'data': data}
+    ), 'update_spending_categories', write=True)
+    for row_number, category in assignments:
+        _replica.apply_category(row_number, category)
+
+
+def update_spending_categories(assignments):
+    """Write several (row_number, category) pairs with one batchUpdate request."""
+    try:
+        if not assignments:
+            return "No categories to update"
+
+        with _writing(*(_spending_day(ref) for ref, _ in assignments)):
+            get_store().set_categories(assignments)
+
+        logger.info(f"Updated categories for {len(assignments)} spendings in one request")
+        return f"Categories updated for {len(assignments)} spendings"
+    except HttpError as e:
+        logger.error(f"Google Sheets API error in update_spending_categories: {e}")
+        return f"Error updating categories: {e}"
+    except Exception as e:
+        logger.error(f"Unexpected error in update_spending_categories: {e}")
+        return f"Unexpected error updating categories: {e}"
+
+
 def update_last_spending_category(text):
     """Update the category for the last spending entry with error handling."""
     try:
@@ -272,82 +1696,362 @@ def update_last_spending_category(text):
         return f"Unexpected error updating category: {e}"
 
 
+def _closed_year_rows(before_year):
+    """Leading replica rows dated before ``before_year``, as (row count, {year: non-empty rows}).
+
+    Rows are chronological, so the closed years are the start of the sheet; it
+    ends at the first row of a later year, or at a row whose year is unknown
+    before any dated one.
+    """
+    count = 0
+    years = defaultdict(list)
+    last_year = None
+    for row in _replica.rows:
+        year = _row_year(row) if any(row) else last_year
+        if year is None and any(row):
+            break
+        if year is not None and year >= before_year:
+            break
+        count += 1
+        if any(row):
+            years[year].append(row)
+            last_year = year
+    return count, dict(years)
+
+
+def _archive_cells(row):
+    """Row as entered by a save, so a serial-number date becomes a date again."""
+    row = list(row)
+    moment = _cell_datetime(row[2]) if len(row) > 2 else None
+    if moment is not None:
+        row[2] = moment.strftime('%Y-%m-%d %H:%M:%S')
+    return row
+
+
+def _archive_year(service, sheet_ids, year, rows):
+    """Copy ``rows`` to the year's archive sheet; returns every row now in it.
+
+    Rows already there from an interrupted earlier run are not copied twice.
+    """
+    title = f'{SHEET_NAME} {year}'
+    if title in sheet_ids:
+        existing = _read_values(service, f"'{title}'!A2:Z", 'archive').get('values', [])
+    else:
+        _add_sheet(service, title, _replica.header)
+        existing = []
+
+    known = Counter(_row_key(row) for row in existing)
+    new_rows = []
+    for row in rows:
+        key = _row_key(row)
+        if known[key]:
+            known[key] -= 1
+        else:
+            new_rows.append(row)
+    if new_rows:
+        _execute(service.values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"'{title}'!A1:Z",
+            valueInputOption='USER_ENTERED',
+            body={'values': [_archive_cells(row) for row in new_rows]}
+        ), 'archive', write=True, idempotent=False)
+    logger.info(f"Archived {len(new_rows)} rows to {title} ({len(existing)} were already there)")
+    return [list(row) for row in existing] + new_rows
+
+
+def archive_closed_years(before_year=None):
+    """Move the spendings of years before ``before_year`` (default: this year) to the archive.
+
+    Rows are copied to their '<SHEET_NAME> <year>' sheet and the manifest is
+    updated before they are deleted from the Spendings sheet, so a failed run
+    can simply be repeated. Deleting rows renumbers the remaining ones, so the
+    undo history is dropped. Journal flushes are held off for the whole run,
+    so no row number from before the deletion is recorded afterwards.
+    """
+    before_year = min(before_year or datetime.now().year, datetime.now().year)
+    journal = get_journal()
+    try:
+        with _writing(), (journal.holding_flushes() if journal is not None else nullcontext()), _replica._lock:
+            if journal is not None and journal.pending_count():
+                return "Spendings are still being sent to Google Sheets, try archiving again later"
+            # A fresh full load, so manual edits of old rows are archived too
+            _replica.reset()
+            with _readable_api_errors():
+                _replica.sync()
+            count, years = _closed_year_rows(before_year)
+            if not count:
+                return "Nothing to archive"
+
+            service = get_sheet_service()
+            sheet_ids = _sheet_ids(service)
+            manifest = SpendingArchive.parse(SpendingArchive.rows(_archive.load()))
+            for year, rows in years.items():
+                archived = SpendingRollup()
+                for row in _archive_year(service, sheet_ids, year, rows):
+                    archived.add(row)
+                for key in [key for key in manifest.month_totals if key[0] == year]:
+                    manifest.total_cents -= manifest.month_totals.pop(key)
+                for key, cents in archived.month_totals.items():
+                    if key[0] == year:
+                        manifest.month_totals[key] = cents
+                        manifest.total_cents += cents
+
+            if ARCHIVE_SHEET not in sheet_ids:
+                _add_sheet(service, ARCHIVE_SHEET, ARCHIVE_COLUMNS)
+            _execute(service.values().clear(
+                spreadsheetId=SPREADSHEET_ID, range=f"'{ARCHIVE_SHEET}'!A2:D"
+            ), 'archive', write=True)
+            _execute(service.values().update(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"'{ARCHIVE_SHEET}'!A2",
+                valueInputOption='USER_ENTERED',
+                body={'values': SpendingArchive.rows(manifest)}
+            ), 'archive', write=True)
+
+            # Undo and "last category" fall back to the replica, which waits for this run
+            _row_tracker.reset()
+            _execute(service.batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={'requests': [{'deleteDimension': {'range': {
+                    'sheetId': sheet_ids[SHEET_NAME], 'dimension': 'ROWS',
+                    'startIndex': 1, 'endIndex': 1 + count}}}]}
+            ), 'archive', write=True)
+            get_store().sheet_rows_deleted(2, count)
+            if journal is not None:
+                journal.rows_deleted(2, count)
+            reset_caches()
+            _archive.replace(manifest)
+
+        archived_years = ', '.join(str(year) for year in sorted(years))
+        logger.info(f"Archived {count} rows of {archived_years} from {SHEET_NAME}")
+        return f"Archived {count} spendings of {archived_years}"
+    except Exception as e:
+        logger.error(f"Error archiving spendings: {e}", exc_info=True)
+        return f"Error archiving spendings: {e}"
+
+
+def _amount_cents(text):
+    """Cents in an amount as the Pivot sheet shows it ('1 234,56', '1,234.56', '1234.5'), or None."""
+    digits = WHITESPACE.sub('', text).strip(',.')
+    if ',' in digits and '.' in digits:
+        thousands = ',' if digits.rfind(',') < digits.rfind('.') else '.'
+        digits = digits.replace(thousands, '').replace(',', '.')
+    elif DECIMAL_COMMA.search(digits):
+        digits = digits.replace(',', '.')
+    else:
+        digits = digits.replace(',', '')
+    return _cell_cents(digits)
+
+
+def format_balance(text, spent_since=0):
+    """Format the Pivot balance cell, less ``spent_since`` cents spent after it was read.
+
+    Cells that do not hold a readable cash amount are shown as they are.
+    """
+    if not text:
+        return f"{CURRENCY} {-spent_since / 100:.2f}"
+
+    # If the cell contains combined cash/invest info, format nicely
+    lower_text = text.lower()
+    if ('cash' in lower_text) and ('invest' in lower_text):
+        cash_match = CASH_PATTERN.search(text)
+        invest_match = INVEST_PATTERN.search(text)
+
+        if cash_match and invest_match:
+            cash_currency = cash_match.group(1) or CURRENCY
+            cash_amount = (cash_match.group(2) or '').replace('\xa0', ' ').strip()
+            invest_currency = invest_match.group(1) or CURRENCY
+            invest_amount = (invest_match.group(2) or '').replace('\xa0', ' ').strip()
+            cash_cents = _amount_cents(cash_amount)
+            if spent_since and cash_cents is not None:
+                cash_amount = f"{(cash_cents - spent_since) / 100:.2f}"
+
+            # Put invest on a new line (plain text)
+            return f"cash: {cash_currency}{cash_amount}\ninvest: {invest_currency}{invest_amount}"
+
+        # Fallback: split on 'invest:' into two lines
+        if 'invest:' in lower_text:
+            parts = INVEST_LABEL.split(text)
+            left = parts[0].strip().rstrip(',;')
+            right = parts[1].strip()
+            # Try to normalize left to just the cash portion
+            left = CASH_LABEL.sub("", left).strip()
+            return f"cash: {left}\ninvest: {right}"
+
+    # Otherwise assume it's a single numeric total, try to format as currency
+    try:
+        value = float(text.replace('\xa0', '').replace(',', '.'))
+    except ValueError:
+        # Present the raw value with a best-effort line break between cash and invest
+        return text.replace(' invest:', '\ninvest: ')
+    return f'{CURRENCY} {value - spent_since / 100:.2f}'
+
+
+class BalanceEngine:
+    """Answers balance requests from the replica instead of reading Pivot every time.
+
+    With an ``opening`` cash balance the cash is that amount minus every
+    spending in the replica, and ``invest`` is shown as configured. Otherwise
+    the Pivot balance cell is read as an anchor, together with the replica's
+    spent total at that moment, and what was spent since (plus the archived
+    years Pivot no longer sees) is subtracted from it locally. ``start()``
+    re-reads the anchor every ``refresh_seconds`` in the background; without
+    it a stale anchor is re-read on the next request. An anchor taken while a
+    write happened may or may not include it in Pivot, so it is re-read on
+    the next request too.
+    """
+
+    def __init__(self, opening=OPENING_BALANCE, invest=INVEST_BALANCE, refresh_seconds=BALANCE_REFRESH_SECONDS):
+        self.opening = opening
+        self.invest = invest
+        self.refresh_seconds = refresh_seconds
+        self._anchor = None  # (Pivot cell text, replica total in cents when it was read)
+        self._anchored_at = None
+        self._uncertain = False  # a write happened while the anchor was read
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def reset(self):
+        self._anchor = None
+        self._anchored_at = None
+        self._uncertain = False
+
+    def text(self):
+        """The balance message, making Sheets requests only for a missing or stale anchor."""
+        if self.opening is not None:
+            spent = _spent_cents() + _archived_cents()
+            cash = (_cell_cents(self.opening) - spent) / 100
+            if self.invest is None:
+                return f"{CURRENCY} {cash:.2f}"
+            return f"cash: {CURRENCY}{cash:.2f}\ninvest: {CURRENCY}{_cell_cents(self.invest) / 100:.2f}"
+
+        anchor = self._anchor
+        running = self._thread is not None and self._thread.is_alive()
+        expired = anchor is not None and not running and time.monotonic() - self._anchored_at > self.refresh_seconds
+        if anchor is None or expired or self._uncertain:
+            anchor = _inflight.do('balance_refresh', self.refresh)
+        text, spent_at_anchor = anchor
+        return format_balance(text, _spent_cents() - spent_at_anchor)
+
+    def refresh(self):
+        """Read the Pivot balance cell and anchor the local total to it."""
+        generation = _report_cache.generation
+        value_response = _read_values(get_sheet_service(), BALANCE_RANGE, 'get_total_amount')
+        values = value_response.get('values')
+        if not values:
+            logger.warning(f"No values found in {BALANCE_RANGE}")
+        text = str(values[0][0]).strip() if values else ''
+        get_store().sync()
+        # Pivot only sums the Spendings sheet, so archived years and rows still in the journal
+        # are subtracted as if spent since
+        self._anchor = (text, _sheet_spent_cents() - _archive.load().total_cents)
+        self._anchored_at = time.monotonic()
+        # Pivot read first: a spending saved in between is at worst not subtracted, until the re-read
+        self._uncertain = _report_cache.generation != generation
+        logger.info(f"Balance anchored to Pivot: {text!r}")
+        return self._anchor
+
+    def start(self):
+        """Keep the anchor fresh from a background thread (idempotent, no-op with an opening balance)."""
+        if self.opening is not None or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='balance-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        refresh = _in_background(self.refresh)
+        while not self._stopping.is_set():
+            try:
+                _inflight.do('balance_refresh', refresh)
+            except Exception as e:
+                logger.warning(f"Balance refresh from Pivot failed: {e}")
+            self._stopping.wait(self.refresh_seconds)
+
+
+_balance = BalanceEngine()
+
+
+def start_balance_refresh():
+    _balance.start()
+
+
+def stop_balance_refresh():
+    _balance.stop()
+
+
 def get_total_amount():
-    """Retrieve the total amount from the spreadsheet."""
+    """Return the total balance, answered locally once the balance is anchored."""
     try:
-        sheet = get_sheet_service()
-        value_response = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range='Pivot!D2:D2').execute()
-        if not value_response.get('values'):
-            logging.warning("No values found in Pivot!D2:D2")
-            return f"{CURRENCY} 0.00"
-        
-        value_str = value_response['values'][0][0]
-        text = str(value_str).strip()
-
-        # If the cell contains combined cash/invest info, format nicely
-        lower_text = text.lower()
-        if ('cash' in lower_text) and ('invest' in lower_text):
-            import re
-            # Extract optional currency and number parts for both cash and invest
-            cash_match = re.search(r"cash\s*:\s*(€)?\s*([\d\s.,]+)", text, re.IGNORECASE)
-            invest_match = re.search(r"invest\s*:\s*(€)?\s*([\d\s.,]+)", text, re.IGNORECASE)
-
-            if cash_match and invest_match:
-                cash_currency = cash_match.group(1) or CURRENCY
-                cash_amount = (cash_match.group(2) or '').replace('\xa0', ' ').strip()
-                invest_currency = invest_match.group(1) or CURRENCY
-                invest_amount = (invest_match.group(2) or '').replace('\xa0', ' ').strip()
-
-                # Put invest on a new line (plain text)
-                formatted = f"cash: {cash_currency}{cash_amount}\ninvest: {invest_currency}{invest_amount}"
-                logging.info("Retrieved combined cash/invest balance")
-                return formatted
-
-            # Fallback: split on 'invest:' into two lines and bold labels
-            if 'invest:' in lower_text:
-                parts = re.split(r"invest\s*:\s*", text, flags=re.IGNORECASE)
-                left = parts[0].strip().rstrip(',;')
-                right = parts[1].strip()
-                # Try to normalize left to just the cash portion
-                left = re.sub(r"\bcash\s*:\s*", "", left, flags=re.IGNORECASE).strip()
-                formatted = f"cash: {left}\ninvest: {right}"
-                return formatted
-
-        # Otherwise assume it's a single numeric total, try to format as currency
-        cleaned_value = float(text.replace('\xa0', '').replace(',', '.'))
-        result = f'{CURRENCY} {cleaned_value:.2f}'
-        logging.info(f"Retrieved total amount: {result}")
+        result = _inflight.do(BALANCE_REPORT, _balance.text)
+        logger.info(f"Retrieved total amount: {result!r}")
         return result
     except HttpError as e:
         logging.error(f"Google Sheets API error in get_total_amount: {e}")
         return f"Error retrieving total amount: {e}"
-    except ValueError as e:
-        # If parsing as float failed, just return the raw text as a readable fallback
-        try:
-            raw = value_response['values'][0][0]
-            # Present raw value with a best-effort line break between cash and invest
-            raw = str(raw).replace(' invest:', '\ninvest: ').replace('cash:', 'cash:')
-            return raw
-        except Exception:
-            logging.error(f"Value conversion error in get_total_amount: {e}")
-            return f"Error processing total amount: {e}"
     except Exception as e:
         logging.error(f"Unexpected error in get_total_amount: {e}")
         return f"Unexpected error retrieving total amount: {e}"
 
 
 def get_report(text):
+    """Return a report, reusing a cached one while no write has touched its period."""
+    today = datetime.now().date()
+    label = REPORT_LABELS.get(text, 'year' if YEAR_REPORT_PATTERN.match(text) else 'other')
+    cached = _report_cache.get(text, today)
+    metrics.CACHE_REQUESTS.inc(report=label, result='miss' if cached is None else 'hit')
+    if cached is not None:
+        logger.debug(f"Report cache hit for {text}")
+        return cached
+    rows_before = metrics.rows_read()
+    # Keyed by the full request: '📊 Год' and '📊 Год 2024' share a label but not a result.
+    # Only builds started after the caller's last write are joined, so its own spending is in
+    generation = _report_cache.generation
+    result = _inflight.do(f'report_{text}_{generation}', _build_and_cache_report, text, today, generation,
+                          label=f'report_{label}')
+    metrics.REPORT_ROWS_LOADED.observe(metrics.rows_read() - rows_before, report=label)
+    return result
+
+
+def _build_and_cache_report(text, today, generation):
+    # A write landing during the build may be missing from the result, which is then not cached
+    result = _build_report(text)
+    if not result.startswith(('Error', 'Invalid report type')):
+        _report_cache.put(text, today, result, generation)
+    return result
+
+
+def _build_report(text):
     """Generate financial reports with error handling."""
+    import pandas as pd
     try:
-        df = load_data_from_google_sheets()
-        current_date = get_current_date()
-        
-        if df.empty:
-            return "No spending data available"
+        if text == YEARS_REPORT or YEAR_REPORT_PATTERN.match(text):
+            return _build_archive_report(text)
+
+        if text in ('📊 Месяц', '📊 Год'):
+            # Category totals are aggregated by the store, no rows are scanned
+            store = get_store()
+            store.sync()
+            if not len(store):
+                return "No spending data available"
+        else:
+            # Day and week reports only need the last few days of rows
+            days_back = 6 if text == '📊 Неделя' else 0
+            df = get_store().query(datetime.now().date() - timedelta(days=days_back))
+            if df.empty:
+                return "No spending data available"
 
         if text == '📊 День':
             try:
-                today_report = df[(pd.to_datetime(df['date']).dt.date == pd.to_datetime(current_date['day']).date())]
+                df = normalize_spendings(df)
+                today = pd.Timestamp(datetime.now().date())
+                today_report = df[df['date'].dt.normalize() == today]
                 return format_report(today_report, CURRENCY)
             except Exception as e:
                 logger.error(f"Error generating daily report: {e}")
@@ -355,10 +2059,10 @@ def get_report(text):
 
         elif text == '📊 Неделя':
             try:
-                df['date'] = pd.to_datetime(df['date']).dt.date
-                start_of_week = datetime.now().date() - timedelta(days=6)
-                end_of_week = datetime.now().date()
-                week_report = df[(df['date'] >= start_of_week) & (df['date'] <= end_of_week)]
+                df = normalize_spendings(df)
+                start_of_week = pd.Timestamp(datetime.now().date() - timedelta(days=6))
+                end_of_week = pd.Timestamp(datetime.now().date() + timedelta(days=1))
+                week_report = df[(df['date'] >= start_of_week) & (df['date'] < end_of_week)]
                 return format_report(week_report, CURRENCY)
             except Exception as e:
                 logger.error(f"Error generating weekly report: {e}")
@@ -366,21 +2070,17 @@ def get_report(text):
 
         elif text == '📊 Месяц':
             try:
-                df['sum'] = df['sum'].astype(float)
-                category_month_report = df[(df['month'].str.contains(current_date['month'])) &
-                                           (df['year'].astype(int) == int(current_date['year']))]
-                df_excluded_sum = category_month_report.groupby('category')['sum'].sum().reset_index()
-                return format_month_report(df_excluded_sum, CURRENCY)
+                now = datetime.now()
+                totals = store.categories_for(now.year, now.month)
+                return format_month_report(pd.DataFrame(totals, columns=['category', 'sum']), CURRENCY)
             except Exception as e:
                 logger.error(f"Error generating monthly report: {e}")
                 return "Error generating monthly report"
 
         elif text == '📊 Год':
             try:
-                df['sum'] = df['sum'].astype(float)
-                category_year_report = df[df['year'].astype(int) == int(current_date['year'])]
-                df_excluded_sum = category_year_report.groupby('category')['sum'].sum().reset_index()
-                return format_year_report(df_excluded_sum, CURRENCY)
+                totals = store.categories_for(datetime.now().year)
+                return format_year_report(pd.DataFrame(totals, columns=['category', 'sum']), CURRENCY)
             except Exception as e:
                 logger.error(f"Error generating yearly report: {e}")
                 return "Error generating yearly report"
@@ -393,29 +2093,102 @@ def get_report(text):
         return f"Error generating report: {e}"
 
 
+def _archived_rollup(hot):
+    """Archived totals that are not also in the store ``hot``.
+
+    A local store keeps every spending, so archived years it has rows of are left out.
+    """
+    archived = _archive.load()
+    if isinstance(hot, SheetsStore):
+        return archived
+    kept = {year for year, _ in hot.year_totals()}
+    rollup = SpendingRollup()
+    for key, cents in archived.month_totals.items():
+        if key[0] not in kept:
+            rollup.month_totals[key] = cents
+            rollup.total_cents += cents
+    return rollup
+
+
+def _archived_cents():
+    return _archived_rollup(get_store()).total_cents
+
+
+def _merge_totals(*totals):
+    """Add up several [(key, amount)] lists into one sorted by key."""
+    merged = defaultdict(int)
+    for pairs in totals:
+        for key, amount in pairs:
+            merged[key] += round(amount * 100)
+    return [(key, merged[key] / 100) for key in sorted(merged)]
+
+
+def _build_archive_report(text):
+    """📊 Годы, or 📊 Год of a given year: the archived totals plus the Spendings sheet."""
+    import pandas as pd
+    hot = get_store()
+    hot.sync()
+    archived = _archived_rollup(hot)
+    match = YEAR_REPORT_PATTERN.match(text)
+    if match:
+        try:
+            year = int(match.group(1))
+            totals = _merge_totals(archived.categories_for(year), hot.categories_for(year))
+            return format_year_report(pd.DataFrame(totals, columns=['category', 'sum']), CURRENCY, year)
+        except Exception as e:
+            logger.error(f"Error generating yearly report: {e}")
+            return "Error generating yearly report"
+
+    try:
+        totals = _merge_totals(archived.year_totals(), hot.year_totals())
+        if not totals:
+            return "No spending data available"
+        report_df = pd.DataFrame([(str(year), amount) for year, amount in totals], columns=['category', 'sum'])
+        return _format_category_totals(report_df, CURRENCY, f'{totals[0][0]}-{totals[-1][0]}\n')
+    except Exception as e:
+        logger.error(f"Error generating multi-year report: {e}")
+        return "Error generating multi-year report"
+
+
+def _as_text(column):
+    """Render a column like str() does per value; missing values become 'nan'."""
+    import pandas as pd
+    text = pd.Series(column.to_numpy().astype(str), index=column.index, dtype=object)
+    text[column.isna().to_numpy()] = 'nan'
+    return text
+
+
+def _sequential_sum(values):
+    """Left-to-right float sum, rounding exactly like a ``total += amount`` loop."""
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    return float(np.add.accumulate(values)[-1]) if len(values) else 0
+
+
 def format_report(report_df, currency):
     """Format spending report with error handling."""
+    import pandas as pd
     try:
         if report_df.empty:
             return "No data to display"
-            
-        formatted_report = ""
-        total_sum = 0
 
-        for _, row in report_df.iterrows():
-            try:
-                day_abbreviation = get_day_abbreviation(pd.to_datetime(row['date']).strftime('%A'))
-                # Handle None values to prevent format string errors
-                category = str(row['category']) if row['category'] is not None else ''
-                amount = str(row['sum']) if row['sum'] is not None else '0'
-                comment = str(row['comment']) if row['comment'] is not None else ''
-                
-                formatted_report += f"{day_abbreviation}. {category:<10} {currency}{amount:<4} {comment}\n"
-                total_sum += float(amount) if amount else 0
-            except (ValueError, KeyError, TypeError) as e:
-                logger.warning(f"Error formatting row: {e}, skipping")
-                continue
+        # Rows without a parseable date cannot be labelled with a weekday and are skipped
+        dates = pd.to_datetime(report_df['date'], errors='coerce')
+        report_df = report_df[dates.notna()]
+        weekdays = dates[dates.notna()].dt.dayofweek.map(weekday_abbreviations)
+
+        amounts = _as_text(report_df['sum'])
+        if pd.api.types.is_float_dtype(report_df['sum']):
+            # Typed frames hold floats, show whole amounts the way they were entered ("5", not "5.0")
+            amounts = amounts.str.replace(r'\.0$', '', regex=True)
+        lines = (weekdays + '. ' + _as_text(report_df['category']).str.ljust(10) + ' ' +
+                 currency + amounts.str.ljust(4) + ' ' + _as_text(report_df['comment']))
 
+        # Amounts that are not numbers are shown but left out of the total
+        numeric = pd.to_numeric(amounts.where(amounts != ''), errors='coerce')
+        total_sum = _sequential_sum(numeric[numeric.notna() | report_df['sum'].isna()])
+
+        formatted_report = ''.join(line + '\n' for line in lines)
         formatted_report += f'Total: {total_sum} {currency}\n'
         return formatted_report.strip()
     except Exception as e:
@@ -423,92 +2196,41 @@ def format_report(report_df, currency):
         return "Error formatting report"
 
 
+def _format_category_totals(report_df, currency, heading):
+    """Lines of '<category> <currency><amount>' under ``heading`` plus a total."""
+    import pandas as pd
+    # Amounts that are not numbers are skipped
+    amounts = pd.to_numeric(report_df['sum'], errors='coerce')
+    valid = amounts.notna() | report_df['sum'].isna()
+    amounts = amounts[valid].astype(float)
+    lines = _as_text(report_df['category'][valid]) + ' ' + currency + _as_text(amounts)
+
+    total_sum = _sequential_sum(amounts)
+    formatted_report = heading + ''.join(line + '\n' for line in lines)
+    formatted_report += f'Total: {total_sum} {currency}\n'
+    return formatted_report.strip()
+
+
 def format_month_report(report_df, currency):
     """Format monthly spending report with error handling."""
     try:
         if report_df.empty:
             return f'{datetime.now().strftime("%Y.%m")}\nNo data to display'
-            
-        formatted_report = f'{datetime.now().strftime("%Y.%m")}\n'
-        total_sum = 0
-
-        for _, row in report_df.iterrows():
-            try:
-                # Handle None values
-                category = str(row['category']) if row['category'] is not None else ''
-                amount = float(row['sum']) if row['sum'] is not None else 0
-                formatted_report += f"{category} {currency}{amount}\n"
-                total_sum += amount
-            except (ValueError, KeyError, TypeError) as e:
-                logger.warning(f"Error formatting row: {e}, skipping")
-                continue
 
-        formatted_report += f'Total: {total_sum} {currency}\n'
-        return formatted_report.strip()
+        return _format_category_totals(report_df, currency, f'{datetime.now().strftime("%Y.%m")}\n')
     except Exception as e:
         logger.error(f"Error in format_month_report: {e}", exc_info=True)
         return "Error formatting monthly report"
 
 
-def format_year_report(report_df, currency):
-    """Format yearly spending report with error handling."""
+def format_year_report(report_df, currency, year=None):
+    """Format yearly spending report (of this year unless ``year`` is given) with error handling."""
     try:
+        heading = str(year) if year is not None else datetime.now().strftime("%Y")
         if report_df.empty:
-            return f'{datetime.now().strftime("%Y")}\nNo data to display'
-            
-        formatted_report = f'{datetime.now().strftime("%Y")}\n'
-        total_sum = 0
+            return f'{heading}\nNo data to display'
 
-        for _, row in report_df.iterrows():
-            try:
-                # Handle None values
-                category = str(row['category']) if row['category'] is not None else ''
-                amount = float(row['sum']) if row['sum'] is not None else 0
-                formatted_report += f"{category} {currency}{amount}\n"
-                total_sum += amount
-            except (ValueError, KeyError, TypeError) as e:
-                logger.warning(f"Error formatting row: {e}, skipping")
-                continue
-
-        formatted_report += f'Total: {total_sum} {currency}\n'
-        return formatted_report.strip()
+        return _format_category_totals(report_df, currency, f'{heading}\n')
     except Exception as e:
         logger.error(f"Error in format_year_report: {e}")
         return "Error formatting yearly report"
-
-
-def delete_last_spending():
-    """Delete the last spending entry from Google Sheets with error handling."""
-    try:
-        sheet = get_sheet_service()
-        
-        # First, get all values to find the last row
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=SHEET_NAME).execute()
-        values = result.get('values', [])
-        
-        if not values or len(values) <= 1:  # Only header or empty
-            return "No spending entries to delete"
-        
-        # Find the last non-empty row (excluding header)
-        last_row_index = len(values)
-        
-        # Clear the last row
-        range_to_clear = f'{SHEET_NAME}!A{last_row_index}:F{last_row_index}'
-        body = {'values': [['', '', '', '', '', '']]}  # Clear all columns
-        
-        result = sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_to_clear,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        
-        logger.info(f"Deleted last spending entry (row {last_row_index})")
-        return "Last spending entry deleted successfully"
-        
-    except HttpError as e:
-        logger.error(f"Google Sheets API error in delete_last_spending: {e}")
-        return f"Error deleting spending: {e}"
-    except Exception as e:
-        logger.error(f"Unexpected error in delete_last_spending: {e}")
-        return f"Unexpected error deleting spending: {e}"
@@ -0,0 +1,263 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_row(row):
+    """(moment, cents, comment, category) of a sheet row, or None without a date or amount.
+
+    Rows are in sheet column order (year, month, date, sum, comment, category)
+    with the date as a save writes it. ``category`` is None when uncategorized.
+    """
+    try:
+        moment = datetime.strptime(str(row[2]), DATE_FORMAT)
+        cents = round(float(row[3]) * 100)
+    except (IndexError, TypeError, ValueError):
+        return None
+    comment = str(row[4]) if len(row) > 4 else ''
+    category = str(row[5]) if len(row) > 5 and row[5] not in ('', None) else None
+    return moment, cents, comment, category
+
+
+def amount_text(cents):
+    """Cents as a sum cell: '4.2', '10', '-0.5'."""
+    text = f'{abs(cents) // 100}.{abs(cents) % 100:02d}'.rstrip('0').rstrip('.')
+    return '-' + text if cents < 0 else text
+
+
+def sheet_row(moment, cents, comment, category):
+    """A spending as a sheet row, in the format save_spending writes."""
+    return [moment.strftime('%Y'), moment.strftime('%m %B').lower(), moment.strftime(DATE_FORMAT),
+            amount_text(cents), comment, category or '']
+
+
+def spending_frame(dates, cents, comments, categories):
+    """DataFrame typed like normalize_spendings() output, from column sequences.
+
+    ``dates`` are datetime64 values or DATE_FORMAT strings.
+    """
+    import pandas as pd
+    dates = pd.Series(pd.to_datetime(dates, format=DATE_FORMAT))
+    return pd.DataFrame({
+        'year': dates.dt.year.astype('Int16'),
+        'month': dates.dt.month.astype('Int16'),
+        'date': dates,
+        'sum': pd.Series(cents, dtype='int64') / 100,
+        'comment': pd.Series(comments, dtype=object),
+        'category': pd.Categorical(categories),
+    }, columns=['year', 'month', 'date', 'sum', 'comment', 'category'])
+
+
+class SpendingStore:
+    """Where spendings are kept; Google Sheets, or a local store that Sheets mirrors.
+
+    Spendings go in and come out as sheet rows (see parse_row). A ref names
+    one spending: a sheet row number or JournalRef for Google Sheets, the
+    integer ``entry`` given to append() for a local store. Methods taking an
+    optional ref act on the newest spending when it is None. Aggregates
+    match SpendingRollup: amounts per category or year, sorted, with
+    uncategorized spendings only counted in total_cents().
+    """
+
+    def append(self, rows, refs=None):
+        """Store ``rows`` in order; returns their refs."""
+        raise NotImplementedError
+
+    def set_category(self, category, ref=None):
+        """Set the category of one spending; returns False when there is none."""
+        raise NotImplementedError
+
+    def set_categories(self, assignments):
+        """Apply several (ref, category) pairs at once."""
+        raise NotImplementedError
+
+    def delete_last(self):
+        """Delete the newest spending; returns its ref, or None when there is none."""
+        raise NotImplementedError
+
+    def last_ref(self):
+        """Ref of the newest spending, or None when there is none."""
+        raise NotImplementedError
+
+    def query(self, start, end=None):
+        """Spendings dated from ``start`` (a date) up to ``end`` (exclusive, open when None) as a DataFrame."""
+        raise NotImplementedError
+
+    def categories_for(self, year, month=None):
+        raise NotImplementedError
+
+    def year_totals(self):
+        raise NotImplementedError
+
+    def total_cents(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def rows(self):
+        """Every spending as (sheet row, ref), oldest first, for copying to another store."""
+        raise NotImplementedError
+
+    def sync(self):
+        """Pick up changes made outside this process (local stores have none)."""
+
+    def sheet_rows_deleted(self, first_row, count):
+        """Sheet rows ``first_row``.. were deleted; keep refs to later rows right."""
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(SpendingStore):
+    """Spendings in an indexed SQLite table, aggregated by SQL.
+
+    One row per spending with its year and month split out, indexed by date
+    for range queries and by (year, month, category) for the month and year
+    totals, which SQLite answers from the index alone. Deleted spendings are
+    gone; ``entry`` links a row to its copy in Google Sheets like in the
+    ledger (journal entry id, minus the sheet row number, 0 when unknown).
+    Uncategorized spendings have the category ''.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS spendings ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' entry INTEGER NOT NULL DEFAULT 0,'
+            ' date TEXT NOT NULL,'
+            ' year INTEGER NOT NULL,'
+            ' month INTEGER NOT NULL,'
+            ' cents INTEGER NOT NULL,'
+            ' comment TEXT NOT NULL,'
+            ' category TEXT NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS spendings_date ON spendings (date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS spendings_period ON spendings (year, month, category, cents)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS spendings_entry ON spendings (entry)')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, statement, parameters=()):
+        with self._lock:
+            return self._conn.execute(statement, parameters).rowcount
+
+    def _write_many(self, statement, parameters):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(statement, parameters)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def _read(self, statement, parameters=()):
+        with self._lock:
+            return self._conn.execute(statement, parameters).fetchall()
+
+    # Writing
+
+    def append(self, rows, refs=None):
+        refs = list(refs) if refs is not None else [0] * len(rows)
+        spendings = []
+        for row, entry in zip(rows, refs):
+            parsed = parse_row(row)
+            if parsed is None:
+                raise ValueError(f"Not a spending row: {row!r}")
+            moment, cents, comment, category = parsed
+            spendings.append((entry, moment.strftime(DATE_FORMAT), moment.year, moment.month,
+                              cents, comment, category or ''))
+        self._write_many('INSERT INTO spendings (entry, date, year, month, cents, comment, category)'
+                         ' VALUES (?, ?, ?, ?, ?, ?, ?)', spendings)
+        return refs
+
+    def set_category(self, category, ref=None):
+        if ref is None:
+            return bool(self._write('UPDATE spendings SET category = ?'
+                                    ' WHERE id = (SELECT MAX(id) FROM spendings)', (category or '',)))
+        return bool(self._write('UPDATE spendings SET category = ?'
+                                ' WHERE id = (SELECT MAX(id) FROM spendings WHERE entry = ?)',
+                                (category or '', ref)))
+
+    def set_categories(self, assignments):
+        self._write_many('UPDATE spendings SET category = ?'
+                         ' WHERE id = (SELECT MAX(id) FROM spendings WHERE entry = ?)',
+                         [(category or '', ref) for ref, category in assignments if ref is not None])
+
+    def delete_last(self):
+        with self._lock:
+            newest = self._conn.execute('SELECT id, entry FROM spendings ORDER BY id DESC LIMIT 1').fetchone()
+            if newest is None:
+                return None
+            self._conn.execute('DELETE FROM spendings WHERE id = ?', (newest[0],))
+            return newest[1]
+
+    def last_ref(self):
+        newest = self._read('SELECT entry FROM spendings ORDER BY id DESC LIMIT 1')
+        return newest[0][0] if newest else None
+
+    def sheet_rows_deleted(self, first_row, count):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('UPDATE spendings SET entry = 0 WHERE entry <= ? AND entry > ?',
+                                   (-first_row, -(first_row + count)))
+                self._conn.execute('UPDATE spendings SET entry = entry + ? WHERE entry <= ?',
+                                   (count, -(first_row + count)))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    # Reading
+
+    def query(self, start, end=None):
+        bounds = [datetime.combine(start, datetime.min.time()).strftime(DATE_FORMAT)]
+        condition = 'date >= ?'
+        if end is not None:
+            bounds.append(datetime.combine(end, datetime.min.time()).strftime(DATE_FORMAT))
+            condition += ' AND date < ?'
+        rows = self._read(f'SELECT date, cents, comment, category FROM spendings WHERE {condition} ORDER BY id',
+                          bounds)
+        return spending_frame(*([list(column) for column in zip(*rows)] if rows else [[], [], [], []]))
+
+    def categories_for(self, year, month=None):
+        """Totals per category as [(category, amount)] sorted by category."""
+        if month is None:
+            rows = self._read('SELECT category, SUM(cents) FROM spendings WHERE year = ? AND category != \'\''
+                              ' GROUP BY category HAVING SUM(cents) != 0 ORDER BY category', (year,))
+        else:
+            rows = self._read('SELECT category, SUM(cents) FROM spendings WHERE year = ? AND month = ?'
+                              ' AND category != \'\' GROUP BY category HAVING SUM(cents) != 0 ORDER BY category',
+                              (year, month))
+        return [(category, cents / 100) for category, cents in rows]
+
+    def year_totals(self):
+        """Totals per year as [(year, amount)] sorted by year."""
+        rows = self._read('SELECT year, SUM(cents) FROM spendings WHERE category != \'\''
+                          ' GROUP BY year HAVING SUM(cents) != 0 ORDER BY year')
+        return [(year, cents / 100) for year, cents in rows]
+
+    def total_cents(self):
+        return self._read('SELECT COALESCE(SUM(cents), 0) FROM spendings')[0][0]
+
+    def __len__(self):
+        return self._read('SELECT COUNT(*) FROM spendings')[0][0]
+
+    def rows(self):
+        rows = self._read('SELECT date, cents, comment, category, entry FROM spendings ORDER BY id')
+        return [(sheet_row(datetime.strptime(date, DATE_FORMAT), cents, comment, category), entry)
+                for date, cents, comment, category, entry in rows]
@@ -64,4 +64,30 @@ def mock_logger():
             'responses': mock_resp_logger,
             'spendings': mock_spend_logger,
             'openai': mock_ai_logger
-        }
\ No newline at end of file
+        }
+
+@pytest.fixture(autouse=True)
+def reset_spendings_state(monkeypatch):
+    """Drop process-wide bot state so tests do not leak into each other"""
+    import metrics
+    import responses
+    import spendings
+    from scheduler import SheetsScheduler
+    spendings.reset_caches()
+    metrics.REGISTRY.clear()
+    monkeypatch.setattr(responses, 'chat_states', responses.ChatStateStore())
+    # No quotas and no real backoff sleeps in tests
+    monkeypatch.setattr(spendings, '_scheduler', SheetsScheduler(None, None, sleep=lambda seconds: None))
+    yield
+    spendings.reset_caches()
+
+
+@pytest.fixture
+def fake_sheets(monkeypatch, sample_spending_data):
+    """In-process Google Sheets API holding the sample spendings"""
+    import spendings
+    from fake_sheets import FakeSheets
+    fake = FakeSheets()
+    fake.set_values(spendings.SHEET_NAME, sample_spending_data)
+    monkeypatch.setattr(spendings, 'get_sheet_service', lambda: fake)
+    return fake
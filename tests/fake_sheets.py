@@ -0,0 +1,393 @@
+"""In-process stand-in for the Google Sheets ``spreadsheets()`` resource.
+
+FakeSheets keeps real row state per sheet and answers the ``values`` calls the
+bot makes (get, append, update, batchUpdate, clear) plus the metadata ``get``
+and the ``batchUpdate`` requests adding sheets and deleting rows, so tests
+and benchmarks can run without network access. Every request can be slowed
+down, failed on purpose or rejected by a per-window quota, in the same shape
+googleapiclient would raise.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+SHEETS_EPOCH = datetime(1899, 12, 30)  # day 0 of Sheets serial-number dates
+DEFAULT_ROW_COUNT = 1000  # grid rows of a new sheet
+DEFAULT_COLUMN_COUNT = 26
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_RANGE_RE = re.compile(r'^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$')
+_NUMBER_RE = re.compile(r'^-?\d+(\.\d+)?$')
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _column_letters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+
+def parse_range(range_name):
+    """Split an A1 range into (sheet, first_row, last_row, first_col, last_col).
+
+    Rows are 1-based and inclusive, columns 0-based and inclusive; an open end
+    is None.
+    """
+    sheet, _, cells = range_name.partition('!')
+    sheet = sheet.strip("'")
+    if not cells:
+        return sheet, 1, None, 0, None
+    match = _RANGE_RE.match(cells.upper())
+    if not match:
+        raise ValueError(f"Unable to parse range: {range_name}")
+    first_col, first_row, last_col, last_row = match.groups()
+    if last_col is None and last_row is None:
+        # A single cell such as F5
+        last_col, last_row = first_col, first_row
+    return (
+        sheet,
+        int(first_row) if first_row else 1,
+        int(last_row) if last_row else None,
+        _column_index(first_col) if first_col else 0,
+        _column_index(last_col) if last_col else None,
+    )
+
+
+def http_error(status, reason, message=None):
+    """HttpError as googleapiclient raises it for a failed request."""
+    response = httplib2.Response({'status': status, 'reason': reason})
+    response.reason = reason
+    content = json.dumps({'error': {'code': status, 'message': message or reason, 'status': reason}})
+    return HttpError(response, content.encode(), uri='https://sheets.googleapis.com/v4/spreadsheets')
+
+
+class _Request:
+    """Deferred call, run by ``execute()`` like a googleapiclient HttpRequest."""
+
+    def __init__(self, fake, method, handler, rows=0):
+        self._fake = fake
+        self._method = method
+        self._handler = handler
+        self._rows = rows
+
+    def execute(self, num_retries=0):
+        return self._fake._execute(self._method, self._handler, self._rows)
+
+
+class _Values:
+    """The ``spreadsheets().values()`` collection."""
+
+    def __init__(self, fake):
+        self._fake = fake
+
+    def get(self, spreadsheetId, range, valueRenderOption='FORMATTED_VALUE',
+            dateTimeRenderOption='SERIAL_NUMBER', **kwargs):
+        return _Request(self._fake, 'values.get',
+                        lambda: self._fake._get(range, valueRenderOption, dateTimeRenderOption))
+
+    def append(self, spreadsheetId, range, body, valueInputOption='USER_ENTERED', **kwargs):
+        values = body.get('values', [])
+        return _Request(self._fake, 'values.append',
+                        lambda: self._fake._append(range, values, valueInputOption), len(values))
+
+    def update(self, spreadsheetId, range, body, valueInputOption='USER_ENTERED', **kwargs):
+        values = body.get('values', [])
+        return _Request(self._fake, 'values.update',
+                        lambda: self._fake._update(range, values, valueInputOption), len(values))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        data = body.get('data', [])
+        input_option = body.get('valueInputOption', 'USER_ENTERED')
+        return _Request(self._fake, 'values.batchUpdate',
+                        lambda: self._fake._batch_update(data, input_option),
+                        sum(len(item.get('values', [])) for item in data))
+
+    def clear(self, spreadsheetId, range, body=None, **kwargs):
+        return _Request(self._fake, 'values.clear', lambda: self._fake._clear(range))
+
+
+class FakeSheets:
+    """Fake ``spreadsheets()`` resource with row state, latency, errors and quota.
+
+    ``latency`` is slept for every request and ``row_latency`` for every row
+    read or written, so full reads cost more than tail reads as they do over
+    the network. ``error_rate`` fails that share of requests with a 503;
+    ``fail_next`` queues specific failures. With ``quota`` set, requests beyond
+    that many per ``quota_window`` seconds get a 429 like the real per-minute
+    limit. ``calls`` records (method, range) for every executed request.
+    """
+
+    def __init__(self, latency=0.0, row_latency=0.0, error_rate=0.0, quota=None,
+                 quota_window=60.0, seed=0, clock=time.monotonic, sleep=time.sleep):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.error_rate = error_rate
+        self.quota = quota
+        self.quota_window = quota_window
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = []
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._sheets = {}
+        self._row_counts = {}
+        self._sheet_ids = {}
+        self._failures = []
+        self._request_times = []
+
+    # Setup and inspection
+
+    def set_values(self, sheet, rows, value_input_option='USER_ENTERED'):
+        """Replace the content of ``sheet`` with ``rows`` (the first one is row 1)."""
+        with self._lock:
+            self._sheets[sheet] = [self._enter_row(row, value_input_option) for row in rows]
+            self._row_counts[sheet] = max(DEFAULT_ROW_COUNT, len(rows))
+
+    def values_of(self, sheet):
+        """Formatted content of ``sheet`` as the API would return it."""
+        with self._lock:
+            return self._get(sheet, 'FORMATTED_VALUE', 'SERIAL_NUMBER').get('values', [])
+
+    def fail_next(self, status=500, reason='backendError', times=1, method=None):
+        """Fail the next ``times`` requests (of ``method`` only, if given)."""
+        with self._lock:
+            self._failures.extend([(method, status, reason)] * times)
+
+    def call_count(self, method=None):
+        return sum(1 for name, _ in self.calls if method is None or name == method)
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = []
+            self._request_times = []
+
+    # The spreadsheets() resource
+
+    def values(self):
+        return _Values(self)
+
+    def get(self, spreadsheetId, ranges=None, fields=None, **kwargs):
+        return _Request(self, 'get', lambda: self._metadata(ranges))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        return _Request(self, 'batchUpdate', lambda: self._spreadsheet_batch_update(body.get('requests', [])))
+
+    # Request execution
+
+    def _execute(self, method, handler, rows):
+        with self._lock:
+            error = self._injected_error(method)
+        if self.latency:
+            self.sleep(self.latency)
+        if error is not None:
+            raise error
+        with self._lock:
+            result = handler()
+        if self.row_latency:
+            rows = rows or len(result.get('values', []))
+            self.sleep(self.row_latency * rows)
+        return result
+
+    def _injected_error(self, method):
+        now = self.clock()
+        if self.quota is not None:
+            self._request_times = [at for at in self._request_times if at > now - self.quota_window]
+            if len(self._request_times) >= self.quota:
+                self.calls.append((method, 'quota'))
+                return http_error(429, 'RATE_LIMIT_EXCEEDED', 'Quota exceeded for quota metric')
+            self._request_times.append(now)
+        for index, (failing_method, status, reason) in enumerate(self._failures):
+            if failing_method is None or failing_method == method:
+                del self._failures[index]
+                self.calls.append((method, 'error'))
+                return http_error(status, reason)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.calls.append((method, 'error'))
+            return http_error(503, 'UNAVAILABLE', 'The service is currently unavailable.')
+        return None
+
+    # Handlers, called with the lock held
+
+    def _get(self, range_name, render_option, date_option):
+        sheet, first_row, last_row, first_col, last_col = parse_range(range_name)
+        self.calls.append(('values.get', range_name))
+        rows = self._sheets.get(sheet, [])
+        end = len(rows) if last_row is None else min(last_row, len(rows))
+        values = []
+        for row in rows[first_row - 1:end]:
+            cells = row[first_col:None if last_col is None else last_col + 1]
+            values.append([self._render(cell, render_option, date_option) for cell in cells])
+        for row in values:
+            while row and row[-1] == '':
+                row.pop()
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': range_name, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def _append(self, range_name, values, input_option):
+        sheet, _, _, first_col, _ = parse_range(range_name)
+        self.calls.append(('values.append', range_name))
+        rows = self._sheets.setdefault(sheet, [])
+        # Appends land after the last non-empty row of the table
+        while rows and not any(cell != '' for cell in rows[-1]):
+            rows.pop()
+        first = len(rows) + 1
+        self._write(sheet, first, first_col, values, input_option)
+        width = max((len(row) for row in values), default=1)
+        updated = f'{sheet}!{_column_letters(first_col)}{first}:{_column_letters(first_col + width - 1)}{first + len(values) - 1}'
+        return {
+            'spreadsheetId': 'fake',
+            'tableRange': f'{sheet}!A1:{_column_letters(first_col + width - 1)}{first - 1}',
+            'updates': {'updatedRange': updated, 'updatedRows': len(values),
+                        'updatedCells': sum(len(row) for row in values)},
+        }
+
+    def _update(self, range_name, values, input_option):
+        sheet, first_row, _, first_col, _ = parse_range(range_name)
+        self.calls.append(('values.update', range_name))
+        self._write(sheet, first_row, first_col, values, input_option)
+        return {'updatedRange': range_name, 'updatedRows': len(values),
+                'updatedCells': sum(len(row) for row in values)}
+
+    def _batch_update(self, data, input_option):
+        self.calls.append(('values.batchUpdate', ','.join(item['range'] for item in data)))
+        responses = []
+        for item in data:
+            sheet, first_row, _, first_col, _ = parse_range(item['range'])
+            self._write(sheet, first_row, first_col, item.get('values', []), input_option)
+            responses.append({'updatedRange': item['range'], 'updatedRows': len(item.get('values', []))})
+        return {'totalUpdatedRows': sum(r['updatedRows'] for r in responses), 'responses': responses}
+
+    def _clear(self, range_name):
+        sheet, first_row, last_row, first_col, last_col = parse_range(range_name)
+        self.calls.append(('values.clear', range_name))
+        rows = self._sheets.get(sheet, [])
+        end = len(rows) if last_row is None else min(last_row, len(rows))
+        for row in rows[first_row - 1:end]:
+            stop = len(row) if last_col is None else min(last_col + 1, len(row))
+            for column in range(first_col, stop):
+                row[column] = ''
+        return {'clearedRange': range_name}
+
+    def _metadata(self, ranges):
+        self.calls.append(('get', ','.join(ranges or [])))
+        names = [parse_range(name)[0] for name in ranges] if ranges else list(self._sheets)
+        return {'sheets': [{'properties': {
+            'sheetId': self._sheet_id(name),
+            'title': name,
+            'gridProperties': {'rowCount': self._row_counts.get(name, DEFAULT_ROW_COUNT),
+                               'columnCount': DEFAULT_COLUMN_COUNT},
+        }} for name in names]}
+
+    def _spreadsheet_batch_update(self, requests):
+        self.calls.append(('batchUpdate', ','.join(name for request in requests for name in request)))
+        replies = []
+        for request in requests:
+            if 'addSheet' in request:
+                title = request['addSheet']['properties']['title']
+                if title in self._sheets:
+                    raise http_error(400, 'INVALID_ARGUMENT', f'A sheet with the name "{title}" already exists.')
+                self._sheets[title] = []
+                self._row_counts[title] = DEFAULT_ROW_COUNT
+                replies.append({'addSheet': {'properties': {'sheetId': self._sheet_id(title), 'title': title}}})
+            elif 'deleteDimension' in request:
+                target = request['deleteDimension']['range']
+                if target.get('dimension') != 'ROWS':
+                    raise http_error(400, 'INVALID_ARGUMENT', 'Only row deletion is supported')
+                title = next(name for name in self._sheets if self._sheet_id(name) == target['sheetId'])
+                del self._sheets[title][target['startIndex']:target['endIndex']]
+                self._row_counts[title] -= target['endIndex'] - target['startIndex']
+                replies.append({})
+            else:
+                raise http_error(400, 'INVALID_ARGUMENT', f'Unsupported request: {list(request)}')
+        return {'spreadsheetId': 'fake', 'replies': replies}
+
+    def _sheet_id(self, title):
+        return self._sheet_ids.setdefault(title, len(self._sheet_ids))
+
+    def _write(self, sheet, first_row, first_col, values, input_option):
+        rows = self._sheets.setdefault(sheet, [])
+        for offset, row in enumerate(values):
+            index = first_row - 1 + offset
+            while len(rows) <= index:
+                rows.append([])
+            target = rows[index]
+            cells = self._enter_row(row, input_option)
+            if len(target) < first_col + len(cells):
+                target.extend([''] * (first_col + len(cells) - len(target)))
+            target[first_col:first_col + len(cells)] = cells
+        self._row_counts[sheet] = max(self._row_counts.get(sheet, DEFAULT_ROW_COUNT), len(rows))
+
+    # Cell values
+
+    @staticmethod
+    def _enter_row(row, input_option):
+        if input_option == 'RAW':
+            return ['' if cell is None else cell for cell in row]
+        return [FakeSheets._enter(cell) for cell in row]
+
+    @staticmethod
+    def _enter(cell):
+        """Parse a cell the way USER_ENTERED does: numbers and dates become typed."""
+        if cell is None:
+            return ''
+        if not isinstance(cell, str):
+            return cell
+        text = cell.strip()
+        if _NUMBER_RE.match(text):
+            return float(text)
+        try:
+            return datetime.strptime(text, DATE_FORMAT)
+        except ValueError:
+            return cell
+
+    @staticmethod
+    def _render(cell, render_option, date_option):
+        if isinstance(cell, datetime):
+            if render_option == 'FORMATTED_VALUE' or date_option == 'FORMATTED_STRING':
+                return cell.strftime(DATE_FORMAT)
+            return (cell - SHEETS_EPOCH) / timedelta(days=1)
+        if isinstance(cell, float):
+            if render_option == 'FORMATTED_VALUE':
+                return f'{cell:.15g}'
+            return int(cell) if cell.is_integer() else cell
+        return cell
+
+
+def generate_spendings(count, end=None, per_day=5, categories=None, seed=0):
+    """Header plus ``count`` chronological spending rows ending at ``end``."""
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    categories = categories or ['🛒 Продукты', '🚇 Транспорт', '🍔 Еда вне дома', '🏠 Аренда', '🌎 Прочее']
+    step = timedelta(days=1) / per_day
+    rows = [['year', 'month', 'date', 'sum', 'comment', 'category']]
+    for index in range(count):
+        moment = end - step * (count - 1 - index)
+        rows.append([
+            moment.strftime('%Y'),
+            moment.strftime('%m %B').lower(),
+            moment.strftime(DATE_FORMAT),
+            f'{rng.randint(100, 10000) / 100:.2f}',
+            f'item {index}',
+            rng.choice(categories),
+        ])
+    return rows
@@ -1,12 +1,18 @@
+import asyncio
 import pytest
 import sys
 import os
-from unittest.mock import Mock, patch, MagicMock
-from datetime import datetime
+import time
+from unittest.mock import AsyncMock, Mock, patch, MagicMock
+from collections import deque
+from datetime import datetime, timedelta
 
 # Add the project root to the path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import main
+import metrics
+import scheduler
 import responses
 import spendings
 
@@ -76,6 +82,125 @@ class TestResponses:
         mock_total.assert_called_once()
         assert "€ 1000.00" in result
 
+    @patch('spendings.save_spendings')
+    def test_sample_responses_multiple_expenses(self, mock_save_many):
+        """Test that a multi-line message is saved in one bulk call"""
+        mock_save_many.return_value = [
+            ("55 аренда", "Spending saved. Don't forget to choose Category", 7),
+            ("35 перевод", "Spending saved. Don't forget to choose Category", 8),
+        ]
+        result = responses.sample_responses("55 аренда\n35 перевод")
+        mock_save_many.assert_called_once_with(["55 аренда", "35 перевод"])
+        assert "Processed 2/2 expenses (Total: 90.00)" in result
+        assert list(responses.chat_states.get(responses.DEFAULT_CHAT_ID).pending) == [("55 аренда", 7), ("35 перевод", 8)]
+
+    @patch('spendings.update_spending_categories')
+    def test_categories_for_batch_written_once(self, mock_update_many):
+        """Test that category choices for a batch are flushed in one request"""
+        mock_update_many.return_value = "Categories updated for 2 spendings"
+        responses.chat_states.get(responses.DEFAULT_CHAT_ID).pending.extend(
+            [responses.PendingExpense("55 аренда", 7), responses.PendingExpense("35 перевод", 8)])
+
+        result = responses.sample_responses("🏠 Аренда")
+        assert "Next expense: '35 перевод'" in result
+        mock_update_many.assert_not_called()
+
+        result = responses.sample_responses("🌎 Прочее")
+        assert "All expenses have been categorized" in result
+        mock_update_many.assert_called_once_with([(7, "🏠 Аренда"), (8, "🌎 Прочее")])
+
+    @patch('spendings.update_spending_categories')
+    def test_buffered_categories_flushed_on_demand(self, mock_update_many):
+        """Test that an explicit flush (idle timer, shutdown) writes what is buffered"""
+        responses.chat_states.get(responses.DEFAULT_CHAT_ID).pending.extend(
+            [responses.PendingExpense("55 аренда", 7), responses.PendingExpense("35 перевод", 8)])
+        responses.sample_responses("🏠 Аренда")
+
+        responses.flush_pending_categories()
+        mock_update_many.assert_called_once_with([(7, "🏠 Аренда")])
+        assert responses.chat_states.get(responses.DEFAULT_CHAT_ID).assigned == []
+
+    @patch('spendings.update_spending_categories')
+    def test_failed_category_flush_is_retried(self, mock_update_many):
+        """Test that choices which failed to write go back to the chat and are written later"""
+        mock_update_many.return_value = "Error updating categories: timeout"
+        responses.chat_states.get(responses.DEFAULT_CHAT_ID).pending.extend(
+            [responses.PendingExpense("55 аренда", 7), responses.PendingExpense("35 перевод", 8)])
+        responses.sample_responses("🏠 Аренда")
+
+        result = responses.sample_responses("🌎 Прочее")
+        assert "will be written again" in result
+        state = responses.chat_states.get(responses.DEFAULT_CHAT_ID)
+        assert state.assigned == [(7, "🏠 Аренда"), (8, "🌎 Прочее")]
+        assert state.flush_timer is not None
+
+        mock_update_many.return_value = "Categories updated for 2 spendings"
+        responses.flush_pending_categories()
+        mock_update_many.assert_called_with([(7, "🏠 Аренда"), (8, "🌎 Прочее")])
+        assert responses.chat_states.get(responses.DEFAULT_CHAT_ID).assigned == []
+
+    def test_undo_in_a_batch_drops_its_pending_expense(self, fake_sheets):
+        """Test that a category pressed after undoing the newest expense of a batch is not written to its row"""
+        responses.sample_responses("5 хлеб\n7 молоко\n3 чай")
+        responses.sample_responses("🛒 Продукты")
+        responses.sample_responses("🛒 Продукты")
+        assert "deleted successfully" in responses.sample_responses("❌ Отмена")
+        assert responses.chat_states.get(responses.DEFAULT_CHAT_ID).pending == deque()
+
+        responses.sample_responses("🚇 Транспорт")
+        responses.flush_pending_categories()
+        rows = [row for row in fake_sheets.values_of(spendings.SHEET_NAME) if any(row)]
+        assert all(row[2] for row in rows)
+        assert rows[-1][4:] == ['молоко', '🚇 Транспорт']
+
+    @patch('spendings.save_spendings')
+    @patch('spendings.update_spending_categories')
+    def test_pending_expenses_are_per_chat(self, mock_update_many, mock_save_many):
+        """Test that a batch in one chat does not wipe the queue of another chat"""
+        mock_save_many.side_effect = lambda lines: [
+            (line, "Spending saved. Don't forget to choose Category", row)
+            for row, line in enumerate(lines, start=10)
+        ]
+        responses.sample_responses("5 хлеб\n7 молоко", chat_id=1)
+        responses.sample_responses("40 такси\n12 кофе", chat_id=2)
+
+        result = responses.sample_responses("🛒 Продукты", chat_id=1)
+        assert "assigned to '5 хлеб'" in result
+        result = responses.sample_responses("🚇 Транспорт", chat_id=2)
+        assert "assigned to '40 такси'" in result
+
+    @patch('spendings.update_spending_categories')
+    def test_idle_chat_state_expires_and_flushes(self, mock_update_many):
+        """Test that TTL eviction drops idle chats after writing their categories"""
+        store = responses.ChatStateStore(ttl=0.05, max_chats=10)
+        store.buffer_category(1, responses.CategoryAssignment(7, "🏠 Аренда"), responses.flush_pending_categories)
+        time.sleep(0.1)
+
+        store.get(2)
+        assert store.chat_ids() == [2]
+        mock_update_many.assert_called_once_with([(7, "🏠 Аренда")])
+
+    def test_idle_flush_runs_on_the_executor(self):
+        """Test that the idle timer hands the flush to the shared thread pool"""
+        executor = Mock()
+        store = responses.ChatStateStore(executor=executor)
+        flush = Mock()
+        with patch('responses.CATEGORY_FLUSH_DELAY', 0.01):
+            store.buffer_category(1, responses.CategoryAssignment(7, "🏠 Аренда"), flush)
+        deadline = time.monotonic() + 5
+        while not executor.submit.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        executor.submit.assert_called_once_with(flush, 1)
+        flush.assert_not_called()
+
+    @patch('spendings.update_spending_categories')
+    def test_chat_states_are_bounded(self, mock_update_many):
+        """Test that the least recently used chat is evicted beyond the bound"""
+        store = responses.ChatStateStore(ttl=3600, max_chats=2)
+        for chat_id in (1, 2, 3):
+            store.get(chat_id)
+        assert store.chat_ids() == [2, 3]
+
     def test_sample_responses_unrecognized_message(self):
         """Test unrecognized message handling"""
         result = responses.sample_responses("some random message")
@@ -121,6 +246,40 @@ class TestSpendings:
         assert "Spending saved" in result
         mock_sheet.values().append.assert_called_once()
 
+    @patch('spendings.get_sheet_service')
+    def test_save_spendings_single_append(self, mock_service):
+        """Test that several lines are saved with one append and numbered from updatedRange"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+        mock_values.append.return_value.execute.return_value = {
+            'updates': {'updatedRange': 'Spendings!A10:F11'}
+        }
+
+        result = spendings.save_spendings(["10 coffee", "oops tea", "5.5 bread"])
+
+        mock_values.append.assert_called_once()
+        sent = mock_values.append.call_args.kwargs['body']['values']
+        assert [row[3:5] for row in sent] == [['10', 'coffee'], ['5.5', 'bread']]
+        assert result[0][2] == 10
+        assert "Invalid amount" in result[1][1] and result[1][2] is None
+        assert result[2][2] == 11
+
+    @patch('spendings.get_sheet_service')
+    def test_update_spending_categories_batch(self, mock_service):
+        """Test that several categories are written with a single batchUpdate"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+
+        result = spendings.update_spending_categories([(7, "🏠 Аренда"), (8, "🌎 Прочее")])
+
+        assert "Categories updated for 2" in result
+        mock_values.batchUpdate.assert_called_once()
+        data = mock_values.batchUpdate.call_args.kwargs['body']['data']
+        assert [item['range'] for item in data] == ['Spendings!F7', 'Spendings!F8']
+        mock_values.update.assert_not_called()
+
     def test_save_spending_invalid_amount(self):
         """Test saving with invalid amount"""
         result = spendings.save_spending("invalid coffee")
@@ -152,6 +311,29 @@ class TestSpendings:
         assert "Test" in result
         assert "10.5" in result
 
+    def test_format_report_layout_and_total(self):
+        """Test day report lines, skipped undated rows and a loop-identical total"""
+        import pandas as pd
+
+        report_df = pd.DataFrame({
+            'date': pd.to_datetime(['2026-01-05 10:00:00', None, '2026-01-07 10:00:00']),
+            'category': ['🛒 Продукты', 'x', 'Test'],
+            'sum': ['10.50', '1', '0.2'],
+            'comment': ['bread', 'y', 'coffee']
+        })
+        result = spendings.format_report(report_df, '€')
+        assert result == ("пн. 🛒 Продукты €10.50 bread\n"
+                          "ср. Test       €0.2  coffee\n"
+                          "Total: 10.7 €")
+
+    def test_format_month_report_lines(self):
+        """Test category totals formatting for the month report"""
+        import pandas as pd
+
+        report_df = pd.DataFrame({'category': ['a', 'b', 'c'], 'sum': [0.1, 0.2, 10.0]})
+        result = spendings.format_month_report(report_df, '€')
+        assert result.split('\n')[1:] == ['a €0.1', 'b €0.2', 'c €10.0', 'Total: 10.3 €']
+
     @patch('spendings.get_sheet_service')
     def test_update_last_spending_category_success(self, mock_service):
         """Test successful category update"""
@@ -201,6 +383,1412 @@ class TestSpendings:
         assert spendings.get_day_abbreviation('Invalid') == 'Invalid'
 
 
+class TestTypedFrame:
+    """Test cases for the schema-normalized spending frame"""
+
+    def test_normalize_spendings_dtypes(self, sample_spending_data):
+        """Test that sheet strings are parsed once into compact dtypes"""
+        import pandas as pd
+
+        df = pd.DataFrame(sample_spending_data[1:], columns=sample_spending_data[0])
+        typed = spendings.normalize_spendings(df)
+
+        assert pd.api.types.is_datetime64_any_dtype(typed['date'])
+        assert typed['sum'].dtype == 'float64'
+        assert isinstance(typed['category'].dtype, pd.CategoricalDtype)
+        assert typed['year'].tolist() == [2026, 2026, 2026]
+        assert typed['month'].tolist() == [1, 1, 1]
+        assert spendings.normalize_spendings(typed) is typed
+
+    def test_normalize_spendings_falls_back_to_cells_without_date(self):
+        """Test that rows with an unreadable date still get year and month"""
+        import pandas as pd
+
+        df = pd.DataFrame([['2025', '12 december', 'garbage', '1,5', 'x', 'a']], columns=spendings.SPENDING_COLUMNS)
+        typed = spendings.normalize_spendings(df)
+        assert typed['year'].tolist() == [2025]
+        assert typed['month'].tolist() == [12]
+        assert typed['sum'].isna().all()
+
+    @patch('spendings.get_sheet_service')
+    def test_raw_value_reads(self, mock_service):
+        """Test that unformatted numbers and serial dates load without string parsing"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_get = mock_sheet.values.return_value.get
+        # 46029.5 is 2026-01-07 12:00:00
+        mock_get.return_value.execute.side_effect = [{'values': [
+            spendings.SPENDING_COLUMNS,
+            [2026, '01 january', 46029.5, 8.5, 'coffee', '🍔 Еда вне дома'],
+            ['2026', '01 january', '2026-01-08 09:00:00', '3', 'bun', ''],
+        ]}, {}]
+
+        df = spendings.load_data_from_google_sheets()
+
+        assert mock_get.call_args.kwargs['valueRenderOption'] == 'UNFORMATTED_VALUE'
+        assert mock_get.call_args.kwargs['dateTimeRenderOption'] == 'SERIAL_NUMBER'
+        assert [str(value) for value in df['date']] == ['2026-01-07 12:00:00', '2026-01-08 09:00:00']
+        assert df['sum'].tolist() == [8.5, 3.0]
+        # The uncategorized bun counts towards the balance, not the category totals
+        rollup = spendings.load_rollup()
+        assert rollup.categories_for(2026, 1) == [('🍔 Еда вне дома', 8.5)]
+        assert rollup.total_cents == 1150
+
+    @patch('spendings.get_sheet_service')
+    def test_total_amount_raw_number(self, mock_service):
+        """Test that an unformatted balance cell is formatted directly"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_sheet.values().get().execute.return_value = {'values': [[1234.5]]}
+
+        assert spendings.get_total_amount() == "€ 1234.50"
+
+    @patch('spendings.load_data_from_google_sheets')
+    def test_week_report_on_typed_frame(self, mock_load):
+        """Test that week reports compare typed dates and show whole amounts as entered"""
+        import pandas as pd
+
+        now = datetime.now()
+        mock_load.return_value = spendings.normalize_spendings(pd.DataFrame([
+            ['2026', '01 january', (now - timedelta(days=8)).strftime('%Y-%m-%d %H:%M:%S'), '9', 'old', 'a'],
+            ['2026', '01 january', now.strftime('%Y-%m-%d %H:%M:%S'), '5', 'tea', 'b'],
+        ], columns=spendings.SPENDING_COLUMNS))
+
+        result = spendings.get_report('📊 Неделя')
+        assert 'old' not in result
+        assert '€5    tea' in result
+        assert result.endswith('Total: 5.0 €')
+
+
+class TestSheetReplica:
+    """Test cases for the in-memory replica of the Spendings sheet"""
+
+    def test_uncategorized_rows_read_the_same_after_a_reload(self, fake_sheets):
+        """Test that a saved row's empty category and a reloaded row's missing cell give one report"""
+        spendings.get_report('📊 Месяц')
+        spendings.save_spending("4.20 bus")
+        saved = spendings.get_report('📊 Месяц')
+        spendings.reset_caches()
+        assert spendings.get_report('📊 Месяц') == saved
+        assert '\n €' not in saved
+
+    def test_identical_rows_are_found_by_occurrence(self, fake_sheets):
+        """Test that two equal rows sent in one batch are found at two different sheet rows"""
+        rows = spendings.save_spendings(["5 coffee", "5 coffee"])
+        coffee = fake_sheets.values_of(spendings.SHEET_NAME)[rows[0][2] - 1]
+        assert spendings._find_rows([coffee, coffee, coffee]) == [rows[0][2], rows[1][2], None]
+
+    @patch('spendings.get_sheet_service')
+    def test_second_load_fetches_only_new_rows(self, mock_service, sample_spending_data):
+        """Test that a warm replica requests only rows after its last known row"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_get = mock_sheet.values.return_value.get
+        mock_get.return_value.execute.side_effect = [
+            {'values': sample_spending_data},
+            {'values': [['2026', '01 january', '2026-01-08 10:00:00', '3.20', 'bus', '']]},
+        ]
+
+        assert len(spendings.load_data_from_google_sheets()) == 3
+        df = spendings.load_data_from_google_sheets()
+
+        assert len(df) == 4
+        assert mock_get.call_args_list[1].kwargs['range'] == 'Spendings!A5:Z'
+
+    @patch('spendings.get_sheet_service')
+    def test_day_report_reads_only_the_tail(self, mock_service):
+        """Test that a cold day report widens a tail read until it passes the window"""
+        now = datetime.now()
+        old = (now - timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S')
+        today = now.strftime('%Y-%m-%d %H:%M:%S')
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_sheet.get.return_value.execute.return_value = {
+            'sheets': [{'properties': {'gridProperties': {'rowCount': 1000}}}]}
+        mock_get = mock_sheet.values.return_value.get
+        mock_get.return_value.execute.side_effect = [
+            {'values': [['2026', 'x', today, '5', 'tea', 'a']]},
+            {'values': [['2026', 'x', old, '9', 'old', 'b'], ['2026', 'x', today, '2', 'bun', 'a']]},
+        ]
+
+        with patch('spendings.TAIL_READ_ROWS', 10):
+            result = spendings.get_report('📊 День')
+
+        assert [call.kwargs['range'] for call in mock_get.call_args_list] == [
+            'Spendings!A991:Z', 'Spendings!A971:Z990']
+        assert 'bun' in result and 'tea' in result and 'old' not in result
+        assert not spendings._replica.loaded
+
+    def test_tail_read_past_the_data_is_remembered(self, fake_sheets):
+        """Test that once a tail read found the last data row, the next one starts there"""
+        spendings.get_report('📊 День')
+        assert fake_sheets.call_count('get') == 1
+        reads = fake_sheets.call_count('values.get')
+        assert reads > 1  # the grid is far larger than the sample data
+
+        spendings.get_report('📊 Неделя')
+        assert fake_sheets.call_count('get') == 1
+        assert fake_sheets.call_count('values.get') == reads + 1
+        assert not spendings._replica.loaded
+
+    @patch('spendings.get_sheet_service')
+    def test_tail_read_starts_at_the_last_appended_row(self, mock_service):
+        """Test that a tail read after a save starts at the appended row, not the grid size"""
+        today = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+        mock_values.append.return_value.execute.return_value = {
+            'updates': {'updatedRange': 'Spendings!A40:F40'}
+        }
+        mock_values.get.return_value.execute.return_value = {'values': [['2026', 'x', today, '5', 'tea', '']]}
+
+        spendings.save_spending("5 tea")
+        with patch('spendings.TAIL_READ_ROWS', 39):
+            spendings.get_report('📊 День')
+
+        assert [call.kwargs['range'] for call in mock_values.get.call_args_list] == ['Spendings!A2:Z']
+        mock_sheet.get.assert_not_called()
+
+    @patch('spendings.get_sheet_service')
+    def test_writes_are_applied_to_replica(self, mock_service, sample_spending_data):
+        """Test that save, category update and delete keep the replica warm"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+        mock_values.get.return_value.execute.side_effect = [{'values': sample_spending_data}, {}, {}, {}]
+        mock_values.append.return_value.execute.return_value = {
+            'updates': {'updatedRange': 'Spendings!A5:F5'}
+        }
+
+        spendings.load_data_from_google_sheets()
+        spendings.save_spending("4.00 tea")
+        spendings.update_spending_category("🛒 Продукты", 5)
+        df = spendings.load_data_from_google_sheets()
+        assert df.iloc[-1]['comment'] == 'tea'
+        assert df.iloc[-1]['category'] == '🛒 Продукты'
+
+        spendings.delete_last_spending()
+        mock_values.update.return_value.execute.assert_called()
+        assert mock_values.update.call_args.kwargs['range'] == 'Spendings!A5:F5'
+        assert len(spendings.load_data_from_google_sheets()) == 3
+
+
+class TestSpendingRollup:
+    """Test cases for the incrementally maintained report totals"""
+
+    def _row(self, when, amount, comment, category):
+        return [when.strftime('%Y'), when.strftime('%m %B').lower(), when.strftime('%Y-%m-%d %H:%M:%S'),
+                amount, comment, category]
+
+    @patch('spendings.get_sheet_service')
+    def test_month_report_follows_writes(self, mock_service):
+        """Test that save, category update and delete adjust the month totals"""
+        now = datetime.now()
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+        mock_values.get.return_value.execute.side_effect = [
+            {'values': [spendings.SPENDING_COLUMNS,
+                        self._row(now, '10.50', 'bread', '🛒 Продукты'),
+                        self._row(now - timedelta(days=400), '99', 'old', '🛒 Продукты')]},
+        ] + [{}] * 5
+        mock_values.append.return_value.execute.return_value = {'updates': {'updatedRange': 'Spendings!A4:F4'}}
+
+        assert spendings.get_report('📊 Месяц').split('\n')[1:] == ['🛒 Продукты €10.5', 'Total: 10.5 €']
+
+        spendings.save_spending("4.20 bus")
+        spendings.update_spending_category('🚇 Транспорт', 4)
+        assert spendings.get_report('📊 Год').split('\n')[1:] == [
+            '🚇 Транспорт €4.2', '🛒 Продукты €10.5', 'Total: 14.7 €']
+
+        spendings.delete_last_spending()
+        assert spendings.get_report('📊 Месяц').split('\n')[1:] == ['🛒 Продукты €10.5', 'Total: 10.5 €']
+
+    def test_rollup_ignores_unparseable_rows(self):
+        """Test that rows without a numeric amount or category do not count"""
+        rollup = spendings.SpendingRollup()
+        rollup.add(['2026', '01 january', '2026-01-07 10:00:00', 'abc', 'x', 'a'])
+        rollup.add(['2026', '01 january', '2026-01-07 10:00:00', '5'])
+        rollup.add(['2026', '01 january', '2026-01-07 10:00:00', '0.1', 'x', 'a'])
+        rollup.add(['2026', '01 january', '2026-01-07 10:00:00', '0.2', 'x', 'a'])
+        assert rollup.categories_for(2026, 1) == [('a', 0.3)]
+        assert rollup.total_for_days(datetime(2026, 1, 7).date(), datetime(2026, 1, 7).date()) == 5.3
+
+
+class TestReportCache:
+    """Test cases for cached reports and their invalidation"""
+
+    @patch('spendings._build_report')
+    def test_repeated_report_is_served_from_cache(self, mock_build):
+        """Test that a second identical request does not rebuild the report"""
+        mock_build.return_value = "2026.01\nTotal: 0 €"
+        assert spendings.get_report('📊 Месяц') == spendings.get_report('📊 Месяц')
+        mock_build.assert_called_once()
+
+    @patch('spendings._build_report')
+    def test_errors_are_not_cached(self, mock_build):
+        """Test that failed reports are retried on the next request"""
+        mock_build.return_value = "Error generating report: timeout"
+        spendings.get_report('📊 Месяц')
+        spendings.get_report('📊 Месяц')
+        assert mock_build.call_count == 2
+
+    @patch('spendings._build_report')
+    def test_report_built_across_a_write_is_not_cached(self, mock_build):
+        """Test that a report which may have missed a write is rebuilt on the next request"""
+        def build_during_write(text):
+            spendings._report_cache.record_write()
+            return "2026.01\nTotal: 0 €"
+        mock_build.side_effect = build_during_write
+        spendings.get_report('📊 Месяц')
+        mock_build.side_effect = None
+        mock_build.return_value = "2026.01\nTotal: 5 €"
+        assert spendings.get_report('📊 Месяц') == "2026.01\nTotal: 5 €"
+        assert spendings.get_report('📊 Месяц') == "2026.01\nTotal: 5 €"
+        assert mock_build.call_count == 2
+
+    def test_write_invalidates_only_affected_buckets(self):
+        """Test that a change on one day keeps reports for other periods"""
+        cache = spendings.ReportCache()
+        today = datetime(2026, 3, 10).date()
+        cache.put('📊 День', today, 'day')
+        cache.put('📊 Неделя', today, 'week')
+        cache.put('📊 Месяц', today, 'month')
+        cache.put('📊 Год', today, 'year')
+        cache.put('📊 Месяц', datetime(2026, 2, 1).date(), 'february')
+
+        cache.invalidate(datetime(2026, 3, 5).date())
+
+        assert cache.get('📊 День', today) == 'day'
+        assert cache.get('📊 Неделя', today) is None
+        assert cache.get('📊 Месяц', today) is None
+        assert cache.get('📊 Год', today) is None
+        assert cache.get('📊 Месяц', datetime(2026, 2, 1).date()) == 'february'
+
+    def test_undo_and_category_keep_reports_of_other_periods(self, fake_sheets):
+        """Test that a category press and an undo only drop the reports covering their spending"""
+        spendings.load_data_from_google_sheets()
+        spendings.save_spending("4.20 bus")
+        february = datetime(2020, 2, 1).date()
+        spendings._report_cache.put('📊 Месяц', february, 'february')
+
+        spendings.update_last_spending_category('🚇 Транспорт')
+        spendings.update_spending_categories([(spendings._row_tracker.peek(), '🌎 Прочее')])
+        spendings.delete_last_spending()
+        assert spendings._report_cache.get('📊 Месяц', february) == 'february'
+
+    def test_cache_entries_expire(self):
+        """Test TTL and LRU eviction"""
+        cache = spendings.ReportCache(max_entries=1, ttl=0.05)
+        today = datetime(2026, 3, 10).date()
+        cache.put('📊 День', today, 'day')
+        cache.put('📊 Год', today, 'year')
+        assert cache.get('📊 День', today) is None
+        time.sleep(0.1)
+        assert cache.get('📊 Год', today) is None
+
+    def test_balance_follows_saves_without_reading_pivot(self, fake_sheets):
+        """Test that a save changes the balance without another Pivot read"""
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '1234.56']])
+
+        assert spendings.get_total_amount() == "€ 1234.56"
+        reads = fake_sheets.call_count('values.get')
+        spendings.save_spending("4.20 bus")
+        assert spendings.get_total_amount() == "€ 1230.36"
+        assert fake_sheets.call_count('values.get') == reads
+
+
+class TestRowTracker:
+    """Test cases for undo and last-category without reading the sheet"""
+
+    @patch('spendings.get_sheet_service')
+    def test_multi_level_undo_without_reads(self, mock_service):
+        """Test that saved rows are undone newest first with one write each"""
+        mock_sheet = Mock()
+        mock_service.return_value = mock_sheet
+        mock_values = mock_sheet.values.return_value
+        mock_values.append.return_value.execute.side_effect = [
+            {'updates': {'updatedRange': 'Spendings!A5:F5'}},
+            {'updates': {'updatedRange': 'Spendings!A6:F6'}},
+        ]
+
+        spendings.save_spending("4.00 tea")
+        spendings.save_spending("2.50 bun")
+        spendings.update_last_spending_category("🍔 Еда вне дома")
+        assert mock_values.update.call_args.kwargs['range'] == 'Spendings!F6'
+
+        spendings.delete_last_spending()
+        assert mock_values.update.call_args.kwargs['range'] == 'Spendings!A6:F6'
+        spendings.delete_last_spending()
+        assert mock_values.update.call_args.kwargs['range'] == 'Spendings!A5:F5'
+        mock_values.get.assert_not_called()
+
+    def test_tracker_is_bounded(self):
+        """Test that the undo stack keeps only the newest rows"""
+        tracker = spendings.RowTracker(depth=2)
+        for row_number in (5, 6, 7):
+            tracker.push(row_number)
+        assert tracker.pop() == 7
+        assert tracker.pop() == 6
+        assert tracker.pop() is None
+
+
+class TestWriteBehindJournal:
+    """Test cases for the write-behind journal in journal.py"""
+
+    def _row(self, amount, comment):
+        return ['2026', '01 january', '2026-01-07 10:00:00', amount, comment, '']
+
+    def test_flush_sends_batch_with_categories(self, tmp_path):
+        """Test that journaled rows are sent in one batch, with categories chosen before the flush"""
+        from journal import SpendingJournal
+        flush_rows = Mock(return_value=20)
+        journal = SpendingJournal(str(tmp_path / 'journal.db'), flush_rows)
+
+        first, second = journal.append_many([self._row('5', 'bread'), self._row('7', 'milk')])
+        assert journal.set_category(first, '🛒 Продукты') is None
+
+        assert journal.flush() == 2
+        flush_rows.assert_called_once()
+        sent = flush_rows.call_args.args[0]
+        assert sent[0][5] == '🛒 Продукты' and sent[1][5] == ''
+        assert journal.resolve(second) == 21
+        assert journal.set_category(second, '🛒 Продукты') == 21
+        journal.close()
+
+    def test_entries_survive_restart(self, tmp_path):
+        """Test that unsent rows are still there for a new process"""
+        from journal import SpendingJournal
+        path = str(tmp_path / 'journal.db')
+        journal = SpendingJournal(path, Mock(side_effect=Exception("offline")))
+        journal.append(self._row('5', 'bread'))
+        with pytest.raises(Exception):
+            journal.flush()
+        journal.close()
+
+        flush_rows = Mock(return_value=3)
+        find_rows = Mock(return_value=[None])
+        restarted = SpendingJournal(path, flush_rows, find_rows=find_rows)
+        assert restarted.pending_count() == 1
+        assert restarted.flush() == 1
+        find_rows.assert_called_once()
+        flush_rows.assert_called_once()
+        restarted.close()
+
+    def test_rows_already_in_sheet_are_not_resent(self, tmp_path):
+        """Test that a row sent before a failure is reconciled instead of duplicated"""
+        from journal import SpendingJournal
+        path = str(tmp_path / 'journal.db')
+        journal = SpendingJournal(path, Mock(side_effect=TimeoutError()))
+        ref = journal.append(self._row('5', 'bread'))
+        with pytest.raises(TimeoutError):
+            journal.flush()
+
+        journal.flush_rows = Mock()
+        journal.find_rows = Mock(return_value=[42])
+        assert journal.flush() == 0
+        journal.flush_rows.assert_not_called()
+        assert journal.resolve(ref) == 42
+        journal.close()
+
+    def test_undo_while_sending_clears_the_row_once_flushed(self, tmp_path):
+        """Test that an entry undone in flight is cleared, not resent or left in the sheet"""
+        from journal import SpendingJournal
+        clear_rows = Mock()
+        journal = SpendingJournal(str(tmp_path / 'journal.db'), Mock(), clear_rows=clear_rows)
+        ref = journal.append(self._row('5', 'bread'))
+
+        def flush_rows(values):
+            assert journal.last_unsent() == ref
+            assert journal.discard(ref)
+            assert journal.last_unsent() is None and journal.pending_count() == 1
+            return 7
+        journal.flush_rows = flush_rows
+        assert journal.flush() == 1
+        clear_rows.assert_called_once_with([7])
+        assert journal.set_category(ref, '🛒 Продукты') is None
+        journal.flush()
+        clear_rows.assert_called_once()
+        journal.close()
+
+    def test_undo_of_a_lost_send_is_not_resent(self, tmp_path):
+        """Test that an entry undone after a failed send is dropped if it never reached the sheet"""
+        from journal import SpendingJournal
+        journal = SpendingJournal(str(tmp_path / 'journal.db'), Mock(side_effect=TimeoutError()),
+                                  find_rows=Mock(return_value=[None]), clear_rows=Mock())
+        ref = journal.append(self._row('5', 'bread'))
+        with pytest.raises(TimeoutError):
+            journal.flush()
+        assert journal.discard(ref)
+
+        journal.flush_rows = Mock()
+        assert journal.flush() == 0
+        journal.flush_rows.assert_not_called()
+        assert journal.pending_count() == 0
+        journal.close()
+
+    def test_undo_and_category_while_sending_touch_the_sent_row(self, fake_sheets, tmp_path, monkeypatch):
+        """Test that undo during a flush removes the expense being sent, not the one before it"""
+        monkeypatch.setattr(spendings, 'WRITE_BEHIND', True)
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        send_rows = spendings._send_rows
+        during_send = []
+
+        def sending(values):
+            for action in during_send:
+                action()
+            return send_rows(values)
+        monkeypatch.setattr(spendings, '_send_rows', sending)
+        with patch('journal.SpendingJournal.start'):
+            try:
+                spendings.save_spending("5 bread")
+                spendings.get_journal().flush()
+                spendings.save_spending("4.20 bus")
+                during_send.append(lambda: spendings.update_last_spending_category('🚇 Транспорт'))
+                spendings.get_journal().flush()
+                assert fake_sheets.values_of(spendings.SHEET_NAME)[5][4:] == ['bus', '🚇 Транспорт']
+
+                spendings.save_spending("3 tea")
+                during_send[:] = [lambda: spendings.delete_last_spending()]
+                spendings.get_journal().flush()
+                rows = fake_sheets.values_of(spendings.SHEET_NAME)
+                assert [row[4] for row in rows[4:] if any(row)] == ['bread', 'bus']
+            finally:
+                spendings.stop_journal()
+
+    def test_flushed_entries_are_pruned(self, tmp_path):
+        """Test that only the newest flushed entries are kept once they are old enough"""
+        from journal import SpendingJournal
+        journal = SpendingJournal(str(tmp_path / 'journal.db'), Mock(return_value=2), keep=1, keep_seconds=0)
+        journal.append_many([self._row('5', 'bread'), self._row('7', 'milk')])
+        journal.flush()
+        assert journal._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 1
+        journal.close()
+
+    def test_reports_and_balance_count_unflushed_rows(self, fake_sheets, tmp_path, monkeypatch):
+        """Test that rows still in the journal are in the month report and the balance"""
+        monkeypatch.setattr(spendings, 'WRITE_BEHIND', True)
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '100']])
+        with patch('journal.SpendingJournal.start'):
+            try:
+                assert spendings.get_total_amount() == "€ 100.00"
+                spendings.save_spending("4.20 bus")
+                spendings.update_last_spending_category('🚇 Транспорт')
+                assert '🚇 Транспорт €4.2' in spendings.get_report('📊 Месяц')
+                assert spendings.get_total_amount() == "€ 95.80"
+
+                spendings.get_journal().flush()
+                assert '🚇 Транспорт €4.2' in spendings.get_report('📊 Месяц')
+                assert spendings.get_total_amount() == "€ 95.80"
+            finally:
+                spendings.stop_journal()
+
+    @patch('spendings.get_sheet_service')
+    def test_write_behind_save_acknowledges_without_api_call(self, mock_service, tmp_path):
+        """Test that save_spending returns at once and undo drops the journaled row"""
+        with patch('spendings.WRITE_BEHIND', True), \
+             patch('spendings.JOURNAL_FILE', str(tmp_path / 'journal.db')), \
+             patch('journal.SpendingJournal.start'):
+            try:
+                message, ref = spendings.save_spending("4.20 bus")
+                assert "Spending saved" in message
+                assert spendings.update_spending_category("🚇 Транспорт", ref) == "Category updated for the spending"
+                assert "deleted successfully" in spendings.delete_last_spending()
+                assert spendings.get_journal().pending_count() == 0
+            finally:
+                spendings.stop_journal()
+
+
+class TestAsyncHandlers:
+    """Test cases for running blocking work off the event loop in main.py"""
+
+    def test_blocking_call_does_not_stall_event_loop(self):
+        """Test that other coroutines keep running while a slow call is awaited"""
+        import time
+
+        ticks = []
+
+        async def ticker():
+            for _ in range(3):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            slow = main.run_blocking(time.sleep, 0.2)
+            await asyncio.gather(slow, ticker())
+
+        asyncio.run(scenario())
+        assert len(ticks) == 3
+        assert ticks[-1] - ticks[0] < 0.15
+
+    @patch('responses.sample_responses')
+    def test_get_response_timeout(self, mock_responses):
+        """Test that a call exceeding the handler timeout yields a friendly message"""
+        import time
+
+        mock_responses.side_effect = lambda text, chat_id: time.sleep(0.2)
+        with patch('main.HANDLER_TIMEOUT', 0.05):
+            result = asyncio.run(main.get_response("📊 Год", 1))
+        assert "taking too long" in result
+
+
+class TestFakeSheets:
+    """Bot flows against the in-process Google Sheets stand-in"""
+
+    def test_save_categorize_and_cancel(self, fake_sheets):
+        """Test that saves, category presses and cancel change the sheet rows"""
+        result = responses.sample_responses("12.50 tea\n3 bun")
+        assert "Processed 2/2" in result
+        responses.sample_responses('🛒 Продукты')
+        responses.sample_responses('🚇 Транспорт')
+
+        rows = fake_sheets.values_of(spendings.SHEET_NAME)
+        assert rows[4][3:] == ['12.5', 'tea', '🛒 Продукты']
+        assert rows[5][3:] == ['3', 'bun', '🚇 Транспорт']
+        assert fake_sheets.call_count('values.append') == 1
+        assert fake_sheets.call_count('values.batchUpdate') == 1
+
+        assert responses.sample_responses('❌ Отмена') == "Last spending entry deleted successfully"
+        assert len(fake_sheets.values_of(spendings.SHEET_NAME)) == 5
+
+    def test_reports_read_typed_values(self, fake_sheets):
+        """Test that reports work on serial dates and numbers from the fake"""
+        responses.sample_responses("7 snack")
+        responses.sample_responses('🛒 Продукты')
+
+        assert 'snack' in spendings.get_report('📊 День')
+        assert '🛒 Продукты' in spendings.get_report('📊 Месяц')
+        assert fake_sheets.values().get(
+            spreadsheetId='id', range='Spendings!D5', valueRenderOption='UNFORMATTED_VALUE'
+        ).execute()['values'] == [[7]]
+
+    def test_injected_errors_and_quota(self, fake_sheets):
+        """Test that injected failures surface as API errors"""
+        fake_sheets.fail_next(403, 'PERMISSION_DENIED', method='values.get')
+        assert spendings.get_report('📊 Месяц').startswith("Error generating report")
+
+        fake_sheets.quota = 1
+        fake_sheets.clock = lambda: 0.0
+        fake_sheets.values().get(spreadsheetId='id', range='Spendings!A1:A1').execute()
+        with pytest.raises(spendings.HttpError) as error:
+            fake_sheets.values().get(spreadsheetId='id', range='Spendings!A1:A1').execute()
+        assert error.value.resp.status == 429
+
+
+class TestMetrics:
+    """Tests for the /metrics instrumentation"""
+
+    def test_render_text_format(self):
+        """Test counters and histograms in the Prometheus text format"""
+        counter = metrics.Counter('test_total', 'A counter.', ['kind'])
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        histogram = metrics.Histogram('test_seconds', 'A histogram.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+
+        lines = counter.render() + histogram.render()
+        assert '# TYPE test_total counter' in lines
+        assert 'test_total{kind="a"} 3' in lines
+        assert 'test_seconds_bucket{le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{le="1.0"} 2' in lines
+        assert 'test_seconds_bucket{le="+Inf"} 2' in lines
+        assert 'test_seconds_count 2' in lines
+        with pytest.raises(ValueError):
+            counter.inc(other='x')
+
+    def test_sheets_calls_reports_and_cache(self, fake_sheets):
+        """Test that Sheets requests, rows loaded and cache lookups are recorded"""
+        responses.sample_responses("7 snack")
+        spendings.get_report('📊 Месяц')
+        spendings.get_report('📊 Месяц')
+
+        assert metrics.SHEETS_REQUEST_SECONDS.count(function='save_spending') == 1
+        assert metrics.SHEETS_ROWS_READ.value(function='load_data') == 5
+        assert metrics.REPORT_ROWS_LOADED.count(report='month') == 1
+        assert metrics.CACHE_REQUESTS.value(report='month', result='miss') == 1
+        assert metrics.CACHE_REQUESTS.value(report='month', result='hit') == 1
+
+    def test_sheets_errors_are_counted(self, fake_sheets):
+        """Test that failed requests are counted by function and status"""
+        fake_sheets.fail_next(503, 'UNAVAILABLE')
+        spendings.get_total_amount()
+        assert metrics.SHEETS_ERRORS.value(function='get_total_amount', status='503') == 1
+
+    def test_handler_metrics_and_endpoint(self):
+        """Test handler instrumentation and the Flask endpoint"""
+        import app
+        update = Mock()
+        update.effective_chat.id = 999  # not an allowed chat, the handler returns early
+        asyncio.run(main.handle_message(update, Mock()))
+
+        assert metrics.UPDATES.value(handler='handle_message') == 1
+        response = app.app.test_client().get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert 'telebot_updates_total{handler="handle_message"} 1' in response.get_data(as_text=True)
+
+
+RECORDED_UPDATE = {
+    'update_id': 10001,
+    'message': {
+        'message_id': 7,
+        'date': 1760000000,
+        'chat': {'id': 106709724, 'type': 'private'},
+        'from': {'id': 106709724, 'is_bot': False, 'first_name': 'Test'},
+        'text': '📊 День',
+    },
+}
+
+
+class TestWebhook:
+    """Tests for webhook delivery through the Flask app"""
+
+    def test_posted_update_reaches_handler(self, monkeypatch):
+        """Test that a recorded update POSTed to the webhook is answered by the bot"""
+        import app
+        from concurrent.futures import ThreadPoolExecutor
+        from telegram import User
+        from telegram.ext import ExtBot
+        replies = []
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(1, 'Test Bot', True, username='test_bot')
+            return self._bot_user
+
+        async def send_message(self, chat_id, text, **kwargs):
+            replies.append((chat_id, text))
+
+        monkeypatch.setattr(ExtBot, 'get_me', get_me)
+        monkeypatch.setattr(ExtBot, 'set_webhook', AsyncMock(return_value=True))
+        monkeypatch.setattr(ExtBot, 'send_message', send_message)
+        monkeypatch.setattr(main, 'get_response', AsyncMock(return_value='report text'))
+        monkeypatch.setattr(main, 'prewarm', Mock())
+        monkeypatch.setattr(spendings, 'start_balance_refresh', Mock())
+        monkeypatch.setattr(main, '_executor', ThreadPoolExecutor(max_workers=1))
+
+        bot = main.WebhookBot(main.build_application(webhook=True),
+                              url='https://bot.example/telegram', secret='s3cret')
+        bot.start()
+        monkeypatch.setattr(app, '_bot', bot)
+        try:
+            client = app.app.test_client()
+            assert client.post(main.WEBHOOK_PATH, json=RECORDED_UPDATE).status_code == 403
+            response = client.post(main.WEBHOOK_PATH, json=RECORDED_UPDATE,
+                                   headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            assert response.status_code == 200
+
+            deadline = time.monotonic() + 5
+            while not replies and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            bot.stop()
+
+        assert replies == [(106709724, 'report text')]
+        main.get_response.assert_awaited_once_with('📊 День', 106709724)
+        ExtBot.set_webhook.assert_awaited_once()
+        assert ExtBot.set_webhook.await_args.kwargs['secret_token'] == 's3cret'
+
+    def test_webhook_without_bot_asks_for_retry(self):
+        """Test that a process not owning the bot rejects updates with 503"""
+        import app
+        response = app.app.test_client().post(main.WEBHOOK_PATH, json=RECORDED_UPDATE)
+        assert response.status_code == 503
+
+    def test_single_bot_owner(self, monkeypatch, tmp_path):
+        """Test that only one holder gets the bot lock"""
+        import app
+        import fcntl
+        monkeypatch.setattr(app, '_lock_file', None)
+        lock_path = str(tmp_path / 'bot.lock')
+        assert app.acquire_bot_lock(lock_path)
+        assert app.acquire_bot_lock(lock_path)  # already owned by this process
+
+        with open(lock_path) as other:
+            with pytest.raises(OSError):
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        app._lock_file.close()
+
+    def test_stop_bot_stops_polling_and_releases_the_lock(self, monkeypatch, tmp_path):
+        """Test that stopping a polling bot ends run_polling() and lets another process own the bot"""
+        import app
+        import fcntl
+        finished = []
+
+        def run_polling(application):
+            asyncio.get_event_loop().run_forever()  # until stop_running()
+            finished.append(application)
+        application = Mock()
+        application.stop_running = lambda: asyncio.get_running_loop().stop()
+        monkeypatch.setattr(main, 'run_bot', run_polling)
+        monkeypatch.setattr(main, 'build_application', lambda: application)
+        monkeypatch.setattr(main, 'WEBHOOK_URL', None)
+        monkeypatch.setattr(app, 'BOT_LOCK_FILE', str(tmp_path / 'bot.lock'))
+        monkeypatch.setattr(app, '_lock_file', None)
+
+        assert app.start_bot()
+        app.stop_bot()
+        assert finished == [application]
+        with open(tmp_path / 'bot.lock') as other:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+    def test_failed_start_releases_the_lock(self, monkeypatch, tmp_path):
+        """Test that a bot that fails to start stops its loop thread and lets another process own the bot"""
+        import app
+        import fcntl
+        import threading
+        application = AsyncMock()
+        application.initialize.side_effect = RuntimeError("no network")
+        monkeypatch.setattr(main, 'build_application', lambda webhook=False: application)
+        monkeypatch.setattr(main, 'WEBHOOK_URL', 'https://example.com')
+        monkeypatch.setattr(app, 'BOT_LOCK_FILE', str(tmp_path / 'bot.lock'))
+        monkeypatch.setattr(app, '_lock_file', None)
+
+        assert not app.start_bot()
+        assert not any(thread.name == 'telegram-webhook' for thread in threading.enumerate())
+        with open(tmp_path / 'bot.lock') as other:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class TestChatOrderedUpdates:
+    """Tests for concurrent update processing with per-chat ordering"""
+
+    @staticmethod
+    def _update(chat_id):
+        update = Mock()
+        update.effective_chat.id = chat_id
+        return update
+
+    @staticmethod
+    def _process(processor, updates):
+        """Process (update, name, seconds) in arrival order; returns start/end events"""
+        events = []
+
+        async def handle(name, seconds):
+            events.append(('start', name))
+            await asyncio.sleep(seconds)
+            events.append(('end', name))
+
+        async def run():
+            await asyncio.gather(*[processor.process_update(update, handle(name, seconds))
+                                   for update, name, seconds in updates])
+
+        asyncio.run(run())
+        return events
+
+    def test_other_chats_overtake_a_slow_update(self):
+        """Test that a slow update delays only its own chat"""
+        processor = main.ChatOrderedUpdateProcessor(4)
+        group, private = self._update(-1), self._update(1)
+        events = self._process(processor, [
+            (group, 'report', 0.05), (group, 'expense', 0), (private, 'quick', 0)])
+
+        assert events.index(('end', 'quick')) < events.index(('end', 'report'))
+        assert events.index(('start', 'expense')) > events.index(('end', 'report'))
+        assert processor._chats == {}
+
+    def test_concurrency_limit(self):
+        """Test that no more than the configured number of updates run at once"""
+        processor = main.ChatOrderedUpdateProcessor(2)
+        events = self._process(processor, [(self._update(chat_id), chat_id, 0.01) for chat_id in range(5)])
+
+        running = peak = 0
+        for kind, _ in events:
+            running += 1 if kind == 'start' else -1
+            peak = max(peak, running)
+        assert peak == 2
+        assert processor.handler_limit == 2
+
+    def test_waiting_updates_do_not_take_slots(self):
+        """Test that a chat's backlog does not block other chats from the only slot"""
+        processor = main.ChatOrderedUpdateProcessor(1)
+        busy, other = self._update(-1), self._update(1)
+        events = self._process(processor, [
+            (busy, 'first', 0.02), (busy, 'second', 0), (busy, 'third', 0), (other, 'other', 0)])
+
+        starts = [name for kind, name in events if kind == 'start']
+        assert starts == ['first', 'other', 'second', 'third']
+
+    def test_invalid_limit(self):
+        with pytest.raises(ValueError):
+            main.ChatOrderedUpdateProcessor(0)
+
+
+class TestSheetClients:
+    """Tests for the per-thread Google Sheets clients"""
+
+    def test_one_client_per_thread_with_shared_credentials(self, monkeypatch):
+        """Test that threads get their own client and share one credential"""
+        import threading
+        monkeypatch.setattr(spendings, '_clients', threading.local())
+        monkeypatch.setattr(spendings, '_credentials', None)
+        monkeypatch.setattr(spendings, 'SPREADSHEET_ID', 'test_spreadsheet_id')
+        monkeypatch.setattr(spendings.os.path, 'exists', lambda path: True)
+        from google.oauth2.service_account import Credentials
+        import googleapiclient.discovery
+        credentials = Mock()
+        load = Mock(return_value=credentials)
+        build = Mock(side_effect=lambda *args, **kwargs: Mock())
+        monkeypatch.setattr(Credentials, 'from_service_account_file', load)
+        monkeypatch.setattr(googleapiclient.discovery, 'build_from_document', build)
+        monkeypatch.setattr(spendings, '_discovery_document', lambda: {})
+
+        main_client = spendings.get_sheet_service()
+        assert spendings.get_sheet_service() is main_client
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(spendings.get_sheet_service()))
+        thread.start()
+        thread.join()
+
+        assert other[0] is not main_client
+        load.assert_called_once()
+        authorized = [call.kwargs['http'] for call in build.call_args_list]
+        assert len(authorized) == 2
+        assert all(http.credentials is credentials for http in authorized)
+        assert authorized[0].http is not authorized[1].http
+
+    def test_discovery_document_without_network(self, monkeypatch, tmp_path):
+        """Test that the discovery document comes from the library or the disk cache"""
+        from googleapiclient import discovery_cache
+        monkeypatch.setattr(spendings, '_discovery', None)
+        assert spendings._discovery_document()['name'] == 'sheets'
+
+        cache_file = tmp_path / 'discovery.json'
+        cache_file.write_text('{"name": "sheets", "cached": true}')
+        monkeypatch.setattr(spendings, '_discovery', None)
+        monkeypatch.setattr(spendings, 'DISCOVERY_CACHE_FILE', str(cache_file))
+        monkeypatch.setattr(discovery_cache, 'get_static_doc', lambda *args: None)
+        assert spendings._discovery_document() == {'name': 'sheets', 'cached': True}
+
+    def test_heavy_imports_are_deferred(self):
+        """Test that importing the bot modules does not import pandas or the API client"""
+        import subprocess
+        code = ("import sys, spendings, responses; "
+                "print(*[name in sys.modules for name in ('pandas', 'googleapiclient.discovery')])")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)})
+        assert result.stdout.split() == ['False', 'False'], result.stderr
+
+    def test_prewarm_reports_step_timings(self, fake_sheets, monkeypatch):
+        """Test that pre-warming loads the replica and times every step"""
+        monkeypatch.setattr(spendings, '_get_credentials', Mock())
+        timings = spendings.prewarm()
+        assert list(timings) == ['pandas', 'discovery', 'credentials', 'client', 'replica']
+        assert spendings._replica.loaded
+
+
+class TestSheetsScheduler:
+    """Tests for quota throttling and retries of Sheets requests"""
+
+    def test_server_errors_are_retried(self, fake_sheets):
+        """Test that a 503 on a read is retried with backoff"""
+        delays = []
+        spendings._scheduler.sleep = delays.append
+        fake_sheets.fail_next(503, 'UNAVAILABLE', times=2, method='values.get')
+
+        assert not spendings.get_report('📊 Год').startswith('Error')
+        assert len(delays) == 2
+        assert 0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2
+        assert metrics.SHEETS_ERRORS.value(function='load_data', status='503') == 2
+
+    def test_appends_only_retry_rate_limits(self, fake_sheets):
+        """Test that an append is retried on 429 but not on a 5xx"""
+        fake_sheets.fail_next(429, 'RATE_LIMIT_EXCEEDED', method='values.append')
+        message, row_number = spendings.save_spending("5 tea")
+        assert row_number == 5
+
+        fake_sheets.fail_next(503, 'UNAVAILABLE', method='values.append')
+        message, row_number = spendings.save_spending("6 tea")
+        assert row_number is None
+        assert message.startswith("Error saving spending")
+        assert fake_sheets.call_count('values.append') == 3
+
+    def test_gives_up_after_max_retries(self):
+        """Test that a request failing every time raises after the retries"""
+        from fake_sheets import http_error
+        sheets_scheduler = scheduler.SheetsScheduler(None, None, max_retries=2, sleep=lambda seconds: None)
+        call = Mock(side_effect=http_error(500, 'backendError'))
+        with pytest.raises(spendings.HttpError):
+            sheets_scheduler.run(call)
+        assert call.call_count == 3
+
+    def test_token_bucket_rate(self):
+        """Test that tokens beyond the burst are handed out at the refill rate"""
+        bucket = scheduler.TokenBucket(rate=20, capacity=2)
+        assert bucket.acquire() < 0.01
+        assert bucket.acquire() < 0.01
+        assert bucket.acquire() >= 0.03
+
+    def test_interactive_requests_go_first(self):
+        """Test that a waiting interactive request gets the next token before a background one"""
+        import threading
+        bucket = scheduler.TokenBucket(rate=10, capacity=1)
+        bucket.acquire()
+        order = []
+
+        def take(priority, name):
+            bucket.acquire(priority)
+            order.append(name)
+
+        background = threading.Thread(target=take, args=(scheduler.BACKGROUND, 'background'))
+        interactive = threading.Thread(target=take, args=(scheduler.INTERACTIVE, 'interactive'))
+        background.start()
+        time.sleep(0.02)
+        interactive.start()
+        background.join()
+        interactive.join()
+        assert order == ['interactive', 'background']
+
+    def test_background_context(self):
+        """Test that background() only applies inside the with block and thread"""
+        sheets_scheduler = scheduler.SheetsScheduler(None, None)
+        with sheets_scheduler.background():
+            assert sheets_scheduler.priority == scheduler.BACKGROUND
+        assert sheets_scheduler.priority == scheduler.INTERACTIVE
+
+
+class TestSingleFlight:
+    """Tests for coalescing concurrent loads"""
+
+    @staticmethod
+    def _concurrently(func, callers=8):
+        import threading
+        results = [None] * callers
+        barrier = threading.Barrier(callers)
+
+        def call(index):
+            barrier.wait()
+            results[index] = func()
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_simultaneous_reports_share_one_load(self, fake_sheets):
+        """Test that simultaneous month reports make a single Sheets read"""
+        fake_sheets.latency = 0.05
+        results = self._concurrently(lambda: spendings.get_report('📊 Месяц'))
+
+        assert len(set(results)) == 1
+        assert fake_sheets.call_count('values.get') == 1
+        assert metrics.COALESCED_CALLS.value(call='report_month') + \
+            metrics.CACHE_REQUESTS.value(report='month', result='hit') == 7
+
+    def test_reports_with_a_shared_label_are_not_coalesced(self):
+        """Test that '📊 Год' never gets the text of a concurrent '📊 Год 2024'"""
+        texts = ['📊 Год', '📊 Год 2024'] * 4
+        with patch('spendings._build_report', side_effect=lambda text: time.sleep(0.05) or text):
+            results = self._concurrently(lambda: spendings.get_report(texts.pop()))
+        assert sorted(results) == sorted(['📊 Год', '📊 Год 2024'] * 4)
+
+    def test_report_after_a_write_does_not_join_an_older_build(self):
+        """Test that a caller who just saved gets a build started after the save"""
+        import threading
+        started, release = threading.Event(), threading.Event()
+        builds = []
+
+        def build(text):
+            builds.append(text)
+            if len(builds) == 1:
+                started.set()
+                release.wait(5)
+                return 'before the save'
+            return 'after the save'
+        with patch('spendings._build_report', side_effect=build):
+            first = threading.Thread(target=spendings.get_report, args=('📊 Месяц',))
+            first.start()
+            started.wait(5)
+            spendings._report_cache.record_write()
+            result = spendings.get_report('📊 Месяц')
+            release.set()
+            first.join()
+        assert result == 'after the save'
+        assert len(builds) == 2
+
+    def test_simultaneous_balance_requests_share_one_read(self, fake_sheets):
+        """Test that simultaneous balance presses read Pivot!D2 and the sheet once"""
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '1234.5']])
+        fake_sheets.latency = 0.05
+        results = self._concurrently(spendings.get_total_amount)
+
+        assert results == ['€ 1234.50'] * 8
+        assert fake_sheets.call_count('values.get') == 3  # Pivot, the replica and the archive manifest, once each
+
+    def test_errors_reach_every_waiter(self):
+        """Test that a failed in-flight call raises in all callers sharing it"""
+        import threading
+        flights = spendings.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait()
+            raise ValueError("boom")
+
+        errors = []
+
+        def call():
+            try:
+                flights.do('key', load)
+            except ValueError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.02)
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert errors == ['boom', 'boom']
+        assert len(calls) == 1
+        assert flights.do('key', lambda: 'fresh') == 'fresh'
+
+
+class TestBalanceEngine:
+    """Tests for answering the balance locally"""
+
+    def test_combined_cell_is_adjusted_locally(self, fake_sheets):
+        """Test that the cash part of a cash/invest cell follows saves and deletes"""
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', 'cash: €1 234,56 invest: €500']])
+
+        assert spendings.get_total_amount() == "cash: €1 234,56\ninvest: €500"
+        spendings.save_spending("4.20 bus")
+        assert spendings.get_total_amount() == "cash: €1230.36\ninvest: €500"
+        spendings.delete_last_spending()
+        assert spendings.get_total_amount() == "cash: €1 234,56\ninvest: €500"
+
+    def test_opening_balance_never_reads_pivot(self, fake_sheets, monkeypatch):
+        """Test that configured balances are combined with the replica total"""
+        monkeypatch.setattr(spendings, '_balance', spendings.BalanceEngine(opening=1000, invest=250))
+
+        assert spendings.get_total_amount() == "cash: €950.51\ninvest: €250.00"
+        assert fake_sheets.call_count('values.get') == 2  # the replica and the archive manifest
+
+    def test_stale_anchor_is_read_again(self, fake_sheets, monkeypatch):
+        """Test that without the refresher an expired anchor is re-read on request"""
+        monkeypatch.setattr(spendings, '_balance', spendings.BalanceEngine(refresh_seconds=0))
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '100']])
+        assert spendings.get_total_amount() == "€ 100.00"
+
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '90']])
+        assert spendings.get_total_amount() == "€ 90.00"
+
+    def test_refresher_anchors_in_background(self, fake_sheets, monkeypatch):
+        """Test that the background refresher reads Pivot before the first request"""
+        engine = spendings.BalanceEngine(refresh_seconds=60)
+        monkeypatch.setattr(spendings, '_balance', engine)
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '100']])
+
+        engine.start()
+        try:
+            deadline = time.monotonic() + 5
+            while engine._anchor is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            reads = fake_sheets.call_count('values.get')
+            assert spendings.get_total_amount() == "€ 100.00"
+            assert fake_sheets.call_count('values.get') == reads
+        finally:
+            engine.stop()
+
+    def test_anchor_read_across_a_write_is_read_again(self, fake_sheets):
+        """Test that an anchor which may or may not include a save is not trusted"""
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '100']])
+        read_values = spendings._read_values
+
+        def read_during_save(service, range_name, function):
+            spendings._report_cache.record_write()
+            return read_values(service, range_name, function)
+        with patch('spendings._read_values', side_effect=read_during_save):
+            assert spendings.get_total_amount() == "€ 100.00"
+
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '90']])
+        assert spendings.get_total_amount() == "€ 90.00"
+        reads = fake_sheets.call_count('values.get')
+        assert spendings.get_total_amount() == "€ 90.00"
+        assert fake_sheets.call_count('values.get') == reads
+
+    def test_amount_formats(self):
+        """Test reading Pivot amounts with either decimal separator"""
+        assert spendings._amount_cents('1 234,56') == 123456
+        assert spendings._amount_cents('1,234.56') == 123456
+        assert spendings._amount_cents('1.234,5') == 123450
+        assert spendings._amount_cents('12,345') == 1234500
+        assert spendings._amount_cents('500,') == 50000
+
+
+class TestYearArchive:
+    """Tests for moving closed years out of the Spendings sheet"""
+
+    @pytest.fixture
+    def years(self, fake_sheets):
+        """Two spendings in each of the last three years, the current one included"""
+        year = datetime.now().year
+        rows = [['year', 'month', 'date', 'sum', 'comment', 'category']]
+        for offset, category in ((2, '🛒 Продукты'), (1, '🚇 Транспорт'), (0, '🛒 Продукты')):
+            for day in (3, 4):
+                rows.append([str(year - offset), '01 january', f'{year - offset}-01-0{day} 10:00:00',
+                             f'{day + offset}.50', f'item {offset}{day}', category])
+        fake_sheets.set_values(spendings.SHEET_NAME, rows)
+        return year
+
+    def test_closed_years_leave_the_hot_sheet(self, fake_sheets, years):
+        """Test that old rows move to archive sheets while reports stay the same"""
+        before = [spendings.get_report(f'📊 Год {years - 1}'), spendings.get_report(spendings.YEARS_REPORT)]
+
+        assert spendings.archive_closed_years() == f"Archived 4 spendings of {years - 2}, {years - 1}"
+        hot = fake_sheets.values_of(spendings.SHEET_NAME)
+        assert len(hot) == 3 and all(row[0] == str(years) for row in hot[1:])
+        assert len(fake_sheets.values_of(f'{spendings.SHEET_NAME} {years - 2}')) == 3
+        assert fake_sheets.values_of('Archive')[0] == spendings.ARCHIVE_COLUMNS
+
+        spendings.reset_caches()
+        assert [spendings.get_report(f'📊 Год {years - 1}'), spendings.get_report(spendings.YEARS_REPORT)] == before
+        assert before[0] == f"{years - 1}\n🚇 Транспорт €10.0\nTotal: 10.0 €"
+        assert spendings.archive_closed_years() == "Nothing to archive"
+
+    def test_journaled_rows_follow_the_deleted_rows(self, fake_sheets, years, tmp_path, monkeypatch):
+        """Test that a sent journal entry points at its shifted row after archiving"""
+        monkeypatch.setattr(spendings, 'WRITE_BEHIND', True)
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        with patch('journal.SpendingJournal.start'):
+            try:
+                _, ref = spendings.save_spending("4.20 bus")
+                spendings.get_journal().flush()
+                assert spendings.get_journal().resolve(ref) == 8
+
+                assert spendings.archive_closed_years().startswith("Archived 4 spendings")
+                assert spendings.get_journal().resolve(ref) == 4
+                spendings.update_spending_categories([(ref, '🚇 Транспорт')])
+                assert fake_sheets.values_of(spendings.SHEET_NAME)[3][4:] == ['bus', '🚇 Транспорт']
+            finally:
+                spendings.stop_journal()
+
+    def test_interrupted_run_can_be_repeated(self, fake_sheets, years):
+        """Test that rows copied by a failed run are not archived twice"""
+        fake_sheets.fail_next(403, 'PERMISSION_DENIED', method='batchUpdate')
+        fake_sheets.set_values(f'{spendings.SHEET_NAME} {years - 1}', [['year'], [], []])
+        fake_sheets.set_values(f'{spendings.SHEET_NAME} {years - 2}', [['year']])
+        fake_sheets.set_values('Archive', [spendings.ARCHIVE_COLUMNS])
+
+        assert spendings.archive_closed_years().startswith("Error archiving spendings")
+        assert len(fake_sheets.values_of(spendings.SHEET_NAME)) == 7
+        assert spendings.archive_closed_years() == f"Archived 4 spendings of {years - 2}, {years - 1}"
+        assert len(fake_sheets.values_of(f'{spendings.SHEET_NAME} {years - 1}')) == 3
+        assert spendings._archive.load().year_totals() == [(years - 2, 12.0), (years - 1, 10.0)]
+
+    def test_opening_balance_counts_archived_spendings(self, fake_sheets, years, monkeypatch):
+        """Test that archiving does not change a balance computed from the opening balance"""
+        monkeypatch.setattr(spendings, '_balance', spendings.BalanceEngine(opening=100))
+        assert spendings.get_total_amount() == "€ 70.00"
+        spendings.archive_closed_years()
+        assert spendings.get_total_amount() == "€ 70.00"
+
+    def test_pivot_balance_counts_archived_spendings(self, fake_sheets, years):
+        """Test that the Pivot anchor is corrected for the rows archiving took out of its range"""
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '1000']])
+        assert spendings.get_total_amount() == "€ 1000.00"
+        spendings.archive_closed_years()
+        # Pivot no longer subtracts the 22.00 archived
+        fake_sheets.set_values('Pivot', [['', '', '', 'total'], ['', '', '', '1022']])
+        assert spendings.get_total_amount() == "€ 1000.00"
+
+
+class TestSpendingLedger:
+    """Tests for the local ledger as the primary store"""
+
+    @pytest.fixture
+    def ledger(self, fake_sheets, tmp_path, monkeypatch):
+        """Ledger created from the sample sheet, mirrored through a journal"""
+        monkeypatch.setattr(spendings, 'STORAGE_BACKEND', 'ledger')
+        monkeypatch.setattr(spendings, 'LEDGER_FILE', str(tmp_path / 'spendings.ledger'))
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        yield spendings.get_store().local.ledger
+        spendings.stop_journal()
+        spendings.close_store()
+
+    def test_records_persist(self, tmp_path):
+        """Test that appends, deletes and category changes survive reopening"""
+        from ledger import SpendingLedger
+        path = str(tmp_path / 'test.ledger')
+        ledger = SpendingLedger(path)
+        ledger.append([(datetime(2025, 12, 31, 23, 0), 1050, 'kofe ☕', '', 1),
+                       (datetime(2026, 1, 2, 9, 0), 250, 'bus', '🚇 Транспорт', 2)])
+        ledger.set_category(ledger.find(1), '🍔 Еда вне дома')
+        ledger.delete(ledger.find(2))
+        ledger.close()
+
+        ledger = SpendingLedger(path)
+        assert len(ledger) == 1 and ledger.count == 2
+        assert ledger.categories_for(2025, 12) == [('🍔 Еда вне дома', 10.5)]
+        assert ledger.categories_for(2026) == []
+        assert ledger.year_totals() == [(2025, 10.5)]
+        assert ledger.comments(ledger.since(datetime(2025, 1, 1))) == ['kofe ☕']
+        ledger.close()
+
+    def test_rejects_other_files(self, tmp_path):
+        from ledger import SpendingLedger
+        path = tmp_path / 'other.db'
+        path.write_bytes(b'SQLite format 3\x00' + bytes(100))
+        with pytest.raises(ValueError):
+            SpendingLedger(str(path))
+
+    def test_created_from_the_sheet(self, ledger, fake_sheets):
+        """Test that a new ledger imports the sheet and links rows to sheet rows"""
+        assert len(ledger) == 3
+        assert ledger.total_cents() == 4949
+        assert ledger.find(-3) == 1
+        assert ledger.categories_for(2026, 1) == [('🍔 Еда вне дома', 8.5), ('🛒 Продукты', 40.99)]
+
+    def test_reports_and_saves_without_reading_the_sheet(self, ledger, fake_sheets):
+        """Test that saves, categories, undo and reports work on the ledger"""
+        reads = fake_sheets.call_count('values.get')
+        spendings.save_spending("4.20 bus")
+        spendings.update_last_spending_category('🚇 Транспорт')
+        ref = spendings.save_spendings(["3 tea"])[0][2]
+        spendings.update_spending_categories([(ref, '🍔 Еда вне дома')])
+
+        month = spendings.get_report('📊 Месяц')
+        assert '🚇 Транспорт €4.2' in month and 'Total: 7.2' in month
+        assert 'bus' in spendings.get_report('📊 День')
+        assert spendings.delete_last_spending() == "Last spending entry deleted successfully"
+        assert 'Total: 4.2' in spendings.get_report('📊 Месяц')
+        assert fake_sheets.call_count('values.get') == reads
+
+        spendings.get_journal().flush()
+        mirrored = fake_sheets.values_of(spendings.SHEET_NAME)
+        assert [row[4] for row in mirrored[4:]] == ['bus']
+        assert len(ledger) == 4
+
+
+class TestStorage:
+    """Tests for the storage backends and migrating between them"""
+
+    @pytest.fixture(params=['ledger', 'sqlite'])
+    def local_store(self, request, fake_sheets, tmp_path, monkeypatch):
+        """Local store created from the sample sheet, mirrored through a journal"""
+        monkeypatch.setattr(spendings, 'STORAGE_BACKEND', request.param)
+        monkeypatch.setattr(spendings, 'LEDGER_FILE', str(tmp_path / 'spendings.ledger'))
+        monkeypatch.setattr(spendings, 'SQLITE_FILE', str(tmp_path / 'spendings.db'))
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        yield spendings.get_store()
+        spendings.stop_journal()
+        spendings.close_store()
+
+    @staticmethod
+    def _row(moment, amount, comment, category=''):
+        return [moment[:4], '', moment, amount, comment, category]
+
+    def test_sqlite_store(self, tmp_path):
+        """Test SQLite writes, aggregates, range queries and reopening"""
+        from datetime import date
+        from storage import SQLiteStore
+        path = str(tmp_path / 'test.db')
+        store = SQLiteStore(path)
+        store.append([self._row('2025-12-31 23:00:00', '10.5', 'kofe ☕'),
+                      self._row('2026-01-02 09:00:00', '2.5', 'bus', '🚇 Транспорт'),
+                      self._row('2026-01-03 09:00:00', '4', 'tea')], [1, 2, -7])
+        assert store.set_category('🍔 Еда вне дома', 1)
+        assert store.set_category('🍔 Еда вне дома', -7)
+        assert not store.set_category('x', 99)
+        store.sheet_rows_deleted(2, 3)
+        assert store.delete_last() == -4
+        store.close()
+
+        store = SQLiteStore(path)
+        assert len(store) == 2 and store.total_cents() == 1300
+        assert store.categories_for(2025, 12) == [('🍔 Еда вне дома', 10.5)]
+        assert store.categories_for(2026) == [('🚇 Транспорт', 2.5)]
+        assert store.year_totals() == [(2025, 10.5), (2026, 2.5)]
+        assert list(store.query(date(2026, 1, 1))['comment']) == ['bus']
+        assert list(store.query(date(2025, 1, 1), date(2026, 1, 1))['sum']) == [10.5]
+        assert store.rows()[0] == (['2025', '12 december', '2025-12-31 23:00:00', '10.5', 'kofe ☕',
+                                    '🍔 Еда вне дома'], 1)
+        store.close()
+
+    def test_sqlite_aggregates_use_the_index(self, tmp_path):
+        from storage import SQLiteStore
+        store = SQLiteStore(str(tmp_path / 'test.db'))
+        plan = store._read('EXPLAIN QUERY PLAN SELECT category, SUM(cents) FROM spendings'
+                           ' WHERE year = ? AND month = ? GROUP BY category', (2026, 1))
+        assert 'COVERING INDEX spendings_period' in ' '.join(row[-1] for row in plan)
+        store.close()
+
+    def test_local_store_reports_without_reading_the_sheet(self, local_store, fake_sheets):
+        """Test that saves, categories, undo and reports are answered by the local store"""
+        assert len(local_store) == 3 and local_store.total_cents() == 4949
+        reads = fake_sheets.call_count('values.get')
+        spendings.save_spending("4.20 bus")
+        spendings.update_last_spending_category('🚇 Транспорт')
+        ref = spendings.save_spendings(["3 tea"])[0][2]
+        spendings.update_spending_categories([(ref, '🍔 Еда вне дома')])
+
+        month = spendings.get_report('📊 Месяц')
+        assert '🚇 Транспорт €4.2' in month and 'Total: 7.2' in month
+        assert 'bus' in spendings.get_report('📊 День')
+        assert spendings.delete_last_spending() == "Last spending entry deleted successfully"
+        assert 'Total: 4.2' in spendings.get_report('📊 Месяц')
+        assert fake_sheets.call_count('values.get') == reads
+
+        spendings.get_journal().flush()
+        assert [row[4] for row in fake_sheets.values_of(spendings.SHEET_NAME)[4:]] == ['bus']
+
+    def test_mirrored_undo_keeps_the_local_spending_when_the_sheet_differs(self, local_store):
+        """Test that undo only deletes locally what Google Sheets deleted"""
+        spendings.save_spending("4.20 bus")
+        with patch.object(local_store.sheets, 'delete_last', return_value=None):
+            assert spendings.delete_last_spending() == "No spending entries to delete"
+        with patch.object(local_store.sheets, 'delete_last', return_value=99):
+            assert spendings.delete_last_spending() == "No spending entries to delete"
+        assert len(local_store) == 4
+        assert spendings.delete_last_spending() == "Last spending entry deleted successfully"
+        assert len(local_store) == 3
+
+    def test_migrate_from_sheets(self, fake_sheets, tmp_path, monkeypatch):
+        """Test that a migrated SQLite store answers reports like the sheet did"""
+        path = str(tmp_path / 'spendings.db')
+        expected = spendings.get_report('📊 Годы')
+        assert spendings.migrate('sqlite', path) == 3
+        with pytest.raises(ValueError):
+            spendings.migrate('sqlite', path)
+        with pytest.raises(ValueError):
+            spendings.migrate('sheets')
+
+        spendings.reset_caches()
+        monkeypatch.setattr(spendings, 'STORAGE_BACKEND', 'sqlite')
+        monkeypatch.setattr(spendings, 'SQLITE_FILE', path)
+        monkeypatch.setattr(spendings, 'JOURNAL_FILE', str(tmp_path / 'journal.db'))
+        try:
+            assert spendings.get_report('📊 Годы') == expected
+            assert spendings.get_store().local.rows()[0][1] == -2
+        finally:
+            spendings.stop_journal()
+            spendings.close_store()
+
+    def test_migrate_between_local_stores(self, local_store, tmp_path):
+        """Test that migrating keeps the links to the mirrored sheet rows"""
+        target = 'ledger' if spendings.STORAGE_BACKEND == 'sqlite' else 'sqlite'
+        spendings.save_spending("4.20 bus")
+        assert spendings.migrate(target, str(tmp_path / 'migrated')) == 4
+        copy = spendings._open_local_store(target, str(tmp_path / 'migrated'))
+        assert copy.rows() == local_store.rows()
+        copy.close()
+
+
 class TestIntegration:
     """Integration tests combining multiple components"""
 